@@ -152,8 +152,8 @@ class PolarCoordinateSystem(AnalyticPlaneDiffeomoprhism):
     def forward(self, p):
         p_0 = p - self.circle.origin
         r = np.linalg.norm(p_0)
-        phi = math.atan2(p_0[1], p_0[0])
-        return np.array([r, phi])
+        phi = np.arctan2(p_0[1], p_0[0])
+        return np.hstack([r, phi])
 
     # Converts from Polar to Euclidean
     # p[0] : r
@@ -181,6 +181,11 @@ def ellipse_polygon(a, b,
 
 
 class ConvexPolygon(Polygon):
+    """
+        A convex polygon, the inside test and the intersection with the
+        rays from the focus are computed for points (2, N) or meshgrids
+        (2, n, m) with the edge arrays of the Polygon class.
+    """
 
     def __init__(self,
                  origin=np.array([0., 0.]),
@@ -197,31 +202,42 @@ class ConvexPolygon(Polygon):
     def focus(self):
         return self._focus
 
+    def _angles(self, x):
+        """ angles in [0, 2pi) around the focus of the points x (2, ...)
+            measured from the first vertex (see vectors_angle) """
+        v0 = self._p1[0] - self._focus
+        v = (x.T - self._focus).T
+        return np.mod(np.arctan2(
+            v0[0] * v[1] - v0[1] * v[0],
+            v0[0] * v[0] + v0[1] * v[1]), 2 * np.pi)
+
     def _vertex_coordinates(self):
         """ associates an angle for each vertex """
-        v0 = self._verticies[0] - self._focus
-        self._coordinates = [None] * len(self._verticies)
-        for i, v in enumerate(self._verticies):
-            self._coordinates[i] = vectors_angle(v0, v - self._focus)
+        self._coordinates = self._angles(self._p1.T)
+        # the edges turn in the same direction, + 1 counter-clockwise
+        self._turn = np.sign(np.sum(
+            self._p1[:, 0] * self._p2[:, 1] - self._p2[:, 0] * self._p1[:, 1]))
+
+    def is_inside(self, x):
+        """ x is inside when it is on the inner side of all the edges """
+        points = x.reshape(2, -1)
+        a = self._p1[:, :, None]
+        u = (self._p2 - self._p1)[:, :, None]
+        side = self._turn * (u[:, 0] * (points[1] - a[:, 1]) -
+                             u[:, 1] * (points[0] - a[:, 0]))
+        return np.all(side >= 0., axis=0).reshape(x.shape[1:])
 
     def intersection_point(self, x):
         """ point on the boundary that intersects the
-            line between the focus and a given point
+            line between the focus and a given point (2, ...)
             TODO : test this function """
-        v0 = self._verticies[0] - self._focus
-        alpha = vectors_angle(v0, x - self._focus)
-        j = 0
-        for i, theta in enumerate(self._coordinates):
-            if theta > alpha:
-                if i == 0:
-                    j = len(self._coordinates) - 1
-                else:
-                    j = i - 1
-                break
+        k = len(self._coordinates)
+        i = np.searchsorted(self._coordinates, self._angles(x), side="right")
+        last = i == k
+        j = np.where(last, 0, np.where(i == 0, k - 1, i - 1))
+        i = np.where(last, k - 1, i)
         return line_line_intersection_det(
-            self._focus, x,
-            self._verticies[i],
-            self._verticies[j])
+            self._focus, x, self._p1[i].T, self._p1[j].T)
 
 
 class AnalyticConvexPolygon(AnalyticPlaneDiffeomoprhism):
@@ -296,10 +312,8 @@ class ElectricCircle(AnalyticPlaneDiffeomoprhism):
         # print "origin : ", self.origin
         x_center = x - self.circle.origin
         d_1 = np.linalg.norm(x_center)
-        y = np.array([0., 0.])
-        y[0] = math.pow(d_1, self.eta)
-        y[1] = math.atan2(x_center[1], x_center[0])
-        return y
+        return np.hstack([d_1 ** self.eta,
+                          np.arctan2(x_center[1], x_center[0])])
 
     # maps them back outside of the circle
     def inverse(self, y):
@@ -314,48 +328,54 @@ class ElectricCircle(AnalyticPlaneDiffeomoprhism):
 
 
 class AnalyticEllipse(AnalyticPlaneDiffeomoprhism):
+    """
+    Squishes the plane around an ellipse along the rays from its center,
+    the radius of the deformation is the distance from the center to the
+    ellipse along the ray, which is the same for x and its image.
+    """
 
-    def __init__(self):
-        self.ellipse = Ellipse()
-        self.radius = .1
-        self.eta = self.radius  # for the exp
-        # self.eta = .01 # for the 1/x
+    def __init__(self, origin=[.1, -.1], a=.2, b=.1, orientation=0.):
+        self.ellipse = Ellipse(a, b, origin, orientation)
         self.gamma = 1.
-        self.origin = np.array([.1, -.1])
+        self.set_alpha(alpha_f, beta_inv_f)
 
-    # Access the internal object.
     def object(self):
+        """ Access the internal object. """
         return self.ellipse
 
-    # To recover the distance scaling one should
-    # pass the alpha and beta inverse functions.
     def set_alpha(self, a, b):
+        """ To recover the distance scaling one should
+            pass the alpha and beta inverse functions."""
         self.alpha_ = a
         self.beta_inv_ = b
 
-    # squishes points inside the circle
+    def radius(self, x):
+        return self.ellipse.radius(x)
+
     def Deformationforward(self, x):
-        x_center = x - self.origin
+        """ squishes points inside the ellipse """
+        x_center = x - self.ellipse.origin
+        r = self.radius(x)
         d_1 = np.linalg.norm(x_center)
-        alpha = self.alpha_(self.eta, self.radius, self.gamma, d_1)
+        alpha = self.alpha_(r, r, self.gamma, d_1)
         return alpha * normalize(x_center)
 
-    # maps them back outside of the circle
     def Deformationinverse(self, y):
-        # print "origin : ", self.origin
-        y_center = y - self.origin
+        """ maps them back outside of the ellipse """
+        y_center = y - self.ellipse.origin
+        r = self.radius(y)
         d_2 = np.linalg.norm(y_center)
-        d_1 = self.beta_inv_(self.eta, self.radius, self.gamma, d_2)
+        d_1 = self.beta_inv_(r, r, self.gamma, d_2)
         alpha = d_1 - d_2
         return alpha * normalize(y_center)
 
-    # squishes points inside the circle
     def forward(self, x):
+        """ squishes points inside the ellipse """
         y = x - self.Deformationforward(x)
         return y
 
-    # maps them back outside of the circle
     def inverse(self, y):
+        """ maps them back outside of the ellipse """
         x = y + self.Deformationinverse(y)
         return x
 
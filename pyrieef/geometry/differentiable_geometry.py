@@ -19,11 +19,31 @@
 
 import numpy as np
 import copy
+from collections import OrderedDict
 from abc import abstractmethod
+from scipy import sparse
+from .jet import *
+from .structured_jacobians import *
 
 
 class DifferentiableMap:
 
+    # Set to False once the forward function failed to run on jets,
+    # the derivatives are then computed by finite differences.
+    _jet_compatible = True
+
+    # Instrumentation hook called on each new map and its profile
+    # (see profiling.py), both are None unless profiling is enabled
+    # so that the maps are not wrapped otherwise.
+    _instrument = None
+    _profile = None
+
+    def __new__(cls, *args, **kwargs):
+        obj = object.__new__(cls)
+        if DifferentiableMap._instrument is not None:
+            DifferentiableMap._instrument(obj)
+        return obj
+
     @abstractmethod
     def output_dimension(self):
         raise NotImplementedError()
@@ -54,28 +74,171 @@ class DifferentiableMap:
     def jacobian(self, q):
         """ Should return a matrix or single value of
                 m x n : ouput x input (dimensions)
-            by default the method returns the finite difference jacobian.
+            by default the method returns the forward mode automatic
+            differentiation jacobian when the forward function supports
+            jets (see jet.py) and the finite difference jacobian otherwise.
             WARNING the object returned by this function is a numpy matrix."""
-        return finite_difference_jacobian(self, q)
+        if self._jet_compatible:
+            try:
+                return forward_mode_jacobian(self, q)
+            except JET_ERRORS:
+                self._jet_compatible = False
+        if self._profile is not None:
+            self._profile.finite_differences += 1
+        return vectorized_finite_difference_jacobian(self, q)
 
     def hessian(self, q):
         """ Should return the hessian matrix
                 n x n : input x input (dimensions)
-            by default the method returns the finite difference hessian
+            by default the method returns the forward mode automatic
+            differentiation hessian when the forward function supports
+            jets and otherwise the finite difference hessian
             that relies on the jacobian function.
             This method would be a third order tensor
             in the case of multiple output, we exclude this case for now.
             WARNING the object returned by this function is a numpy matrix."""
-        return finite_difference_hessian(self, q)
+        assert self.output_dimension() == 1
+        if self._jet_compatible:
+            try:
+                return forward_mode_hessian(self, q)
+            except JET_ERRORS:
+                self._jet_compatible = False
+        if self._profile is not None:
+            self._profile.finite_differences += 1
+        return vectorized_finite_difference_hessian(self, q)
 
     def evaluate(self, q):
         """ Evaluates the map and jacobian simultaneously. The default
-            implementation simply calls both forward and Getjacobian()
-            separately but overriding this method can make the evaluation
-            more efficient """
-        x = self.forward(q)
-        J = self.jacobian(q)
-        return [x, J]
+            implementation relies on evaluate_all, overriding this method
+            can make the evaluation more efficient """
+        return self.evaluate_all(q, order=1)
+
+    def evaluate_all(self, q, order=2):
+        """ Evaluates the map and its derivatives in a single query
+                order 0 : [y]
+                order 1 : [y, J]
+                order 2 : [y, J, H] (only for functions)
+            The default implementation runs the forward function once on
+            jets when the derivatives are obtained by automatic
+            differentiation, otherwise it calls forward, jacobian and
+            hessian separately. Maps override this method to reuse
+            intermediate results within the query.
+            WARNING J and H are numpy matrices. """
+        uses_jets = (
+            type(self).jacobian is DifferentiableMap.jacobian and (
+                order < 2 or type(self).hessian is DifferentiableMap.hessian))
+        if order > 0 and uses_jets and self._jet_compatible:
+            try:
+                return forward_mode_evaluate(self, q, order)
+            except JET_ERRORS:
+                self._jet_compatible = False
+        values = [self.forward(q)]
+        if order > 0:
+            values.append(self.jacobian(q))
+        if order > 1:
+            values.append(self.hessian(q))
+        return values
+
+    def forward_record(self, q):
+        """ Evaluates the map and records the quantities needed to
+            backpropagate through it (reverse mode differentiation).
+            Returns the output y and a backward function that maps
+            an output cotangent w (m) to the input cotangent w^T J (n).
+            The default implementation stores the jacobian, composite maps
+            override this method so that a single forward pass records
+            all intermediate values. """
+        [y, J] = self.evaluate(q)
+        J = np.asarray(J).reshape(
+            self.output_dimension(), self.input_dimension())
+        return y, lambda w: np.dot(np.asarray(w).reshape(J.shape[0]), J)
+
+    def value_and_gradient(self, q):
+        """ Evaluates a function (output dimension is one) and its
+            gradient with one forward and one backward pass, the cost
+            of the gradient is a small multiple of the cost of forward.
+            Returns [value, gradient], the gradient has the shape of q. """
+        assert self.output_dimension() == 1
+        y, backward = self.forward_record(q)
+        return [y, np.asarray(backward(np.ones(1))).reshape(q.shape)]
+
+    def forward_into(self, q, out):
+        """ Writes the output in the preallocated array out (m) and
+            returns out. The *_into methods evaluate the maps without
+            allocating the results in optimization loops: the default
+            implementations copy the result of forward, jacobian and
+            hessian, maps override them to write directly in out. """
+        out[...] = np.reshape(np.asarray(self.forward(q)), out.shape)
+        return out
+
+    def jacobian_into(self, q, out):
+        """ Writes the jacobian in the preallocated array out (m x n) """
+        out[...] = np.reshape(np.asarray(self.jacobian(q)), out.shape)
+        return out
+
+    def hessian_into(self, q, out):
+        """ Writes the hessian in the preallocated array out (n x n) """
+        out[...] = np.reshape(np.asarray(self.hessian(q)), out.shape)
+        return out
+
+    def _buffer(self, name, shape):
+        """ Returns an array of the map workspace, which is allocated on
+            the first call and reused by the following ones. The content
+            of the array is overwritten by the next call. """
+        buffers = self.__dict__.setdefault("_buffers", {})
+        buffer = buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = buffers[name] = np.zeros(shape)
+        return buffer
+
+    def hessian_vector_product(self, q, v):
+        """ Product H v of the hessian with a vector v of the input
+            dimension, which is all Newton-CG needs, returns an array with
+            the shape of q. The default implementation forms the hessian,
+            composite maps override this method so that the n x n hessian
+            is never built. """
+        assert self.output_dimension() == 1
+        Hv = np.dot(np.asarray(self.hessian(q)), np.asarray(v).flatten())
+        return Hv.reshape(np.shape(q))
+
+    def forward_batch(self, Q):
+        """ Evaluates the map on a batch of N points
+                Q : N x n, one input point per row
+            returns an array of dimension N x m.
+            The default implementation loops over the points, overriding
+            this method allows to vectorize the evaluation. """
+        Q = np.asarray(Q)
+        m = self.output_dimension()
+        Y = np.zeros((Q.shape[0], m))
+        for i, q in enumerate(Q):
+            Y[i] = np.asarray(self.forward(q)).reshape(m)
+        return Y
+
+    def jacobian_batch(self, Q):
+        """ Jacobians on a batch of N points
+                Q : N x n, one input point per row
+            returns an array of dimension N x m x n.
+            Unlike the jacobian function, the object returned by this
+            function is a numpy array (not a numpy matrix). """
+        Q = np.asarray(Q)
+        m = self.output_dimension()
+        n = self.input_dimension()
+        J = np.zeros((Q.shape[0], m, n))
+        for i, q in enumerate(Q):
+            J[i] = np.asarray(self.jacobian(q)).reshape(m, n)
+        return J
+
+    def hessian_batch(self, Q):
+        """ Hessians on a batch of N points
+                Q : N x n, one input point per row
+            returns an array of dimension N x n x n.
+            Only defined for functions (output dimension is one). """
+        assert self.output_dimension() == 1
+        Q = np.asarray(Q)
+        n = self.input_dimension()
+        H = np.zeros((Q.shape[0], n, n))
+        for i, q in enumerate(Q):
+            H[i] = np.asarray(self.hessian(q)).reshape(n, n)
+        return H
 
 
 class Compose(DifferentiableMap):
@@ -129,23 +292,104 @@ class Compose(DifferentiableMap):
             https://en.wikipedia.org/wiki/Chain_rule (Higher derivatives)
             WARNING: J_f is assumed to be a jacobian np.matrix object
         """
-        x = self._g(q)
-        J_g = self._g.jacobian(q)
-        H_g = self._g.hessian(q)
-        J_f = self._f.jacobian(x)
-        H_f = self._f.hessian(x)
-        a_x = J_g.T * H_f * J_g
-        b_x = J_f * np.ones(self.input_dimension()) * H_g
-        return a_x + b_x
+        return self.evaluate_all(q, order=2)[2]
 
     def evaluate(self, q):
         """
             d/dq f(g(q)), applies chain rule.
         """
-        x = self._g(q)
-        [y, J_f] = self._f.evaluate(x)
-        J = J_f * self._g.jacobian(q)
-        return [y, J]
+        return self.evaluate_all(q, order=1)
+
+    def evaluate_all(self, q, order=2):
+        """ g(q), J_g and H_g are evaluated once and shared between
+            the value and the derivatives of the composition """
+        values_g = self._g.evaluate_all(q, order)
+        values_f = self._f.evaluate_all(values_g[0], order)
+        values = values_f[:1]
+        if order > 0:
+            J_f = values_f[1]
+            J_g = values_g[1]
+            values.append(chain_rule(J_f, J_g))
+        if order > 1:
+            a_x = pullback_hessian(values_f[2], J_g)
+            b_x = np.asarray(J_f).item(0) * values_g[2]
+            values.append(a_x + b_x)
+        return values
+
+    def forward_into(self, q, out):
+        x = self._g.forward_into(
+            q, self._buffer("x", (self._g.output_dimension(),)))
+        return self._f.forward_into(x, out)
+
+    def jacobian_into(self, q, out):
+        """ J_f(g(q)) J_g(q) computed in the buffers of the map """
+        x = self._g.forward_into(
+            q, self._buffer("x", (self._g.output_dimension(),)))
+        J_f = self._f.jacobian_into(x, self._buffer(
+            "J_f", (self.output_dimension(), x.size)))
+        J_g = self._g.jacobian_into(q, self._buffer(
+            "J_g", (x.size, self.input_dimension())))
+        return np.matmul(J_f, J_g, out=out)
+
+    def _pullback_hessian_into(self, q, out):
+        """ Writes J_g' H_f J_g in out and returns g(q) """
+        n = self.input_dimension()
+        x = self._g.forward_into(
+            q, self._buffer("x", (self._g.output_dimension(),)))
+        J_g = self._g.jacobian_into(q, self._buffer("J_g", (x.size, n)))
+        H_f = self._f.hessian_into(x, self._buffer("H_f", (x.size, x.size)))
+        H_f_J_g = np.matmul(
+            H_f, J_g, out=self._buffer("H_f_J_g", (x.size, n)))
+        np.matmul(J_g.T, H_f_J_g, out=out)
+        return x
+
+    def hessian_into(self, q, out):
+        """ J_g' H_f J_g + H_g J_f computed in the buffers of the map """
+        x = self._pullback_hessian_into(q, out)
+        J_f = self._f.jacobian_into(x, self._buffer("J_f", (1, x.size)))
+        H_g = self._g.hessian_into(q, self._buffer("H_g", out.shape))
+        H_g *= J_f[0, 0]
+        out += H_g
+        return out
+
+    def _pullback_hessian_vector_product(self, q, v):
+        """ Returns g(q) and J_g' H_f J_g v """
+        [x, J_g] = self._g.evaluate(q)
+        J_g_v = np.asarray(chain_rule(J_g, np.reshape(v, (-1, 1))))
+        H_f_J_g_v = self._f.hessian_vector_product(
+            x, J_g_v.reshape(np.shape(x)))
+        Hv = chain_rule(np.reshape(H_f_J_g_v, (1, -1)), J_g)
+        return x, np.asarray(Hv).reshape(np.shape(q))
+
+    def hessian_vector_product(self, q, v):
+        """ J_g' H_f J_g v + J_f H_g v, the hessians are not formed """
+        x, Hv = self._pullback_hessian_vector_product(q, v)
+        J_f = np.asarray(self._f.jacobian(x)).item(0)
+        return Hv + J_f * self._g.hessian_vector_product(q, v)
+
+    def forward_record(self, q):
+        """ backward : w -> (w^T J_f) J_g """
+        x, backward_g = self._g.forward_record(q)
+        y, backward_f = self._f.forward_record(x)
+        return y, lambda w: backward_g(backward_f(w))
+
+    def forward_batch(self, Q):
+        return self._f.forward_batch(self._g.forward_batch(Q))
+
+    def jacobian_batch(self, Q):
+        """ Stacks of J_f(g(q)) J_g(q) """
+        X = self._g.forward_batch(Q)
+        return np.matmul(self._f.jacobian_batch(X), self._g.jacobian_batch(Q))
+
+    def hessian_batch(self, Q):
+        """ Stacks of J_g' H_f J_g + H_g J_f """
+        X = self._g.forward_batch(Q)
+        J_g = self._g.jacobian_batch(Q)
+        H_f = self._f.hessian_batch(X)
+        J_f = self._f.jacobian_batch(X)
+        H_g = self._g.hessian_batch(Q)
+        a_x = np.matmul(np.matmul(J_g.transpose(0, 2, 1), H_f), J_g)
+        return a_x + J_f[:, 0, 0, None, None] * H_g
 
 
 class Pullback(Compose):
@@ -169,12 +413,33 @@ class Pullback(Compose):
             this cooresponds to the full hessian when H_g = 0
             WARNING: f still has to be a function for now.
         """
-        x = self._g(q)
-        J_g = self._g.jacobian(q)
-        H_f = self._f.hessian(x)
-        # print("H_f :", H_f.shape)
-        # print("J_g :", J_g.shape)
-        return J_g.T * H_f * J_g
+        return self.evaluate_all(q, order=2)[2]
+
+    def evaluate_all(self, q, order=2):
+        """ Same as the composition without the hessian of g """
+        values_g = self._g.evaluate_all(q, min(order, 1))
+        values_f = self._f.evaluate_all(values_g[0], order)
+        values = values_f[:1]
+        if order > 0:
+            J_g = values_g[1]
+            values.append(chain_rule(values_f[1], J_g))
+        if order > 1:
+            values.append(pullback_hessian(values_f[2], J_g))
+        return values
+
+    def hessian_into(self, q, out):
+        self._pullback_hessian_into(q, out)
+        return out
+
+    def hessian_vector_product(self, q, v):
+        """ J_g' H_f J_g v """
+        return self._pullback_hessian_vector_product(q, v)[1]
+
+    def hessian_batch(self, Q):
+        X = self._g.forward_batch(Q)
+        J_g = self._g.jacobian_batch(Q)
+        H_f = self._f.hessian_batch(X)
+        return np.matmul(np.matmul(J_g.transpose(0, 2, 1), H_f), J_g)
 
 
 class Scale(DifferentiableMap):
@@ -199,6 +464,40 @@ class Scale(DifferentiableMap):
     def hessian(self, q):
         return self._alpha * self._f.hessian(q)
 
+    def evaluate_all(self, q, order=2):
+        return [self._alpha * v for v in self._f.evaluate_all(q, order)]
+
+    def hessian_vector_product(self, q, v):
+        return self._alpha * self._f.hessian_vector_product(q, v)
+
+    def forward_into(self, q, out):
+        self._f.forward_into(q, out)
+        out *= self._alpha
+        return out
+
+    def jacobian_into(self, q, out):
+        self._f.jacobian_into(q, out)
+        out *= self._alpha
+        return out
+
+    def hessian_into(self, q, out):
+        self._f.hessian_into(q, out)
+        out *= self._alpha
+        return out
+
+    def forward_record(self, q):
+        y, backward = self._f.forward_record(q)
+        return self._alpha * y, lambda w: backward(self._alpha * np.asarray(w))
+
+    def forward_batch(self, Q):
+        return self._alpha * self._f.forward_batch(Q)
+
+    def jacobian_batch(self, Q):
+        return self._alpha * self._f.jacobian_batch(Q)
+
+    def hessian_batch(self, Q):
+        return self._alpha * self._f.hessian_batch(Q)
+
 
 class SumOfTerms(DifferentiableMap):
     """ Sums n differentiable maps """
@@ -227,6 +526,111 @@ class SumOfTerms(DifferentiableMap):
     def hessian(self, q):
         return sum(f.hessian(q) for f in self._functions)
 
+    def evaluate_all(self, q, order=2):
+        values = [f.evaluate_all(q, order) for f in self._functions]
+        return [sum(v) for v in zip(*values)]
+
+    def forward_record(self, q):
+        records = [f.forward_record(q) for f in self._functions]
+        y = sum(y_f for y_f, _ in records)
+        return y, lambda w: sum(backward(w) for _, backward in records)
+
+    def hessian_vector_product(self, q, v):
+        return sum(f.hessian_vector_product(q, v) for f in self._functions)
+
+    def _sum_into(self, method, q, out):
+        """ Sums the terms in out, the terms are written in a buffer """
+        buffer = self._buffer(method, out.shape)
+        getattr(self._functions[0], method)(q, out)
+        for f in self._functions[1:]:
+            out += getattr(f, method)(q, buffer)
+        return out
+
+    def forward_into(self, q, out):
+        return self._sum_into("forward_into", q, out)
+
+    def jacobian_into(self, q, out):
+        return self._sum_into("jacobian_into", q, out)
+
+    def hessian_into(self, q, out):
+        return self._sum_into("hessian_into", q, out)
+
+    def forward_batch(self, Q):
+        return sum(f.forward_batch(Q) for f in self._functions)
+
+    def jacobian_batch(self, Q):
+        return sum(f.jacobian_batch(Q) for f in self._functions)
+
+    def hessian_batch(self, Q):
+        return sum(f.hessian_batch(Q) for f in self._functions)
+
+
+class CachedMap(DifferentiableMap):
+    """
+    Caches the evaluations of a map f, which is evaluated once per input
+    with its derivatives up to order (see evaluate_all). The value,
+    jacobian and hessian requested separately at the same input, e.g.,
+    by the callbacks of scipy.optimize, then cost a single traversal of
+    f. The max_size last inputs are kept (least recently used). The
+    cached values are shared and should not be modified.
+
+    The other attributes (e.g., hessian_banded) are the ones of f.
+    """
+
+    def __init__(self, f, order=1, max_size=4):
+        self._f = f
+        self._order = order
+        self._max_size = max_size
+        self._cache = OrderedDict()
+
+    def output_dimension(self):
+        return self._f.output_dimension()
+
+    def input_dimension(self):
+        return self._f.input_dimension()
+
+    def clear(self):
+        self._cache.clear()
+
+    def evaluations(self, q, order):
+        """ Returns the cached evaluations [f, J, H] of q up to order at
+            least, f is evaluated if the input is not cached """
+        key = np.asarray(q, dtype=float).tobytes()
+        values = self._cache.get(key)
+        if values is None or len(values) <= order:
+            values = self._f.evaluate_all(q, max(order, self._order))
+            self._cache[key] = values
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return values
+
+    def forward(self, q):
+        return self.evaluations(q, 0)[0]
+
+    def jacobian(self, q):
+        return self.evaluations(q, 1)[1]
+
+    def hessian(self, q):
+        return self.evaluations(q, 2)[2]
+
+    def evaluate_all(self, q, order=2):
+        return self.evaluations(q, order)[:order + 1]
+
+    def hessian_vector_product(self, q, v):
+        """ Uses the cached hessian of q if any """
+        values = self._cache.get(np.asarray(q, dtype=float).tobytes())
+        if values is None or len(values) < 3:
+            return self._f.hessian_vector_product(q, v)
+        Hv = np.dot(np.asarray(values[2]), np.asarray(v).flatten())
+        return Hv.reshape(np.shape(q))
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._f, name)
+
 
 class RangeSubspaceMap(DifferentiableMap):
     """ Takes only some outputs """
@@ -235,6 +639,7 @@ class RangeSubspaceMap(DifferentiableMap):
         """n is the input dimension, indices are the output"""
         self._dim = n
         self._indices = indices
+        self._jacobian = SelectionJacobian(n, indices)
 
     def output_dimension(self):
         return len(self._indices)
@@ -246,12 +651,112 @@ class RangeSubspaceMap(DifferentiableMap):
         return q[self._indices]
 
     def jacobian(self, q):
-        return np.matrix(np.eye(self._dim))[self._indices, :]
+        """ selection matrix, which is multiplied by index slicing """
+        return self._jacobian
 
     def hessian(self, q):
         assert self.output_dimension() == 1
         return np.matrix(np.zeros((self._dim, self._dim)))
 
+    def forward_record(self, q):
+        def backward(w):
+            g = np.zeros(self._dim)
+            g[self._indices] = np.asarray(w).reshape(len(self._indices))
+            return g
+        return self.forward(q), backward
+
+    def forward_into(self, q, out):
+        return np.take(q, self._indices, out=out)
+
+    def jacobian_into(self, q, out):
+        out[...] = 0.
+        out[np.arange(len(self._indices)), self._indices] = 1.
+        return out
+
+    def forward_batch(self, Q):
+        return np.asarray(Q)[:, self._indices]
+
+    def jacobian_batch(self, Q):
+        J = np.eye(self._dim)[self._indices, :]
+        return np.tile(J, (np.asarray(Q).shape[0], 1, 1))
+
+    def hessian_batch(self, Q):
+        assert self.output_dimension() == 1
+        return np.zeros((np.asarray(Q).shape[0], self._dim, self._dim))
+
+
+class SubspacePullback(DifferentiableMap):
+    """ f pulled back by a RangeSubspaceMap : f(q[indices])
+
+        The derivatives are scattered in the columns (and rows) of the
+        indices instead of being multiplied by the selection matrix. """
+
+    def __init__(self, f, n, indices):
+        """n is the input dimension, indices are the input of f"""
+        assert f.input_dimension() == len(indices)
+        self._f = f
+        self._dim = n
+        self._indices = list(indices)
+
+    def output_dimension(self):
+        return self._f.output_dimension()
+
+    def input_dimension(self):
+        return self._dim
+
+    def forward(self, q):
+        return self._f(q[self._indices])
+
+    def jacobian(self, q):
+        return self.evaluate_all(q, order=1)[1]
+
+    def hessian(self, q):
+        return self.evaluate_all(q, order=2)[2]
+
+    def evaluate_all(self, q, order=2):
+        values_f = self._f.evaluate_all(q[self._indices], order)
+        values = values_f[:1]
+        if order > 0:
+            J = np.matrix(np.zeros((self.output_dimension(), self._dim)))
+            J[:, self._indices] = values_f[1]
+            values.append(J)
+        if order > 1:
+            H = np.matrix(np.zeros((self._dim, self._dim)))
+            H[np.ix_(self._indices, self._indices)] = values_f[2]
+            values.append(H)
+        return values
+
+    def forward_record(self, q):
+        y, backward_f = self._f.forward_record(q[self._indices])
+
+        def backward(w):
+            g = np.zeros(self._dim)
+            g[self._indices] = backward_f(w)
+            return g
+        return y, backward
+
+    def hessian_vector_product(self, q, v):
+        Hv = np.zeros(self._dim)
+        Hv[self._indices] = self._f.hessian_vector_product(
+            q[self._indices], np.asarray(v).flatten()[self._indices])
+        return Hv.reshape(np.shape(q))
+
+    def forward_batch(self, Q):
+        return self._f.forward_batch(np.asarray(Q)[:, self._indices])
+
+    def jacobian_batch(self, Q):
+        Q = np.asarray(Q)
+        J = np.zeros((Q.shape[0], self.output_dimension(), self._dim))
+        J[:, :, self._indices] = self._f.jacobian_batch(Q[:, self._indices])
+        return J
+
+    def hessian_batch(self, Q):
+        Q = np.asarray(Q)
+        H = np.zeros((Q.shape[0], self._dim, self._dim))
+        idx = np.ix_(range(Q.shape[0]), self._indices, self._indices)
+        H[idx] = self._f.hessian_batch(Q[:, self._indices])
+        return H
+
 
 class CombinedOutputMap(DifferentiableMap):
     """ creates a combination of the maps
@@ -279,14 +784,37 @@ class CombinedOutputMap(DifferentiableMap):
         return phi
 
     def jacobian(self, q):
+        """ When all the jacobians are structured they are stacked in
+            a sparse jacobian """
+        jacobians = [m.jacobian(q) for m in self._maps]
+        if all(isinstance(J, StructuredJacobian) for J in jacobians):
+            return SparseJacobian(
+                sparse.vstack([J.tosparse() for J in jacobians]))
         idx = 0
         J_phi = np.zeros((self._output_dim, self.input_dimension()))
-        for m in self._maps:
-            J = m.jacobian(q)
+        for m, J in zip(self._maps, jacobians):
             J_phi[idx:m.output_dimension() + idx, 0:m.input_dimension()] = J
             idx += m.output_dimension()
         return J_phi
 
+    def forward_record(self, q):
+        records = [m.forward_record(q) for m in self._maps]
+        phi = np.hstack([np.asarray(y).reshape(m.output_dimension())
+                         for m, (y, _) in zip(self._maps, records)])
+        splits = np.cumsum([m.output_dimension() for m in self._maps])[:-1]
+
+        def backward(w):
+            w_maps = np.split(np.asarray(w).reshape(self._output_dim), splits)
+            return sum(b(w_m) for (_, b), w_m in zip(records, w_maps))
+        return phi, backward
+
+    def forward_batch(self, Q):
+        return np.concatenate([m.forward_batch(Q) for m in self._maps], axis=1)
+
+    def jacobian_batch(self, Q):
+        return np.concatenate(
+            [m.jacobian_batch(Q) for m in self._maps], axis=1)
+
 
 class ProductFunction(DifferentiableMap):
     """Take the product of functions"""
@@ -315,24 +843,54 @@ class ProductFunction(DifferentiableMap):
         return v1 * v2
 
     def jacobian(self, x):
-        v1 = self._g.forward(x)
-        v2 = self._h.forward(x)
-        J1 = self._g.jacobian(x)
-        J2 = self._h.jacobian(x)
-        return v1 * J2 + v2 * J1
+        return self.evaluate_all(x, order=1)[1]
+
+    def forward_record(self, x):
+        """ backward : w -> w (v2 J1 + v1 J2) """
+        v1, backward_g = self._g.forward_record(x)
+        v2, backward_h = self._h.forward_record(x)
+        return v1 * v2, lambda w: (backward_g(np.asarray(w) * v2) +
+                                   backward_h(np.asarray(w) * v1))
 
     def hessian(self, x):
         assert self.output_dimension() == 1
-        v1 = self._g.forward(x)
-        v2 = self._h.forward(x)
-
-        H1 = self._g.hessian(x)
-        H2 = self._h.hessian(x)
-
-        g1 = self._g.gradient(x)
-        g2 = self._h.gradient(x)
+        return self.evaluate_all(x, order=2)[2]
+
+    def evaluate_all(self, x, order=2):
+        """ Each factor is evaluated once with its derivatives """
+        values_g = self._g.evaluate_all(x, order)
+        values_h = self._h.evaluate_all(x, order)
+        v1, v2 = values_g[0], values_h[0]
+        values = [v1 * v2]
+        if order > 0:
+            J1, J2 = values_g[1], values_h[1]
+            values.append(v1 * J2 + v2 * J1)
+        if order > 1:
+            g1 = np.asarray(J1).reshape(self.input_dimension())
+            g2 = np.asarray(J2).reshape(self.input_dimension())
+            values.append(v1 * values_h[2] + v2 * values_g[2] +
+                          np.outer(g1, g2) + np.outer(g2, g1))
+        return values
+
+    def forward_batch(self, X):
+        return self._g.forward_batch(X) * self._h.forward_batch(X)
+
+    def jacobian_batch(self, X):
+        v1 = self._g.forward_batch(X)[:, :, None]
+        v2 = self._h.forward_batch(X)[:, :, None]
+        J1 = self._g.jacobian_batch(X)
+        J2 = self._h.jacobian_batch(X)
+        return v1 * J2 + v2 * J1
 
-        return v1 * H2 + v2 * H1 + np.outer(g1, g2) + np.outer(g2, g1)
+    def hessian_batch(self, X):
+        v1 = self._g.forward_batch(X)[:, :, None]
+        v2 = self._h.forward_batch(X)[:, :, None]
+        H1 = self._g.hessian_batch(X)
+        H2 = self._h.hessian_batch(X)
+        g1 = self._g.jacobian_batch(X)
+        g2 = self._h.jacobian_batch(X)
+        g1_g2 = np.matmul(g1.transpose(0, 2, 1), g2)
+        return v1 * H2 + v2 * H1 + g1_g2 + g1_g2.transpose(0, 2, 1)
 
 
 class AffineMap(DifferentiableMap):
@@ -364,6 +922,41 @@ class AffineMap(DifferentiableMap):
         return np.matrix(np.zeros((
             self.input_dimension(), self.input_dimension())))
 
+    def evaluate_all(self, x, order=2):
+        values = [self.forward(x), self._a]
+        if order > 1:
+            values.append(self.hessian(x))
+        return values[:order + 1]
+
+    def forward_into(self, x, out):
+        np.matmul(np.asarray(self._a), np.reshape(x, x.size), out=out)
+        out += np.asarray(self._b).reshape(self._b.size)
+        return out
+
+    def jacobian_into(self, x, out):
+        np.copyto(out, self._a)
+        return out
+
+    def hessian_into(self, x, out):
+        out[...] = 0.
+        return out
+
+    def forward_record(self, x):
+        a = np.asarray(self._a)
+        return self.forward(x), lambda w: np.dot(
+            np.asarray(w).reshape(a.shape[0]), a)
+
+    def forward_batch(self, X):
+        return np.asarray(np.asarray(X) * self._a.T + self._b.T)
+
+    def jacobian_batch(self, X):
+        return np.tile(np.asarray(self._a), (np.asarray(X).shape[0], 1, 1))
+
+    def hessian_batch(self, X):
+        assert self.output_dimension() == 1
+        n = self.input_dimension()
+        return np.zeros((np.asarray(X).shape[0], n, n))
+
 
 class QuadricFunction(DifferentiableMap):
     """ Here we implement a quadric funciton of the form:
@@ -386,9 +979,8 @@ class QuadricFunction(DifferentiableMap):
 
     def forward(self, x):
         x_tmp = np.matrix(x.reshape(self._b.size, 1))
-        v = np.asscalar(
-            .5 * x_tmp.T * self._a * x_tmp + self._b.T * x_tmp + self._c)
-        return v
+        v = .5 * x_tmp.T * self._a * x_tmp + self._b.T * x_tmp + self._c
+        return v.item()
 
     def jacobian(self, x):
         x_tmp = np.matrix(x.reshape(self._b.size, 1))
@@ -402,6 +994,44 @@ class QuadricFunction(DifferentiableMap):
         else:
             return 0.5 * (self._a + self._a.T)
 
+    def evaluate_all(self, x, order=2):
+        x_tmp = np.matrix(x.reshape(self._b.size, 1))
+        H = self.hessian(x)
+        v = .5 * x_tmp.T * self._a * x_tmp + self._b.T * x_tmp + self._c
+        values = [v.item()]
+        if order > 0:
+            values.append((H * x_tmp + self._b).T)
+        if order > 1:
+            values.append(H)
+        return values
+
+    def jacobian_into(self, x, out):
+        H = np.asarray(self.hessian(x))
+        np.matmul(np.reshape(x, (1, self._b.size)), H.T, out=out)
+        out += np.asarray(self._b).T
+        return out
+
+    def hessian_into(self, x, out):
+        np.copyto(out, self.hessian(x))
+        return out
+
+    def forward_batch(self, X):
+        X = np.asarray(X)
+        A = np.asarray(self._a)
+        b = np.asarray(self._b).reshape(self._b.size)
+        v = .5 * np.einsum('ni,ij,nj->n', X, A, X) + np.dot(X, b) + self._c
+        return v.reshape(X.shape[0], 1)
+
+    def jacobian_batch(self, X):
+        X = np.asarray(X)
+        H = np.asarray(self.hessian(None))
+        J = np.dot(X, H.T) + np.asarray(self._b).reshape(self._b.size)
+        return J.reshape(X.shape[0], 1, self._b.size)
+
+    def hessian_batch(self, X):
+        H = np.asarray(self.hessian(None))
+        return np.tile(H, (np.asarray(X).shape[0], 1, 1))
+
 
 class ExpTestFunction(DifferentiableMap):
     """ Test function that can be evaluated on a grid """
@@ -415,6 +1045,10 @@ class ExpTestFunction(DifferentiableMap):
     def forward(self, p):
         return np.exp(-(2 * p[0])**2 - (p[1] / 2)**2)
 
+    def forward_batch(self, P):
+        P = np.asarray(P)
+        return self.forward(P.T).reshape(P.shape[0], 1)
+
 
 class IdentityMap(DifferentiableMap):
     """Simple identity map : f(x)=x"""
@@ -432,12 +1066,34 @@ class IdentityMap(DifferentiableMap):
         return q
 
     def jacobian(self, q):
-        return np.matrix(np.eye(self._dim))
+        return IdentityJacobian(self._dim)
+
+    def forward_record(self, q):
+        return q, lambda w: np.asarray(w).reshape(self._dim)
+
+    def forward_into(self, q, out):
+        np.copyto(out, q)
+        return out
+
+    def jacobian_into(self, q, out):
+        out[...] = 0.
+        np.fill_diagonal(out, 1.)
+        return out
 
     def hessian(self, x):
         assert self.output_dimension() == 1
         return np.matrix(np.zeros((self._dim, self._dim)))
 
+    def forward_batch(self, Q):
+        return np.array(Q, dtype=float)
+
+    def jacobian_batch(self, Q):
+        return np.tile(np.eye(self._dim), (np.asarray(Q).shape[0], 1, 1))
+
+    def hessian_batch(self, Q):
+        assert self.output_dimension() == 1
+        return np.zeros((np.asarray(Q).shape[0], self._dim, self._dim))
+
 
 class ZeroMap(DifferentiableMap):
     """Simple zero map : f(x)=0"""
@@ -455,13 +1111,38 @@ class ZeroMap(DifferentiableMap):
     def forward(self, q):
         return np.zeros(self._m)
 
+    def forward_record(self, q):
+        return self.forward(q), lambda w: np.zeros(self._n)
+
+    def forward_into(self, q, out):
+        out[...] = 0.
+        return out
+
+    def jacobian_into(self, q, out):
+        out[...] = 0.
+        return out
+
+    def hessian_into(self, q, out):
+        out[...] = 0.
+        return out
+
     def jacobian(self, q):
-        return np.matrix(np.zeros((self._m, self._n)))
+        return ZeroJacobian(self._m, self._n)
 
     def hessian(self, x):
         assert self.output_dimension() == 1
         return np.matrix(np.zeros((self._n, self._n)))
 
+    def forward_batch(self, Q):
+        return np.zeros((np.asarray(Q).shape[0], self._m))
+
+    def jacobian_batch(self, Q):
+        return np.zeros((np.asarray(Q).shape[0], self._m, self._n))
+
+    def hessian_batch(self, Q):
+        assert self.output_dimension() == 1
+        return np.zeros((np.asarray(Q).shape[0], self._n, self._n))
+
 
 class SquaredNorm(DifferentiableMap):
     """ Simple squared norm : f(x)= | x - x_0 | ^2 """
@@ -487,6 +1168,38 @@ class SquaredNorm(DifferentiableMap):
         assert self.output_dimension() == 1
         return np.matrix(np.eye(self.x_0.size, self.x_0.size))
 
+    def evaluate_all(self, x, order=2):
+        delta_x = np.array(x).reshape(x.size) - self.x_0
+        values = [0.5 * np.dot(delta_x, delta_x), np.matrix(delta_x)]
+        if order > 1:
+            values.append(self.hessian(x))
+        return values[:order + 1]
+
+    def jacobian_into(self, x, out):
+        np.subtract(np.reshape(x, (1, x.size)), self.x_0, out=out)
+        return out
+
+    def hessian_into(self, x, out):
+        out[...] = 0.
+        np.fill_diagonal(out, 1.)
+        return out
+
+    def forward_record(self, x):
+        delta_x = np.array(x).reshape(x.size) - self.x_0
+        return (0.5 * np.dot(delta_x, delta_x),
+                lambda w: np.asarray(w).reshape(1)[0] * delta_x)
+
+    def forward_batch(self, X):
+        delta_x = np.asarray(X) - self.x_0
+        return .5 * np.sum(delta_x ** 2, axis=1).reshape(delta_x.shape[0], 1)
+
+    def jacobian_batch(self, X):
+        delta_x = np.asarray(X) - self.x_0
+        return delta_x.reshape(delta_x.shape[0], 1, self.x_0.size)
+
+    def hessian_batch(self, X):
+        return np.tile(np.eye(self.x_0.size), (np.asarray(X).shape[0], 1, 1))
+
 
 class Norm(DifferentiableMap):
     """
@@ -518,6 +1231,32 @@ class Norm(DifferentiableMap):
         d_inv = 1. / np.linalg.norm(x_d)
         return d_inv * np.eye(x.size) - d_inv**3 * np.outer(x_d, x_d)
 
+    def evaluate_all(self, x, order=2):
+        """ the norm is computed once """
+        x_d = self._xd(x)
+        d = np.linalg.norm(x_d)
+        values = [d, np.matrix(x_d / d)]
+        if order > 1:
+            d_inv = 1. / d
+            values.append(np.matrix(
+                d_inv * np.eye(x.size) - d_inv**3 * np.outer(x_d, x_d)))
+        return values[:order + 1]
+
+    def forward_batch(self, X):
+        X_d = self._xd(np.asarray(X))
+        return np.linalg.norm(X_d, axis=1).reshape(X_d.shape[0], 1)
+
+    def jacobian_batch(self, X):
+        X_d = self._xd(np.asarray(X))
+        X_d = X_d / np.linalg.norm(X_d, axis=1)[:, None]
+        return X_d.reshape(X_d.shape[0], 1, self._n)
+
+    def hessian_batch(self, X):
+        X_d = self._xd(np.asarray(X))
+        d_inv = 1. / np.linalg.norm(X_d, axis=1)[:, None, None]
+        xx_t = X_d[:, :, None] * X_d[:, None, :]
+        return d_inv * np.eye(self._n) - d_inv ** 3 * xx_t
+
 
 class Normalize(DifferentiableMap):
     """
@@ -541,11 +1280,24 @@ class Normalize(DifferentiableMap):
         s = np.full((self._n, ), dinv)
         return np.diag(s) - np.outer(x, x) * (dinv ** 3)
 
+    def forward_batch(self, X):
+        X = np.asarray(X)
+        return X / np.linalg.norm(X, axis=1)[:, None]
+
+    def jacobian_batch(self, X):
+        X = np.asarray(X)
+        dinv = 1. / np.linalg.norm(X, axis=1)[:, None, None]
+        xx_t = X[:, :, None] * X[:, None, :]
+        return dinv * np.eye(self._n) - xx_t * (dinv ** 3)
+
 
 class SoftMax(DifferentiableMap):
     """ Softmax
 
             f(x) = exp(x_i) / sum_j exp(x_j)
+
+        The exponentials are shifted by their max, which does not change
+        the result, so that they neither overflow nor all underflow.
     """
 
     def __init__(self, n, gamma):
@@ -558,14 +1310,37 @@ class SoftMax(DifferentiableMap):
     def input_dimension(self):
         return self._n
 
+    def _exponentials(self, x, axis=None):
+        """ Returns exp(gamma * x - m) and the shift m, which is kept
+            constant when x is a Jet (forward mode) """
+        m = np.max(self._gamma * np.asarray(getattr(x, "value", x)),
+                   axis=axis, keepdims=True)
+        return np.exp(self._gamma * x - m), m
+
     def forward(self, x):
-        z = np.exp(self._gamma * x)
+        z = self._exponentials(x)[0]
         return z / np.sum(z)
 
     def jacobian(self, q):
         s = self.forward(q)
         return self._gamma * (np.diag(s) - np.outer(s, s))
 
+    def evaluate_all(self, x, order=2):
+        s = self.forward(x)
+        values = [s, np.matrix(self._gamma * (np.diag(s) - np.outer(s, s)))]
+        if order > 1:
+            values.append(self.hessian(x))
+        return values[:order + 1]
+
+    def forward_batch(self, X):
+        Z = self._exponentials(np.asarray(X), axis=1)[0]
+        return Z / np.sum(Z, axis=1)[:, None]
+
+    def jacobian_batch(self, X):
+        S = SoftMax.forward_batch(self, X)
+        S_diag = S[:, :, None] * np.eye(self._n)
+        return self._gamma * (S_diag - S[:, :, None] * S[:, None, :])
+
 
 class LogSumExp(SoftMax):
     """ Log of softmax (smooth max)
@@ -574,6 +1349,10 @@ class LogSumExp(SoftMax):
 
         A normalized version can be defined when all the monoids
         are positive f(x) =  log( sum(z) - (1-n))
+
+        With a negative gamma it is a smooth min. The sum is computed
+        with the exponentials shifted by their max (see SoftMax), so the
+        function can be evaluated for large |gamma * x|.
     """
 
     def __init__(self, n, gamma):
@@ -583,17 +1362,39 @@ class LogSumExp(SoftMax):
         return 1
 
     def forward(self, x):
-        z = np.exp(self._gamma * x)
-        return (1. / self._gamma) * np.log(np.sum(z))
+        z, m = self._exponentials(x)
+        return (1. / self._gamma) * (np.log(np.sum(z)) + m.item())
 
     def jacobian(self, x):
         return SoftMax.forward(self, x)
 
     def hessian(self, x):
-        z = np.exp(self._gamma * x)
-        p_inv = 1 / np.sum(z)
-        M = p_inv * np.diag(z) - (p_inv ** 2) * np.outer(z, z)
-        return self._gamma * M
+        s = SoftMax.forward(self, x)
+        return self._gamma * (np.diag(s) - np.outer(s, s))
+
+    def evaluate_all(self, x, order=2):
+        """ the exponentials and partition function are computed once """
+        z, m = self._exponentials(x)
+        partition = np.sum(z)
+        s = z / partition
+        values = [(1. / self._gamma) * (np.log(partition) + m.item()),
+                  np.matrix(s)]
+        if order > 1:
+            values.append(self._gamma * (np.diag(s) - np.outer(s, s)))
+        return values[:order + 1]
+
+    def forward_batch(self, X):
+        Z, m = self._exponentials(np.asarray(X), axis=1)
+        return (1. / self._gamma) * (np.log(np.sum(Z, axis=1))[:, None] + m)
+
+    def jacobian_batch(self, X):
+        S = SoftMax.forward_batch(self, X)
+        return S.reshape(S.shape[0], 1, self._n)
+
+    def hessian_batch(self, X):
+        S = SoftMax.forward_batch(self, X)
+        S_diag = S[:, :, None] * np.eye(self._n)
+        return self._gamma * (S_diag - S[:, :, None] * S[:, None, :])
 
 
 class Sigmoid(DifferentiableMap):
@@ -634,6 +1435,30 @@ class Sigmoid(DifferentiableMap):
         H[0, 0] = s * (1 - s) * (1 - 2 * s)
         return H
 
+    def evaluate_all(self, x, order=2):
+        """ the derivatives are polynomials of the sigmoid value """
+        s = self.forward(x)
+        ds = s * (1 - s)
+        values = [s, np.matrix(np.diag(ds))]
+        if order > 1:
+            assert self.output_dimension() == 1
+            values.append(np.matrix(ds * (1 - 2 * s)))
+        return values[:order + 1]
+
+    def forward_batch(self, X):
+        X = np.asarray(X)
+        expx = np.exp(-np.absolute(X))
+        return np.where(X > 0, 1. / (1. + expx), expx / (1. + expx))
+
+    def jacobian_batch(self, X):
+        S = Sigmoid.forward_batch(self, X)
+        return (S * (1 - S))[:, :, None] * np.eye(self._n)
+
+    def hessian_batch(self, X):
+        assert self.output_dimension() == 1
+        S = Sigmoid.forward_batch(self, X)
+        return (S * (1 - S) * (1 - 2 * S))[:, :, None]
+
 
 class Tanh(DifferentiableMap):
     """
@@ -650,11 +1475,8 @@ class Tanh(DifferentiableMap):
         return self._n
 
     def forward(self, x):
-        y = np.zeros(self._n)
-        for i in range(self._n):
-            exp2x = np.exp(-2. * x[i])
-            y[i] = (1. - exp2x) / (1. + exp2x)
-        return y
+        exp2x = np.exp(-2. * x)
+        return (1. - exp2x) / (1. + exp2x)
 
     def jacobian(self, x):
         J = np.matrix(np.zeros((self._n, self._n)))
@@ -663,9 +1485,23 @@ class Tanh(DifferentiableMap):
             J[i, i] = 1 - tanh[i] ** 2
         return J
 
-    def hessian(self, x):
-        """ TODO """
-        assert self.output_dimension() == 1
+    def evaluate_all(self, x, order=2):
+        """ the derivatives are polynomials of the tanh value """
+        tanh = self.forward(x)
+        d_tanh = 1 - tanh ** 2
+        values = [tanh, np.matrix(np.diag(d_tanh))]
+        if order > 1:
+            assert self.output_dimension() == 1
+            values.append(np.matrix(-2. * tanh * d_tanh))
+        return values[:order + 1]
+
+    def forward_batch(self, X):
+        exp2x = np.exp(-2. * np.asarray(X))
+        return (1. - exp2x) / (1. + exp2x)
+
+    def jacobian_batch(self, X):
+        tanh = Tanh.forward_batch(self, X)
+        return (1 - tanh ** 2)[:, :, None] * np.eye(self._n)
 
 
 class Arccos(DifferentiableMap):
@@ -695,6 +1531,17 @@ class Arccos(DifferentiableMap):
         H[0, 0] = -x / np.power(1 - x ** 2, 1.5)
         return H
 
+    def forward_batch(self, X):
+        return np.arccos(np.asarray(X, dtype=float).reshape(-1, 1))
+
+    def jacobian_batch(self, X):
+        X = np.asarray(X, dtype=float).reshape(-1, 1, 1)
+        return -1 / np.sqrt(1 - X ** 2)
+
+    def hessian_batch(self, X):
+        X = np.asarray(X, dtype=float).reshape(-1, 1, 1)
+        return -X / np.power(1 - X ** 2, 1.5)
+
 
 class RadialBasisFunction(DifferentiableMap):
     """
@@ -727,6 +1574,11 @@ class RadialBasisFunction(DifferentiableMap):
         d = x - self._x0
         return np.exp(-.5 * np.dot(np.dot(d.T, self._H), d))
 
+    def forward_batch(self, X):
+        D = np.asarray(X) - self._x0
+        v = np.exp(-.5 * np.einsum('ni,ij,nj->n', D, self._H, D))
+        return v.reshape(D.shape[0], 1)
+
     def input_dimension(self):
         return 2
 
@@ -773,6 +1625,88 @@ def finite_difference_hessian(f, q):
     return np.matrix(H)
 
 
+def finite_difference_points(q, dt=1e-4, scheme="central"):
+    """ Returns all the perturbed points stacked in an array and the
+        associated step, so that they can be evaluated in a single batch.
+
+            central  : [q + dt/2 e_j ; q - dt/2 e_j]     (2n x n)
+            forward  : [q ; q + dt e_j]                   (n + 1 x n)
+            backward : [q ; q - dt e_j]                   (n + 1 x n)
+            complex  : [q + i dt e_j]                     (n x n) complex
+        """
+    q = np.asarray(q).reshape(q.size)
+    n = q.size
+    if scheme == "central":
+        delta = np.diag(np.full(n, dt / 2.))
+        return np.vstack([q + delta, q - delta])
+    if scheme == "forward":
+        return np.vstack([q, q + np.diag(np.full(n, dt))])
+    if scheme == "backward":
+        return np.vstack([q, q - np.diag(np.full(n, dt))])
+    if scheme == "complex":
+        return q + 1j * np.diag(np.full(n, dt))
+    raise ValueError("scheme ({}) not suported".format(scheme))
+
+
+def _finite_difference_quotient(Y, n, dt, scheme):
+    """ Y : the outputs on all perturbed points (one row per point)
+        returns the matrix of the derivatives, one column per input. """
+    if scheme == "central":
+        return (Y[:n] - Y[n:]).T / dt
+    if scheme == "forward":
+        return (Y[1:] - Y[0]).T / dt
+    if scheme == "backward":
+        return (Y[0] - Y[1:]).T / dt
+    if scheme == "complex":
+        return Y.imag.T / dt
+    raise ValueError("scheme ({}) not suported".format(scheme))
+
+
+def vectorized_finite_difference_jacobian(f, q, dt=1e-4, scheme="central"):
+    """ Finite difference jacobian where all perturbed points are
+        evaluated in a single call to forward_batch.
+
+        The complex scheme (complex step differentiation) is exact up to
+        machine precision for maps whose forward accepts complex input
+        and is analytic (i.e., no abs, norm or comparisons), a very small
+        step can then be used (e.g., dt=1e-20). Complex points are
+        evaluated one by one since forward_batch outputs real arrays.
+
+        WARNING the object returned by this function is a numpy matrix."""
+    assert q.size == f.input_dimension()
+    m = f.output_dimension()
+    n = f.input_dimension()
+    Q = finite_difference_points(q, dt, scheme)
+    if scheme == "complex":
+        Y = np.array([np.asarray(f.forward(q_j)).reshape(m) for q_j in Q])
+    else:
+        Y = f.forward_batch(Q)
+    return np.matrix(_finite_difference_quotient(Y.reshape(-1, m), n, dt,
+                                                 scheme))
+
+
+def vectorized_finite_difference_hessian(f, q, dt=1e-4, scheme="central"):
+    """ Finite difference hessian where the gradients at all perturbed
+        points are evaluated in a single call to jacobian_batch.
+
+        WARNING the object returned by this function is a numpy matrix."""
+    assert q.size == f.input_dimension()
+    assert f.output_dimension() == 1
+    n = f.input_dimension()
+    Q = finite_difference_points(q, dt, scheme)
+    if scheme == "complex":
+        G = np.array([np.asarray(f.jacobian(q_j)).reshape(n) for q_j in Q])
+    else:
+        G = f.jacobian_batch(Q).reshape(-1, n)
+    return np.matrix(_finite_difference_quotient(G, n, dt, scheme))
+
+
+def complex_step_jacobian(f, q, dt=1e-20):
+    """ Complex step differentiation, see
+        vectorized_finite_difference_jacobian. """
+    return vectorized_finite_difference_jacobian(f, q, dt, "complex")
+
+
 def check_is_close(a, b, tolerance=1e-10):
     """ Returns True of all variable are close."""
     results=np.isclose(
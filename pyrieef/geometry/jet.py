@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2018, University of Stuttgart
+# All rights reserved.
+#
+# Permission to use, copy, modify, and distribute this software for any purpose
+# with or without   fee is hereby granted, provided   that the above  copyright
+# notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS  SOFTWARE INCLUDING ALL  IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR  BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR  ANY DAMAGES WHATSOEVER RESULTING  FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION,   ARISING OUT OF OR IN    CONNECTION WITH THE USE   OR
+# PERFORMANCE OF THIS SOFTWARE.
+#
+#                                        Jim Mainprice on Sunday June 13 2018
+
+import numpy as np
+
+# Forward mode automatic differentiation.
+#
+# A Jet is an array that carries, for each of its entries, the value and
+# the first (and optionally second) order derivatives with respect to k
+# seed directions. Jets implement the numpy protocols (__array_ufunc__ and
+# __array_function__) so that the forward functions of the
+# DifferentiableMap, which are written with numpy, can be evaluated on jets
+# without modifications. Seeding the k = n canonical directions gives the
+# exact jacobian and hessian in a single evaluation of the forward.
+#
+# Forward functions that do not support jets raise one of the errors of
+# JET_ERRORS, the caller can then fall back to finite differences:
+#   - converting jets to plain arrays (e.g., np.array([x, y]) or float(x))
+#     raises a TypeError,
+#   - assigning a jet into a preallocated array raises a ValueError (numpy
+#     treats the jet as a sequence),
+#   - array methods that jets do not implement (e.g., x.min()) raise an
+#     AttributeError,
+#   - unsupported options raise a NotImplementedError.
+
+JET_ERRORS = (TypeError, ValueError, AttributeError, NotImplementedError)
+
+_HANDLED_FUNCTIONS = {}
+
+
+def _implements(numpy_function):
+    """ Registers an __array_function__ implementation for Jets. """
+    def decorator(func):
+        _HANDLED_FUNCTIONS[numpy_function] = func
+        return func
+    return decorator
+
+
+def _outer(a, b):
+    """ Outer product on the last axis (the seed directions) """
+    return a[..., :, None] * b[..., None, :]
+
+
+class Jet:
+    """
+    Second order truncated Taylor expansion of an array
+
+        value     : array of shape S
+        jacobian  : array of shape S x k
+        hessian   : array of shape S x k x k (None for first order jets)
+    """
+
+    def __init__(self, value, jacobian, hessian=None):
+        self.value = np.asarray(value)
+        self.jacobian = np.asarray(jacobian)
+        self.hessian = None if hessian is None else np.asarray(hessian)
+
+    @staticmethod
+    def variable(q, order=1):
+        """ Seeds the canonical directions of the input vector q """
+        q = np.asarray(q)
+        q = q.astype(np.result_type(q, float))
+        n = q.size
+        J = np.eye(n).reshape(q.shape + (n,))
+        H = None if order < 2 else np.zeros(q.shape + (n, n))
+        return Jet(q, J, H)
+
+    def nb_directions(self):
+        return self.jacobian.shape[-1]
+
+    def constant(self, x):
+        """ Lifts x to a jet with the same directions and order """
+        if isinstance(x, Jet):
+            return x
+        v = np.asarray(x)
+        k = self.nb_directions()
+        H = None if self.hessian is None else np.zeros(v.shape + (k, k))
+        return Jet(v, np.zeros(v.shape + (k,)), H)
+
+    @property
+    def shape(self):
+        return self.value.shape
+
+    @property
+    def ndim(self):
+        return self.value.ndim
+
+    @property
+    def size(self):
+        return self.value.size
+
+    @property
+    def dtype(self):
+        return self.value.dtype
+
+    @property
+    def T(self):
+        return self.transpose()
+
+    def __repr__(self):
+        return "Jet(value={}, order={})".format(
+            self.value, 1 if self.hessian is None else 2)
+
+    def __array__(self, dtype=None):
+        raise TypeError("Jet can not be converted to a numpy array")
+
+    def __len__(self):
+        return len(self.value)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        H = None
+        if self.hessian is not None:
+            H = self.hessian[key + (slice(None), slice(None))]
+        return Jet(self.value[key], self.jacobian[key + (slice(None),)], H)
+
+    def copy(self):
+        return Jet(self.value.copy(), self.jacobian.copy(),
+                   None if self.hessian is None else self.hessian.copy())
+
+    def reshape(self, *shape):
+        if len(shape) == 1 and isinstance(shape[0], (tuple, list)):
+            shape = tuple(shape[0])
+        v = self.value.reshape(shape)
+        k = self.nb_directions()
+        H = None
+        if self.hessian is not None:
+            H = self.hessian.reshape(v.shape + (k, k))
+        return Jet(v, self.jacobian.reshape(v.shape + (k,)), H)
+
+    def flatten(self):
+        return self.reshape(self.size)
+
+    def ravel(self):
+        return self.reshape(self.size)
+
+    def transpose(self):
+        d = self.ndim
+        axes = tuple(reversed(range(d)))
+        H = None
+        if self.hessian is not None:
+            H = self.hessian.transpose(axes + (d, d + 1))
+        return Jet(self.value.transpose(axes),
+                   self.jacobian.transpose(axes + (d,)), H)
+
+    def sum(self, axis=None, keepdims=False):
+        return _sum(self, axis, keepdims=keepdims)
+
+    def dot(self, other):
+        return _dot(self, other)
+
+    def __add__(self, other):
+        return np.add(self, other)
+
+    def __radd__(self, other):
+        return np.add(other, self)
+
+    def __sub__(self, other):
+        return np.subtract(self, other)
+
+    def __rsub__(self, other):
+        return np.subtract(other, self)
+
+    def __mul__(self, other):
+        if isinstance(other, np.matrix):
+            return _dot(self, np.asarray(other))
+        if not isinstance(other, Jet):
+            other = np.asarray(other)
+        return np.multiply(self, other)
+
+    def __rmul__(self, other):
+        if isinstance(other, np.matrix):
+            return _dot(np.asarray(other), self)
+        return np.multiply(np.asarray(other), self)
+
+    def __truediv__(self, other):
+        return np.true_divide(self, other)
+
+    def __rtruediv__(self, other):
+        return np.true_divide(other, self)
+
+    def __pow__(self, other):
+        return np.power(self, other)
+
+    def __rpow__(self, other):
+        return np.power(other, self)
+
+    def __matmul__(self, other):
+        return _dot(self, other)
+
+    def __rmatmul__(self, other):
+        return _dot(other, self)
+
+    def __neg__(self):
+        return np.negative(self)
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return np.absolute(self)
+
+    def __lt__(self, other):
+        return self.value < _value(other)
+
+    def __le__(self, other):
+        return self.value <= _value(other)
+
+    def __gt__(self, other):
+        return self.value > _value(other)
+
+    def __ge__(self, other):
+        return self.value >= _value(other)
+
+    def __eq__(self, other):
+        return self.value == _value(other)
+
+    def __ne__(self, other):
+        return self.value != _value(other)
+
+    __hash__ = None
+
+    def __bool__(self):
+        return bool(self.value)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != "__call__" or kwargs:
+            return NotImplemented
+        if ufunc in _COMPARISONS:
+            return ufunc(*[_value(x) for x in inputs])
+        if ufunc in _UNARY:
+            return _unary(inputs[0], *_UNARY[ufunc](inputs[0].value))
+        if ufunc in _BINARY:
+            return _BINARY[ufunc](*_lift(*inputs))
+        return NotImplemented
+
+    def __array_function__(self, func, types, args, kwargs):
+        if func not in _HANDLED_FUNCTIONS:
+            return NotImplemented
+        return _HANDLED_FUNCTIONS[func](*args, **kwargs)
+
+
+def _value(x):
+    return x.value if isinstance(x, Jet) else x
+
+
+def _lift(*inputs):
+    """ Lifts all inputs to jets of the same directions and order """
+    jets = [x for x in inputs if isinstance(x, Jet)]
+    first_order = any(x.hessian is None for x in jets)
+    like = next(x for x in jets if x.hessian is None or not first_order)
+    return [like.constant(x) for x in inputs]
+
+
+def _unary(x, f0, f1, f2):
+    """ Chain rule for y = f(x) given f(x), f'(x) and f''(x) """
+    f1 = np.asarray(f1)
+    J = f1[..., None] * x.jacobian
+    H = None
+    if x.hessian is not None:
+        H = f1[..., None, None] * x.hessian
+        H = H + np.asarray(f2)[..., None, None] * _outer(
+            x.jacobian, x.jacobian)
+    return Jet(f0, J, H)
+
+
+def _binary(a, b, f0, fa, fb, faa=None, fab=None, fbb=None):
+    """ Chain rule for y = f(a, b) given f and its partial derivatives,
+        the second order partials are zero when None """
+    fa = np.asarray(fa)
+    fb = np.asarray(fb)
+    J = fa[..., None] * a.jacobian + fb[..., None] * b.jacobian
+    if a.hessian is None or b.hessian is None:
+        return Jet(f0, J)
+    H = fa[..., None, None] * a.hessian + fb[..., None, None] * b.hessian
+    if faa is not None:
+        H = H + np.asarray(faa)[..., None, None] * _outer(
+            a.jacobian, a.jacobian)
+    if fbb is not None:
+        H = H + np.asarray(fbb)[..., None, None] * _outer(
+            b.jacobian, b.jacobian)
+    if fab is not None:
+        H = H + np.asarray(fab)[..., None, None] * (
+            _outer(a.jacobian, b.jacobian) + _outer(b.jacobian, a.jacobian))
+    return Jet(f0, J, H)
+
+
+def _add(a, b):
+    return _binary(a, b, a.value + b.value, 1., 1.)
+
+
+def _subtract(a, b):
+    return _binary(a, b, a.value - b.value, 1., -1.)
+
+
+def _multiply(a, b):
+    one = np.ones(np.broadcast(a.value, b.value).shape)
+    return _binary(a, b, a.value * b.value, b.value, a.value, fab=one)
+
+
+def _divide(a, b):
+    inv_b = 1. / b.value
+    return _binary(a, b, a.value * inv_b, inv_b, -a.value * inv_b ** 2,
+                   fab=-inv_b ** 2, fbb=2. * a.value * inv_b ** 3)
+
+
+def _power(a, b):
+    if not b.jacobian.any() and (b.hessian is None or not b.hessian.any()):
+        p = b.value
+        return _unary(a, a.value ** p, p * a.value ** (p - 1.),
+                      p * (p - 1.) * a.value ** (p - 2.))
+    if not a.jacobian.any() and (a.hessian is None or not a.hessian.any()):
+        y = a.value ** b.value
+        log_a = np.log(a.value)
+        return _unary(b, y, log_a * y, log_a ** 2 * y)
+    return np.exp(b * np.log(a))
+
+
+def _arctan2(a, b):
+    """ arctan2(a, b) where a is the ordinate and b the abscissa """
+    r2 = a.value ** 2 + b.value ** 2
+    return _binary(a, b, np.arctan2(a.value, b.value),
+                   b.value / r2, -a.value / r2,
+                   faa=-2. * a.value * b.value / r2 ** 2,
+                   fab=(a.value ** 2 - b.value ** 2) / r2 ** 2,
+                   fbb=2. * a.value * b.value / r2 ** 2)
+
+
+def _maximum(a, b):
+    return _where(a.value >= b.value, a, b)
+
+
+def _minimum(a, b):
+    return _where(a.value <= b.value, a, b)
+
+
+def _exp(x):
+    y = np.exp(x)
+    return y, y, y
+
+
+def _log(x):
+    return np.log(x), 1. / x, -1. / x ** 2
+
+
+def _sqrt(x):
+    y = np.sqrt(x)
+    return y, .5 / y, -.25 / y ** 3
+
+
+def _tanh(x):
+    y = np.tanh(x)
+    d = 1. - y ** 2
+    return y, d, -2. * y * d
+
+
+def _arcsin(x):
+    d = 1. / np.sqrt(1. - x ** 2)
+    return np.arcsin(x), d, x * d ** 3
+
+
+def _arccos(x):
+    d = 1. / np.sqrt(1. - x ** 2)
+    return np.arccos(x), -d, -x * d ** 3
+
+
+def _arctan(x):
+    d = 1. / (1. + x ** 2)
+    return np.arctan(x), d, -2. * x * d ** 2
+
+
+def _tan(x):
+    y = np.tan(x)
+    d = 1. + y ** 2
+    return y, d, 2. * y * d
+
+
+_UNARY = {
+    np.negative: lambda x: (-x, -np.ones_like(x), np.zeros_like(x)),
+    np.positive: lambda x: (x, np.ones_like(x), np.zeros_like(x)),
+    np.square: lambda x: (x ** 2, 2. * x, np.full_like(x, 2.)),
+    np.reciprocal: lambda x: (1. / x, -1. / x ** 2, 2. / x ** 3),
+    np.absolute: lambda x: (np.abs(x), np.sign(x), np.zeros_like(x)),
+    np.fabs: lambda x: (np.abs(x), np.sign(x), np.zeros_like(x)),
+    np.exp: _exp,
+    np.log: _log,
+    np.sqrt: _sqrt,
+    np.sin: lambda x: (np.sin(x), np.cos(x), -np.sin(x)),
+    np.cos: lambda x: (np.cos(x), -np.sin(x), -np.cos(x)),
+    np.tan: _tan,
+    np.sinh: lambda x: (np.sinh(x), np.cosh(x), np.sinh(x)),
+    np.cosh: lambda x: (np.cosh(x), np.sinh(x), np.cosh(x)),
+    np.tanh: _tanh,
+    np.arcsin: _arcsin,
+    np.arccos: _arccos,
+    np.arctan: _arctan,
+}
+
+_BINARY = {
+    np.add: _add,
+    np.subtract: _subtract,
+    np.multiply: _multiply,
+    np.true_divide: _divide,
+    np.power: _power,
+    np.arctan2: _arctan2,
+    np.maximum: _maximum,
+    np.minimum: _minimum,
+    np.matmul: lambda a, b: _dot(a, b),
+}
+
+_COMPARISONS = {
+    np.less, np.less_equal, np.greater, np.greater_equal,
+    np.equal, np.not_equal, np.sign, np.isnan, np.isinf, np.isfinite,
+}
+
+
+def _normalize_axis(axis, ndim):
+    if isinstance(axis, tuple):
+        return tuple(a % ndim for a in axis)
+    return axis % ndim
+
+
+@_implements(np.sum)
+def _sum(x, axis=None, keepdims=False, **kwargs):
+    if not isinstance(x, Jet):
+        return np.sum(x, axis=axis, keepdims=keepdims)
+    if axis is None:
+        axis = tuple(range(x.ndim))
+    axis = _normalize_axis(axis, x.ndim)
+    H = None
+    if x.hessian is not None:
+        H = x.hessian.sum(axis=axis, keepdims=keepdims)
+    return Jet(x.value.sum(axis=axis, keepdims=keepdims),
+               x.jacobian.sum(axis=axis, keepdims=keepdims), H)
+
+
+@_implements(np.dot)
+def _dot(a, b):
+    """ Dot product for arrays of dimension at most 2, the operands that
+        are not jets are converted to arrays (np.matrix would otherwise
+        turn the elementwise products below into matrix products) """
+    a = a if isinstance(a, Jet) else np.asarray(a)
+    b = b if isinstance(b, Jet) else np.asarray(b)
+    if a.ndim == 0 or b.ndim == 0:
+        return a * b
+    if a.ndim > 2 or b.ndim > 2:
+        raise TypeError("Jet dot only supports dimensions at most 2")
+    if a.shape[-1] != b.shape[0]:
+        raise TypeError("Jet dot shapes {} and {} not aligned".format(
+            a.shape, b.shape))
+    if np.ndim(_value(a)) == 1 and np.ndim(_value(b)) == 1:
+        return _sum(a * b)
+    if np.ndim(_value(b)) == 1:
+        return _sum(a * b[None, :], axis=1)
+    if np.ndim(_value(a)) == 1:
+        return _sum(a[:, None] * b, axis=0)
+    return _sum(a[:, :, None] * b[None, :, :], axis=1)
+
+
+@_implements(np.outer)
+def _np_outer(a, b):
+    return a.flatten()[:, None] * b.flatten()[None, :]
+
+
+@_implements(np.linalg.norm)
+def _norm(x, ord=None, axis=None, keepdims=False):
+    if ord is not None:
+        raise NotImplementedError("Jet norm only supports ord=None")
+    return np.sqrt(_sum(x * x, axis=axis, keepdims=keepdims))
+
+
+@_implements(np.where)
+def _where(condition, x, y):
+    """ Selects x where condition holds and y otherwise """
+    condition = np.asarray(_value(condition))
+    x, y = _lift(x, y)
+    H = None
+    if x.hessian is not None:
+        H = np.where(condition[..., None, None], x.hessian, y.hessian)
+    return Jet(np.where(condition, x.value, y.value),
+               np.where(condition[..., None], x.jacobian, y.jacobian), H)
+
+
+@_implements(np.reshape)
+def _reshape(x, newshape):
+    return x.reshape(newshape)
+
+
+@_implements(np.transpose)
+def _transpose(x):
+    return x.transpose()
+
+
+@_implements(np.concatenate)
+def _concatenate(arrays, axis=0):
+    jets = _lift(*arrays)
+    axis = _normalize_axis(axis, jets[0].ndim)
+    H = None
+    if jets[0].hessian is not None:
+        H = np.concatenate([x.hessian for x in jets], axis=axis)
+    return Jet(np.concatenate([x.value for x in jets], axis=axis),
+               np.concatenate([x.jacobian for x in jets], axis=axis), H)
+
+
+@_implements(np.stack)
+def _stack(arrays, axis=0):
+    jets = _lift(*arrays)
+    axis = _normalize_axis(axis, jets[0].ndim + 1)
+    return _concatenate([x.reshape(
+        x.shape[:axis] + (1,) + x.shape[axis:]) for x in jets], axis)
+
+
+@_implements(np.hstack)
+def _hstack(arrays):
+    jets = [x.reshape(-1) if np.ndim(_value(x)) == 0 else x
+            for x in _lift(*arrays)]
+    return _concatenate(jets, axis=0 if jets[0].ndim == 1 else 1)
+
+
+@_implements(np.vstack)
+def _vstack(arrays):
+    jets = [x.reshape(1, -1) if x.ndim < 2 else x for x in _lift(*arrays)]
+    return _concatenate(jets, axis=0)
+
+
+def forward_mode_evaluate(f, q, order=2):
+    """ Value and derivatives of the map f up to the given order from a
+        single evaluation of its forward function on jets seeded with
+        the canonical directions. Returns [y, J] (order 1) or [y, J, H]
+        (order 2, only for functions). Raises an exception when the
+        forward function does not support jets.
+
+        WARNING J and H are numpy matrices."""
+    assert q.size == f.input_dimension()
+    m = f.output_dimension()
+    n = f.input_dimension()
+    assert order < 2 or m == 1
+    y = f.forward(Jet.variable(q, order))
+    dtype = np.result_type(q, float)
+    if not isinstance(y, Jet):
+        # constant output, checks that no jet ended up in the output
+        np.asarray(y, dtype=dtype)
+        return [y, np.matrix(np.zeros((m, n), dtype=dtype)),
+                np.matrix(np.zeros((n, n), dtype=dtype))][:order + 1]
+    values = [y.value[()], np.matrix(y.jacobian.reshape(m, n))]
+    if order > 1:
+        values.append(np.matrix(y.hessian.reshape(n, n)))
+    return values
+
+
+def forward_mode_jacobian(f, q):
+    """ Jacobian of the map f evaluated in forward mode, i.e., by running
+        its forward function on a first order jet.
+
+        WARNING the object returned by this function is a numpy matrix."""
+    return forward_mode_evaluate(f, q, order=1)[1]
+
+
+def forward_mode_hessian(f, q):
+    """ Hessian of the function f evaluated in forward mode using
+        second order jets.
+
+        WARNING the object returned by this function is a numpy matrix."""
+    return forward_mode_evaluate(f, q, order=2)[2]
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2018, University of Stuttgart
+# All rights reserved.
+#
+# Permission to use, copy, modify, and distribute this software for any purpose
+# with or without   fee is hereby granted, provided   that the above  copyright
+# notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS  SOFTWARE INCLUDING ALL  IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR  BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR  ANY DAMAGES WHATSOEVER RESULTING  FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION,   ARISING OUT OF OR IN    CONNECTION WITH THE USE   OR
+# PERFORMANCE OF THIS SOFTWARE.
+#
+#                                        Jim Mainprice on Sunday June 13 2018
+
+from .differentiable_geometry import *
+
+# Simplification of DifferentiableMap trees.
+#
+# The trees are walked bottom up and the following rules are applied:
+#
+#   Scale(Scale(f, a), b)               -> Scale(f, a * b)
+#   Scale(quadric or affine, a)         -> quadric or affine
+#   affine o affine                     -> AffineMap
+#   quadric o affine                    -> QuadricFunction
+#   Scale(f, a) o g                     -> Scale(f o g, a)
+#   f o RangeSubspaceMap                -> SubspacePullback (index slicing)
+#   SumOfTerms(SumOfTerms(...), ...)    -> SumOfTerms(...)
+#   SumOfTerms(quadrics, affines, ...)  -> SumOfTerms(quadric, affine, ...)
+#
+# the operands of ProductFunction and CombinedOutputMap are compiled,
+# affine stands for AffineMap, RangeSubspaceMap and IdentityMap and
+# quadric for QuadricFunction and SquaredNorm. Composition is exact for
+# both Compose and Pullback here, since the hessian of an affine map is
+# zero. Maps that are not known to the compiler are kept as is, unless
+# they define an expression() method which returns an equivalent tree of
+# elementary maps.
+
+
+def _affine_terms(g):
+    """ Returns (A, b) with g(x) = A x + b as arrays or None """
+    if isinstance(g, IdentityMap):
+        n = g.input_dimension()
+        return np.eye(n), np.zeros(n)
+    if isinstance(g, RangeSubspaceMap):
+        return np.eye(g.input_dimension())[g._indices, :], np.zeros(
+            g.output_dimension())
+    if isinstance(g, AffineMap):
+        return np.asarray(g._a), np.asarray(g._b).reshape(g._b.size)
+    return None
+
+
+def _quadric_terms(f):
+    """ Returns (A, b, c) with f(x) = 1/2 x^T A x + b^T x + c and A
+        symmetric, as arrays or None """
+    if isinstance(f, SquaredNorm):
+        x_0 = np.asarray(f.x_0, dtype=float).reshape(f.x_0.size)
+        return np.eye(x_0.size), -x_0, .5 * np.dot(x_0, x_0)
+    if isinstance(f, QuadricFunction):
+        a = np.asarray(f._a)
+        return .5 * (a + a.T), np.asarray(f._b).reshape(f._b.size), f._c
+    return None
+
+
+def _compile_scale(f, memo):
+    g = compile_map(f._f, memo)
+    alpha = f._alpha
+    if type(g) is Scale:
+        alpha *= g._alpha
+        g = g._f
+    quadric = _quadric_terms(g)
+    if quadric is not None:
+        a, b, c = quadric
+        return QuadricFunction(alpha * a, alpha * b, alpha * c)
+    if type(g) is AffineMap:
+        a, b = _affine_terms(g)
+        return AffineMap(alpha * a, alpha * b)
+    if alpha == 1.:
+        return g
+    if g is f._f and alpha == f._alpha:
+        return f
+    return Scale(g, alpha)
+
+
+def _compile_sum(f, memo):
+    functions = []
+    for g in f._functions:
+        g = compile_map(g, memo)
+        if type(g) is SumOfTerms:
+            functions.extend(g._functions)
+        else:
+            functions.append(g)
+    quadrics = [g for g in functions if _quadric_terms(g) is not None]
+    affines = [g for g in functions if type(g) is AffineMap]
+    others = [g for g in functions if g not in quadrics and g not in affines]
+    if len(quadrics) > 1:
+        terms = [_quadric_terms(g) for g in quadrics]
+        quadrics = [QuadricFunction(*[sum(t) for t in zip(*terms)])]
+    if len(affines) > 1:
+        terms = [_affine_terms(g) for g in affines]
+        affines = [AffineMap(*[sum(t) for t in zip(*terms)])]
+    functions = quadrics + affines + others
+    if len(functions) == 1:
+        return functions[0]
+    return SumOfTerms(functions)
+
+
+def _compile_composition(f, memo):
+    outer = compile_map(f._f, memo)
+    inner = compile_map(f._g, memo)
+    if isinstance(inner, IdentityMap):
+        return outer
+    if type(outer) is Scale:
+        composition = type(f)(outer._f, inner)
+        return compile_map(Scale(composition, outer._alpha), memo)
+    if (type(outer) is RangeSubspaceMap and
+            type(inner) is RangeSubspaceMap):
+        indices = [inner._indices[i] for i in outer._indices]
+        return RangeSubspaceMap(inner.input_dimension(), indices)
+    affine = _affine_terms(inner)
+    if affine is not None:
+        m, d = affine
+        quadric = _quadric_terms(outer)
+        if quadric is not None:
+            a, b, c = quadric
+            return QuadricFunction(
+                np.dot(m.T, np.dot(a, m)),
+                np.dot(m.T, np.dot(a, d) + b),
+                .5 * np.dot(d, np.dot(a, d)) + np.dot(b, d) + c)
+        affine_outer = _affine_terms(outer)
+        if affine_outer is not None:
+            a, b = affine_outer
+            return AffineMap(np.dot(a, m), np.dot(a, d) + b)
+    if type(inner) is RangeSubspaceMap:
+        if type(outer) is SubspacePullback:
+            indices = [inner._indices[i] for i in outer._indices]
+            return SubspacePullback(
+                outer._f, inner.input_dimension(), indices)
+        return SubspacePullback(
+            outer, inner.input_dimension(), inner._indices)
+    if outer is f._f and inner is f._g:
+        return f
+    return type(f)(outer, inner)
+
+
+def compile_map(f, memo=None):
+    """ Returns an equivalent map where the algebraic simplifications
+        listed above are applied, which evaluates faster. The input map
+        is not modified. Sub-maps that appear multiple times in the tree
+        are compiled once (memo maps ids to compiled maps) so that
+        sharing is preserved. """
+    if memo is None:
+        memo = {}
+    key = id(f)
+    if key in memo:
+        return memo[key][1]
+    if type(f) is Scale:
+        compiled = _compile_scale(f, memo)
+    elif type(f) is SumOfTerms:
+        compiled = _compile_sum(f, memo)
+    elif type(f) in (Compose, Pullback):
+        compiled = _compile_composition(f, memo)
+    elif type(f) is SubspacePullback:
+        compiled = compile_map(Compose(
+            f._f, RangeSubspaceMap(f.input_dimension(), f._indices)), memo)
+    elif type(f) is ProductFunction:
+        g = compile_map(f._g, memo)
+        h = compile_map(f._h, memo)
+        compiled = f if g is f._g and h is f._h else ProductFunction(g, h)
+    elif type(f) is CombinedOutputMap:
+        maps = [compile_map(m, memo) for m in f._maps]
+        compiled = CombinedOutputMap(maps)
+    elif hasattr(f, "expression"):
+        compiled = compile_map(f.expression(), memo)
+    else:
+        compiled = f
+    # the map is kept in the memo so that its id is not reused
+    memo[key] = (f, compiled)
+    return compiled
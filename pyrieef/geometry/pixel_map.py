@@ -49,6 +49,12 @@ class Extent:
         return self.y_max - self.y_min
 
 
+def nb_cells(length, resolution):
+    """ Number of cells of side resolution along a side of the extent,
+        shared by the PixelMap and the rasterized grids (cell_centers) """
+    return int(round(length / resolution))
+
+
 def sample_uniform(extent):
     """ Sample uniformly point in extend"""
     pt = np.random.random(2)  # in [0, 1]^2
@@ -69,8 +75,8 @@ class PixelMap:
         self.resolution = resolution
         self.origin_minus = np.array([self.extent.x_min, self.extent.y_min])
         self.origin = self.origin_minus + 0.5 * self.resolution
-        self.nb_cells_x = int(self.extent.x() / self.resolution)
-        self.nb_cells_y = int(self.extent.y() / self.resolution)
+        self.nb_cells_x = nb_cells(self.extent.x(), self.resolution)
+        self.nb_cells_y = nb_cells(self.extent.y(), self.resolution)
 
     def world_to_matrix(self, x):
         """
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2018, University of Stuttgart
+# All rights reserved.
+#
+# Permission to use, copy, modify, and distribute this software for any purpose
+# with or without   fee is hereby granted, provided   that the above  copyright
+# notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS  SOFTWARE INCLUDING ALL  IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR  BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR  ANY DAMAGES WHATSOEVER RESULTING  FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION,   ARISING OUT OF OR IN    CONNECTION WITH THE USE   OR
+# PERFORMANCE OF THIS SOFTWARE.
+#
+#                                        Jim Mainprice on Sunday June 13 2018
+
+from .differentiable_geometry import *
+from contextlib import contextmanager
+import time
+
+# Opt-in instrumentation of the DifferentiableMap objects.
+#
+# When profiling is enabled, the maps constructed afterwards have their
+# methods wrapped so that the calls and the wall time spent in each
+# method are accumulated in a MapProfile. Maps constructed while
+# profiling is disabled are not wrapped and run at full speed.
+#
+#   enable_profiling()
+#   problem = MotionOptimization2DCostMap(...)
+#   problem.optimize(...)
+#   print(profile_report(problem.objective))
+#
+# The times are inclusive: the time of a map contains the time of its
+# sub-maps. Profiled maps should not be copied (the wrappers are bound
+# to the original instance).
+
+PROFILED_METHODS = [
+    "forward",
+    "jacobian",
+    "hessian",
+    "evaluate_all",
+    "hessian_vector_product"]
+
+
+class MapProfile:
+    """ Call counts and accumulated wall times of a map """
+
+    def __init__(self):
+        self.calls = dict((name, 0) for name in PROFILED_METHODS)
+        self.times = dict((name, 0.) for name in PROFILED_METHODS)
+        self.finite_differences = 0
+
+    def reset(self):
+        self.__init__()
+
+    def __str__(self):
+        stats = ["{} {} ({:.2e} s)".format(
+            name, self.calls[name], self.times[name])
+            for name in PROFILED_METHODS if self.calls[name] > 0]
+        if self.finite_differences > 0:
+            stats.append("finite differences {}".format(
+                self.finite_differences))
+        return ", ".join(stats) if stats else "no calls"
+
+
+def _profiled(profile, name, method):
+    def wrapper(*args, **kwargs):
+        t_start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            profile.calls[name] += 1
+            profile.times[name] += time.time() - t_start
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+def instrument(f):
+    """ Wraps the methods of a map to record them in f._profile """
+    f._profile = MapProfile()
+    for name in PROFILED_METHODS:
+        setattr(f, name, _profiled(f._profile, name, getattr(f, name)))
+    return f
+
+
+def enable_profiling(enabled=True):
+    """ Maps constructed after this call are profiled (or not) """
+    DifferentiableMap._instrument = instrument if enabled else None
+
+
+def is_profiling_enabled():
+    return DifferentiableMap._instrument is not None
+
+
+@contextmanager
+def profiling():
+    """ Profiles the maps constructed within the context """
+    enabled = is_profiling_enabled()
+    enable_profiling()
+    try:
+        yield
+    finally:
+        enable_profiling(enabled)
+
+
+def sub_maps(f):
+    """ Returns the maps that are attributes of f (or in lists of
+        attributes), e.g., the operands of Compose or SumOfTerms and the
+        clique functions of a CliquesFunctionNetwork, without repetition """
+    maps = []
+    ids = set()
+
+    def add(v):
+        if isinstance(v, DifferentiableMap):
+            if id(v) not in ids:
+                ids.add(id(v))
+                maps.append(v)
+        elif isinstance(v, (list, tuple)):
+            for u in v:
+                add(u)
+    for v in vars(f).values():
+        add(v)
+    return maps
+
+
+def reset_profiles(f):
+    """ Resets the profiles of the map tree """
+    if f._profile is not None:
+        f._profile.reset()
+    for g in sub_maps(f):
+        reset_profiles(g)
+
+
+def profile_report(f, indent=2):
+    """ Returns the profiles of the map tree as a string with one line
+        per map, sub-maps are indented under their parent map. Maps that
+        are shared in the tree are detailed at their first occurrence. """
+    lines = []
+    visited = set()
+
+    def report(g, depth):
+        name = " " * (indent * depth) + type(g).__name__
+        if id(g) in visited:
+            lines.append("{} (shared)".format(name))
+            return
+        visited.add(id(g))
+        profile = g._profile
+        lines.append("{} : {}".format(
+            name, "not profiled" if profile is None else profile))
+        for h in sub_maps(g):
+            report(h, depth + 1)
+    report(f, 0)
+    return "\n".join(lines)
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2018, University of Stuttgart
+# All rights reserved.
+#
+# Permission to use, copy, modify, and distribute this software for any purpose
+# with or without   fee is hereby granted, provided   that the above  copyright
+# notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+# REGARD TO THIS  SOFTWARE INCLUDING ALL  IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS. IN NO EVENT SHALL THE AUTHOR  BE LIABLE FOR ANY SPECIAL, DIRECT,
+# INDIRECT, OR CONSEQUENTIAL DAMAGES OR  ANY DAMAGES WHATSOEVER RESULTING  FROM
+# LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR
+# OTHER TORTIOUS ACTION,   ARISING OUT OF OR IN    CONNECTION WITH THE USE   OR
+# PERFORMANCE OF THIS SOFTWARE.
+#
+#                                        Jim Mainprice on Sunday June 13 2018
+
+import numpy as np
+from scipy import sparse
+from scipy.linalg import block_diag
+
+
+class StructuredJacobian:
+    """
+    Jacobian matrix with a known structure (identity, zero, selection,
+    block diagonal or sparse).
+
+    They behave like the numpy matrices returned by the jacobian functions:
+    * is the matrix product, .T is the transpose, and numpy converts them
+    to dense arrays (e.g., np.array(J)). The products with other jacobians
+    exploit the structure (see chain_rule). numpy operators defer to them
+    (__array_ufunc__ = None), so that ndarray * J is a matrix product as
+    with numpy matrices.
+    """
+
+    __array_ufunc__ = None
+
+    @property
+    def shape(self):
+        raise NotImplementedError()
+
+    def todense(self):
+        """ Returns the dense numpy matrix """
+        raise NotImplementedError()
+
+    def tosparse(self):
+        """ Returns the scipy.sparse (CSR) matrix """
+        return sparse.csr_matrix(np.asarray(self.todense()))
+
+    def transpose(self):
+        raise NotImplementedError()
+
+    def left_multiply(self, a):
+        """ Returns the array a J, a is a 2D array """
+        raise NotImplementedError()
+
+    def right_multiply(self, b):
+        """ Returns the array J b, b is a 2D array """
+        raise NotImplementedError()
+
+    def compose(self, other):
+        """ Returns the structured jacobian J other """
+        return SparseJacobian(self.tosparse().dot(other.tosparse()))
+
+    @property
+    def T(self):
+        return self.transpose()
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.todense(), dtype=dtype)
+
+    def __mul__(self, other):
+        if np.isscalar(other):
+            return np.matrix(other * np.asarray(self))
+        return chain_rule(self, other)
+
+    def __rmul__(self, other):
+        if np.isscalar(other):
+            return np.matrix(other * np.asarray(self))
+        return chain_rule(other, self)
+
+    def __matmul__(self, other):
+        return chain_rule(self, other)
+
+    def __rmatmul__(self, other):
+        return chain_rule(other, self)
+
+    def __add__(self, other):
+        return self.todense() + np.asarray(other)
+
+    def __radd__(self, other):
+        return np.asarray(other) + self.todense()
+
+    def __sub__(self, other):
+        return self.todense() - np.asarray(other)
+
+    def __rsub__(self, other):
+        return np.asarray(other) - self.todense()
+
+    def __neg__(self):
+        return -self.todense()
+
+    def __getitem__(self, key):
+        return self.todense()[key]
+
+    def __getattr__(self, name):
+        """ Other numpy matrix attributes are taken from the dense matrix """
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.todense(), name)
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, self.todense())
+
+    def __str__(self):
+        return str(self.todense())
+
+
+class IdentityJacobian(StructuredJacobian):
+    """ Jacobian of the identity map """
+
+    def __init__(self, n):
+        self._n = n
+
+    @property
+    def shape(self):
+        return (self._n, self._n)
+
+    def todense(self):
+        return np.matrix(np.eye(self._n))
+
+    def tosparse(self):
+        return sparse.identity(self._n, format="csr")
+
+    def transpose(self):
+        return self
+
+    def left_multiply(self, a):
+        return a
+
+    def right_multiply(self, b):
+        return b
+
+    def compose(self, other):
+        return other
+
+
+class ZeroJacobian(StructuredJacobian):
+    """ Jacobian of constant maps """
+
+    def __init__(self, m, n):
+        self._m = m
+        self._n = n
+
+    @property
+    def shape(self):
+        return (self._m, self._n)
+
+    def todense(self):
+        return np.matrix(np.zeros((self._m, self._n)))
+
+    def tosparse(self):
+        return sparse.csr_matrix((self._m, self._n))
+
+    def transpose(self):
+        return ZeroJacobian(self._n, self._m)
+
+    def left_multiply(self, a):
+        return np.zeros((a.shape[0], self._n))
+
+    def right_multiply(self, b):
+        return np.zeros((self._m, b.shape[1]))
+
+    def compose(self, other):
+        return ZeroJacobian(self._m, other.shape[1])
+
+
+class SelectionJacobian(StructuredJacobian):
+    """
+    Jacobian of a map that selects some of its inputs (RangeSubspaceMap)
+
+        J[i, indices[i]] = 1
+
+    The transpose scatters its input in the rows of the indices.
+    """
+
+    def __init__(self, n, indices, transposed=False):
+        self._n = n
+        self._indices = np.asarray(indices, dtype=int)
+        self._transposed = transposed
+
+    @property
+    def shape(self):
+        shape = (self._indices.size, self._n)
+        return shape[::-1] if self._transposed else shape
+
+    def tosparse(self):
+        k = self._indices.size
+        J = sparse.csr_matrix(
+            (np.ones(k), (np.arange(k), self._indices)), shape=(k, self._n))
+        return J.T.tocsr() if self._transposed else J
+
+    def todense(self):
+        return np.matrix(self.tosparse().toarray())
+
+    def transpose(self):
+        return SelectionJacobian(self._n, self._indices, not self._transposed)
+
+    def _select_rows(self, b):
+        return b[self._indices]
+
+    def _scatter_rows(self, b):
+        c = np.zeros((self._n,) + b.shape[1:], dtype=b.dtype)
+        np.add.at(c, self._indices, b)
+        return c
+
+    def left_multiply(self, a):
+        if self._transposed:
+            return a[:, self._indices]
+        return self._scatter_rows(a.T).T
+
+    def right_multiply(self, b):
+        if self._transposed:
+            return self._scatter_rows(b)
+        return self._select_rows(b)
+
+    def compose(self, other):
+        if (isinstance(other, SelectionJacobian) and
+                not self._transposed and not other._transposed):
+            return SelectionJacobian(
+                other._n, other._indices[self._indices])
+        return StructuredJacobian.compose(self, other)
+
+
+class BlockDiagonalJacobian(StructuredJacobian):
+    """ Jacobian of maps that act independently on consecutive ranges of
+        their input, e.g., the same map applied on each configuration of
+        a trajectory. """
+
+    def __init__(self, blocks):
+        self._blocks = [np.asarray(b) for b in blocks]
+        self._rows = np.cumsum([0] + [b.shape[0] for b in self._blocks])
+        self._cols = np.cumsum([0] + [b.shape[1] for b in self._blocks])
+
+    @property
+    def shape(self):
+        return (self._rows[-1], self._cols[-1])
+
+    def todense(self):
+        return np.matrix(block_diag(*self._blocks))
+
+    def tosparse(self):
+        return sparse.block_diag(self._blocks, format="csr")
+
+    def transpose(self):
+        return BlockDiagonalJacobian([b.T for b in self._blocks])
+
+    def left_multiply(self, a):
+        return np.hstack([
+            np.dot(a[:, self._rows[i]:self._rows[i + 1]], b)
+            for i, b in enumerate(self._blocks)])
+
+    def right_multiply(self, b):
+        return np.vstack([
+            np.dot(block, b[self._cols[i]:self._cols[i + 1]])
+            for i, block in enumerate(self._blocks)])
+
+
+class SparseJacobian(StructuredJacobian):
+    """ Jacobian stored as a scipy.sparse matrix """
+
+    def __init__(self, matrix):
+        self._matrix = sparse.csr_matrix(matrix)
+
+    @property
+    def shape(self):
+        return self._matrix.shape
+
+    def todense(self):
+        return np.matrix(self._matrix.toarray())
+
+    def tosparse(self):
+        return self._matrix
+
+    def transpose(self):
+        return SparseJacobian(self._matrix.T)
+
+    def left_multiply(self, a):
+        return np.asarray(self._matrix.T.dot(a.T)).T
+
+    def right_multiply(self, b):
+        return np.asarray(self._matrix.dot(b))
+
+
+def chain_rule(J_f, J_g):
+    """ Product J_f J_g of the jacobians of f and g in the composition
+        f(g(q)), which exploits their structure. Returns a structured
+        jacobian when both are structured and a numpy matrix otherwise. """
+    if isinstance(J_g, StructuredJacobian):
+        if isinstance(J_f, StructuredJacobian):
+            return J_f.compose(J_g)
+        a = np.asarray(J_f)
+        a = a.reshape(-1, J_g.shape[0]) if a.ndim < 2 else a
+        return np.matrix(J_g.left_multiply(a))
+    if isinstance(J_f, StructuredJacobian):
+        b = np.asarray(J_g)
+        b = b.reshape(J_f.shape[1], -1) if b.ndim < 2 else b
+        return np.matrix(J_f.right_multiply(b))
+    return np.matrix(J_f) * np.matrix(J_g)
+
+
+def pullback_hessian(H_f, J_g):
+    """ J_g^T H_f J_g, which exploits the structure of J_g, e.g., when
+        g is a RangeSubspaceMap H_f is scattered in the hessian. """
+    if isinstance(J_g, StructuredJacobian):
+        H_f_J_g = J_g.left_multiply(np.asarray(H_f))
+        return np.matrix(J_g.T.right_multiply(H_f_J_g))
+    J_g = np.matrix(J_g)
+    return J_g.T * H_f * J_g
@@ -22,11 +22,15 @@ import numpy as np
 # import matplotlib as mpl
 # from matplotlib.pyplot import cm
 import math
+import functools
 from .pixel_map import *
 from abc import abstractmethod
 from .differentiable_geometry import *
 from .rotations import *
 from .utils import *
+from scipy.spatial import cKDTree
+from scipy.interpolate import RectBivariateSpline
+from concurrent.futures import ThreadPoolExecutor
 
 
 def vector_norm(x):
@@ -108,6 +112,13 @@ class Shape:
         """
         raise NotImplementedError()
 
+    def bounding_circle(self):
+        """
+        Returns the center and the radius of a circle that contains the
+        shape, None when the shape is unbounded or the circle is unknown
+        """
+        return None
+
     @abstractmethod
     def sampled_points(self):
         raise NotImplementedError()
@@ -181,6 +192,9 @@ class Circle(Shape):
         """ Warning: not parraleized but should work from 3D """
         return point_distance_hessian(x, self.origin)
 
+    def bounding_circle(self):
+        return self.origin, self.radius
+
     def sampled_points(self):
         """ TODO make this generic (3D) and parallelizable... Tough."""
         points = []
@@ -191,51 +205,137 @@ class Circle(Shape):
         return points
 
 
+def ellipse_closest_point(x, a, b, nb_iterations=12):
+    """
+    Closest points on the ellipse (x / a)^2 + (y / b)^2 = 1 with a >= b,
+    from the points x (2, ...) in the frame of the ellipse.
+
+    The closest point of a point y in the first quadrant is
+    (a^2 y_0 / (t + a^2), b^2 y_1 / (t + b^2)) where t is the root of
+
+        F(t) = (a y_0 / (t + a^2))^2 + (b y_1 / (t + b^2))^2 - 1
+
+    which is convex and decreasing in [-b^2 + b y_1, -b^2 + |(a y_0, b y_1)|]
+    (see D. Eberly, Distance from a point to an ellipse, 2013). All the
+    points are iterated at once with a fixed number of Newton steps from
+    the left end of the bracket, which do not overshoot the root, and
+    bisection steps that shrink the bracket. The points on the axes are
+    solved in closed form.
+    """
+    y_0 = np.abs(x[0])
+    y_1 = np.abs(x[1])
+    a2, b2 = a * a, b * b
+    on_axis = (y_0 == 0.) | (y_1 == 0.)
+    ay_0 = a * np.where(on_axis, 1., y_0)
+    by_1 = b * np.where(on_axis, 1., y_1)
+
+    def f(t):
+        r_0 = ay_0 / (t + a2)
+        r_1 = by_1 / (t + b2)
+        return r_0, r_1, r_0**2 + r_1**2 - 1.
+
+    t_min = by_1 - b2
+    t_max = np.hypot(ay_0, by_1) - b2
+    for _ in range(nb_iterations):
+        r_0, r_1, f_min = f(t_min)
+        df = -2. * (r_0**2 / (t_min + a2) + r_1**2 / (t_min + b2))
+        t_newton = np.minimum(t_min - f_min / df, t_max)
+        t_mid = .5 * (t_min + t_max)
+        left = f(t_mid)[2] >= 0.
+        t_min = np.where(left, np.maximum(t_newton, t_mid), t_newton)
+        t_max = np.where(left, t_max, t_mid)
+    p_0 = a2 * y_0 / (t_min + a2)
+    p_1 = b2 * y_1 / (t_min + b2)
+
+    # on the major axis, the closest point is off the axis for the points
+    # between the centers of curvature of the vertices (0, b) and (0, -b)
+    c = a2 - b2
+    x_0 = np.minimum(a * y_0 / np.where(c > 0., c, 1.), 1.) * a
+    p_0 = np.where(y_1 == 0., np.where(c > 0., x_0, a), p_0)
+    p_1 = np.where(y_1 == 0., b * np.sqrt(1. - (p_0 / a)**2), p_1)
+    p_0 = np.where((y_0 == 0.) & (y_1 > 0.), 0., p_0)
+    p_1 = np.where((y_0 == 0.) & (y_1 > 0.), b, p_1)
+    return np.array([np.copysign(p_0, x[0]), np.copysign(p_1, x[1])])
+
+
 class Ellipse(Shape):
     """
     Define a ellipse shape using a and b parameters.
     (a, b) are the size of the great nd small radii.
+
+    The ellipse is centered at origin and rotated by orientation (radian).
+    The signed distance, its gradient and hessian, and the closest point
+    are computed for a single point (2), for points (2, N) or for a
+    meshgrid (2, n, m), see ellipse_closest_point.
     """
 
-    def __init__(self, a, b):
+    def __init__(self, a, b, origin=np.array([0., 0.]), orientation=0.):
         Shape.__init__(self)
-        self.origin = np.array([0., 0.])
+        self.origin = np.asarray(origin, dtype=float)
+        self.orientation = orientation
+        self._rotation = rotation_matrix_2d_radian(orientation)
         self._a = a
         self._b = b
         assert self._a >= self._b
 
+    def _ellipse_frame(self, x):
+        """ Coordinates of the points x in the frame of the ellipse """
+        return np.tensordot(self._rotation.T, (x.T - self.origin).T, axes=1)
+
+    def _world_frame(self, v):
+        """ Rotates the vectors v (2, ...) from the frame of the ellipse """
+        return np.tensordot(self._rotation, v, axes=1)
+
     def is_inside(self, x):
-        return ((x[0] / self._a)**2 + (x[1] / self._b)**2) < 1.
+        x_e = self._ellipse_frame(x)
+        return ((x_e[0] / self._a)**2 + (x_e[1] / self._b)**2) < 1.
+
+    def radius(self, x):
+        """ Distance from the center to the border in the direction of x """
+        x_e = self._ellipse_frame(x)
+        return vector_norm(x_e) / np.sqrt(
+            (x_e[0] / self._a)**2 + (x_e[1] / self._b)**2)
+
+    def closest_point(self, x):
+        p = ellipse_closest_point(self._ellipse_frame(x), self._a, self._b)
+        return (self._world_frame(p).T + self.origin).T
 
     def dist_from_border(self, x):
+        x_e = self._ellipse_frame(x)
+        d = vector_norm(x_e - ellipse_closest_point(x_e, self._a, self._b))
+        d = np.where(self.is_inside(x), -d, d)
+        return d.item() if x.ndim == 1 else d
+
+    def dist_gradient(self, x):
+        x_e = self._ellipse_frame(x)
+        x_p = x_e - ellipse_closest_point(x_e, self._a, self._b)
+        sign = np.where(self.is_inside(x), -1., 1.)
+        return self._world_frame(sign * x_p / vector_norm(x_p))
+
+    def dist_hessian(self, x):
         """
-            Iterative method described, Signed distance
-            http://www.am.ub.edu/~robert/Documents/ellipse.pdf
+        The hessian of the signed distance d is k / (1 + k d) t t^T,
+        where k is the curvature of the ellipse and t its tangent at the
+        closest point. The batch dimensions are last (2, 2, ...).
         """
-        x_abs = math.fabs(x[0])
-        y_abs = math.fabs(x[1])
-        a_m_b = self._a**2 - self._b**2
-        phi = 0.
-        for i in range(100):
-            phi_n = math.atan2(
-                a_m_b * math.sin(phi) + y_abs * self._b,
-                x_abs * self._a)
-            if math.fabs(phi_n - phi) < 1e-8:
-                break
-            phi = phi_n
-            if phi > math.pi / 2:
-                break
-        d = math.sqrt((x_abs - self._a * math.cos(phi))**2 +
-                      (y_abs - self._b * math.sin(phi))**2)
-        sign = -1 if self.is_inside(x) else 1.
-        return sign * d
+        x_e = self._ellipse_frame(x)
+        p = ellipse_closest_point(x_e, self._a, self._b)
+        d = vector_norm(x_e - p)
+        d = np.where(self.is_inside(x), -d, d)
+        n = np.array([p[0] / self._a**2, p[1] / self._b**2])
+        n_norm = vector_norm(n)
+        k = 1. / (self._a**2 * self._b**2 * n_norm**3)
+        t = self._world_frame(np.array([-n[1], n[0]]) / n_norm)
+        return k / (1. + k * d) * t[:, None] * t[None, :]
+
+    def bounding_circle(self):
+        return self.origin, self._a
 
     def sampled_points(self):
         points = []
         for theta in np.linspace(0, 2 * math.pi, self.nb_points):
-            x = self.origin[0] + self._a * np.cos(theta)
-            y = self.origin[1] + self._b * np.sin(theta)
-            points.append(np.array([x, y]))
+            p = np.array([self._a * np.cos(theta), self._b * np.sin(theta)])
+            points.append(self.origin + np.dot(self._rotation, p))
         return points
 
 
@@ -247,6 +347,18 @@ def sample_line(p_1, p_2, nb_points):
     return points
 
 
+def points_distance_hessian(x_center):
+    """
+    Hessians of the distance functions to points (see
+    point_distance_hessian), x_center are the vectors from the points
+    (d x p), returns an array of dimension d x d x p
+    """
+    d_inv = 1. / vector_norm(x_center)
+    n = x_center * d_inv
+    eye = np.eye(x_center.shape[0])[:, :, None]
+    return d_inv * (eye - n[:, None] * n[None, :])
+
+
 class Segment(Shape):
     """ A segment defined with an origin, length and orientaiton
         TODO :
@@ -276,6 +388,9 @@ class Segment(Shape):
     def p2(self):
         return self._p2
 
+    def bounding_circle(self):
+        return self.origin, .5 * self._length
+
     def length(self):
         return self._length
 
@@ -346,6 +461,50 @@ def segment_from_end_points(p1, p2):
         length=np.linalg.norm(p12))
 
 
+def box_distance(x_center, half_dim):
+    """
+    Signed distance to boxes centered at the origin, the coordinates are
+    on the first axis of x_center (d, ...), half_dim is broadcast.
+    """
+    d = np.abs(x_center) - half_dim
+    outside = vector_norm(np.maximum(d, 0.))
+    return outside + np.minimum(np.max(d, axis=0), 0.)
+
+
+def box_distance_gradient(x_center, half_dim):
+    """
+    Gradient of box_distance, outside it points away from the closest
+    point and inside towards the closest side.
+    """
+    d = np.abs(x_center) - half_dim
+    outside = np.maximum(d, 0.)
+    norm = vector_norm(outside)
+    axes = np.arange(d.shape[0]).reshape((-1,) + (1,) * (d.ndim - 1))
+    closest_side = (axes == np.argmax(d, axis=0)).astype(float)
+    sign = np.where(x_center < 0., -1., 1.)
+    return sign * np.where(
+        norm > 0., outside / np.where(norm > 0., norm, 1.), closest_side)
+
+
+def box_distance_hessian(x_center, half_dim):
+    """
+    Hessian of box_distance (d, d, ...), which is only non zero when the
+    closest point is a corner (or an edge in 3D): (P - g g^T) / |d|,
+    where P projects on the axes outside of the box. It is exactly zero
+    when the closest point is on a side.
+    """
+    d = np.abs(x_center) - half_dim
+    outside = np.maximum(d, 0.)
+    norm = vector_norm(outside)
+    corner = np.sum(d > 0., axis=0) > 1
+    norm_inv = np.where(corner, 1. / np.where(corner, norm, 1.), 0.)
+    g = np.where(x_center < 0., -1., 1.) * outside * norm_inv
+    n = d.shape[0]
+    eye = np.eye(n).reshape((n, n) + (1,) * (d.ndim - 1))
+    H = eye * (d > 0.)[:, None] - g[:, None] * g[None, :]
+    return H * norm_inv
+
+
 class Box(Shape):
     """
         An axis aligned box (hypercube) defined by
@@ -365,6 +524,9 @@ class Box(Shape):
         self.origin = origin
         self.dim = dim
 
+    def bounding_circle(self):
+        return self.origin, .5 * self.diag()
+
     def upper_corner(self):
         return self.origin + .5 * self.dim
 
@@ -441,13 +603,11 @@ class Box(Shape):
         return self.closest_segment(x)[0].dist_hessian(x)
 
     def dist_from_border(self, x):
-        d = [None] * 4
-        for i, segment in enumerate(self.segments()):
-            d[i] = segment.dist_from_border(x)
-        sign = np.where(Box.is_inside(self, x), -1., 1.)
-        minimum = np.min(np.array(d), axis=0)
-        d = sign * minimum
-        return np.asscalar(d) if d.size == 1 else d
+        """ Closed form signed distance (see box_distance) """
+        x_center = (x.T - self.origin).T
+        d = box_distance(
+            x_center, (.5 * self.dim).reshape((-1,) + (1,) * (x.ndim - 1)))
+        return d.item() if d.size == 1 else d
 
     def sampled_points(self):
         points = []
@@ -465,71 +625,29 @@ class AxisAlignedBox(Box):
         An axis aligned box (hypercube) defined by
             - origin    : its center
             - dim       : its extent
+
+        The signed distance, its gradient and hessian are computed in
+        closed form for a single point (d), for points (d, N) or for a
+        meshgrid (d, n, m). The gradients (d, ...) and hessians
+        (d, d, ...) keep the batch dimensions last.
     """
 
     def __init__(self,
                  origin=np.array([0., 0.]),
                  dim=np.array([1., 1.])):
         Box.__init__(self, origin, dim)
-        """
-        In all zones (1) the hessian of the signed distance
-        field is zero((n, n)) and gradient (0, 1) or (1, 0)
+        self.half_dim = 0.5 * self.dim
 
-                   v1 | (1) | v2
-                   ___|_____|___
-                  (1) | (1) | (1)
-                   ___|_____|___
-                   v4 | (1) | v3
+    def _box_frame(self, x):
+        """ Coordinates of the points x in the frame of the box """
+        return (x.T - self.origin).T
 
-        ZONES:
-                   1  |  5  |  2
-                   ___|_____|___
-                   8  |  9  |  6
-                   ___|_____|___
-                   4  |  7  |  3
-        """
-        self.half_dim = 0.5 * self.dim
-        self._v1 = np.array([-self.half_dim[0], self.half_dim[1]])
-        self._v2 = np.array([self.half_dim[0], self.half_dim[1]])
-        self._v3 = np.array([self.half_dim[0], -self.half_dim[1]])
-        self._v4 = np.array([-self.half_dim[0], -self.half_dim[1]])
-        self._verticies = [self._v1, self._v2, self._v3, self._v4]
-
-        self._switcher_distance = {
-            1: lambda x: vector_norm(x - self._v1),
-            2: lambda x: vector_norm(x - self._v2),
-            3: lambda x: vector_norm(x - self._v3),
-            4: lambda x: vector_norm(x - self._v4),
-            5: lambda x: x[1] - self._v1[1],
-            6: lambda x: x[0] - self._v3[0],
-            7: lambda x: self._v1[1] - x[1],
-            8: lambda x: self._v1[0] - x[0],
-            9: lambda x: -min(self.half_dim - np.absolute(x))
-        }
-
-        self._switcher_gradient = {
-            1: lambda x: point_distance_gradient(x, self._v1),
-            2: lambda x: point_distance_gradient(x, self._v2),
-            3: lambda x: point_distance_gradient(x, self._v3),
-            4: lambda x: point_distance_gradient(x, self._v4),
-            5: lambda x: np.array([0, 1]),
-            6: lambda x: np.array([1, 0]),
-            7: lambda x: np.array([0, -1]),
-            8: lambda x: np.array([-1, 0]),
-            9: lambda x: self._inside_gradient(x)
-        }
-
-        self._switcher_hessian = {
-            1: lambda x: point_distance_hessian(x, self._v1),
-            2: lambda x: point_distance_hessian(x, self._v2),
-            3: lambda x: point_distance_hessian(x, self._v3),
-            4: lambda x: point_distance_hessian(x, self._v4),
-            5: lambda x: np.zeros((self.origin.size, self.origin.size)),
-            6: lambda x: np.zeros((self.origin.size, self.origin.size)),
-            7: lambda x: np.zeros((self.origin.size, self.origin.size)),
-            8: lambda x: np.zeros((self.origin.size, self.origin.size)),
-            9: lambda x: np.zeros((self.origin.size, self.origin.size))
-        }
+    def _world_frame(self, v):
+        """ Rotates the vectors v (d, ...) from the frame of the box """
+        return v
+
+    def _half_dim(self, x):
+        return self.half_dim.reshape((-1,) + (1,) * (x.ndim - 1))
 
     def find_zone(self, x_center):
         """
@@ -538,69 +656,62 @@ class AxisAlignedBox(Box):
                    8  |  9  |  6
                    ___|_____|___
                    4  |  7  |  3
+
+        In zone 9 the box is the closest to one of its sides, in the
+        zones 5 to 8 to a side and in the zones 1 to 4 to a corner.
         """
-        # ----------------------------------------
-        # TOP ------------------------------------
-        if x_center[1] > self._v1[1]:
-
-            if x_center[0] < self._v1[0]:
-                return 1
-            elif x_center[0] > self._v2[0]:
-                return 2
-            else:
-                return 5
-        # ----------------------------------------
-        # BOTTOM ---------------------------------
-        elif x_center[1] < self._v3[1]:
-
-            if x_center[0] < self._v4[0]:
-                return 4
-            elif x_center[0] > self._v3[0]:
-                return 3
-            else:
-                return 7
-        # ----------------------------------------
-        # MIDDLE ---------------------------------
-        else:
-            if x_center[0] < self._v1[0]:
-                return 8
-            elif x_center[0] > self._v2[0]:
-                return 6
-            else:
-                return 9
+        h = self.half_dim
+        column = 0 if x_center[0] < -h[0] else 2 if x_center[0] > h[0] else 1
+        row = 0 if x_center[1] > h[1] else 2 if x_center[1] < -h[1] else 1
+        return [[1, 5, 2], [8, 9, 6], [4, 7, 3]][row][column]
 
     def is_inside(self, x):
-        x_center = (x.T - self.origin).T
-        return self.find_zone(x_center) == 9
-
-    def _inside_gradient(self, x):
-        d1 = np.fabs(self.half_dim[0] - x[0])
-        d2 = np.fabs(self.half_dim[1] - x[1])
-        d3 = np.fabs(-self.half_dim[0] - x[0])
-        d4 = np.fabs(-self.half_dim[1] - x[1])
-        switcher = {
-            0: np.array([1, 0]),
-            1: np.array([0, 1]),
-            2: np.array([-1, 0]),
-            3: np.array([0, -1])}
-        idx = np.argmin([d1, d2, d3, d4])
-        return switcher[idx]
+        x_center = self._box_frame(x)
+        return np.all(np.abs(x_center) <= self._half_dim(x), axis=0)
 
     def dist_from_border(self, x):
-        single = x.shape == (2,) or x.shape == (3,)
-        if not single:
-            # For now we can not use meshgrid for this class
-            return Box.dist_from_border(self, x)
-        x_center = (x.T - self.origin).T
-        return self._switcher_distance.get(self.find_zone(x_center))(x_center)
+        d = box_distance(self._box_frame(x), self._half_dim(x))
+        return d.item() if x.ndim == 1 else d
 
     def dist_gradient(self, x):
-        x_center = (x.T - self.origin).T
-        return self._switcher_gradient.get(self.find_zone(x_center))(x_center)
+        return self._world_frame(box_distance_gradient(
+            self._box_frame(x), self._half_dim(x)))
 
     def dist_hessian(self, x):
-        x_center = (x.T - self.origin).T
-        return self._switcher_hessian.get(self.find_zone(x_center))(x_center)
+        H = box_distance_hessian(self._box_frame(x), self._half_dim(x))
+        H = self._world_frame(np.swapaxes(self._world_frame(H), 0, 1))
+        return np.swapaxes(H, 0, 1)
+
+
+class OrientedBox(AxisAlignedBox):
+    """
+        A 2D box defined by
+            - origin        : its center
+            - dim           : its extent
+            - orientation   : its rotation around the center (radian)
+    """
+
+    def __init__(self,
+                 origin=np.array([0., 0.]),
+                 dim=np.array([1., 1.]),
+                 orientation=0.):
+        AxisAlignedBox.__init__(self, origin, dim)
+        self.orientation = orientation
+        self._rotation = rotation_matrix_2d_radian(orientation)
+
+    def _box_frame(self, x):
+        return np.tensordot(self._rotation.T, (x.T - self.origin).T, axes=1)
+
+    def _world_frame(self, v):
+        return np.tensordot(self._rotation, v, axes=1)
+
+    def verticies(self):
+        h = self.half_dim
+        corners = [[-h[0], -h[1]], [h[0], -h[1]], [h[0], h[1]], [-h[0], h[1]]]
+        return [self.origin + np.dot(self._rotation, c) for c in corners]
+
+    def closest_point(self, x):
+        return x - self.dist_from_border(x) * self.dist_gradient(x)
 
 
 def line_side(a, b, p):
@@ -635,12 +746,33 @@ def line_side(a, b, p):
     return m >= 0
 
 
+def winding_number(x, p1, p2):
+    """
+    Winding numbers around the points x (2, p) of the closed polyline
+    with edges [p1, p2] (k, 2), which are zero outside of the polygon.
+    The upward and downward crossings of a horizontal ray are counted for
+    all the edges at once (see D. Sunday, Inclusion of a point in a
+    polygon, 2001).
+    """
+    a = p1[:, :, None]
+    b = p2[:, :, None]
+    side = ((b[:, 0] - a[:, 0]) * (x[1] - a[:, 1]) -
+            (b[:, 1] - a[:, 1]) * (x[0] - a[:, 0]))
+    upward = (a[:, 1] <= x[1]) & (b[:, 1] > x[1]) & (side > 0.)
+    downward = (a[:, 1] > x[1]) & (b[:, 1] <= x[1]) & (side < 0.)
+    return np.sum(upward, axis=0) - np.sum(downward, axis=0)
+
+
 class Polygon(Shape):
     """
         A Polygon class
             - origin    : its center
             - verticies : stored and passed in a counter-clockwise order
-        TODO: TEST
+
+        The edges are stored as arrays of end points (k, 2) so that the
+        signed distance, its gradient and hessian, the closest point and
+        the inside test are computed for all the edges at once, for a
+        single point (2), for points (2, N) or for a meshgrid (2, n, m).
     """
 
     def __init__(self,
@@ -664,57 +796,85 @@ class Polygon(Shape):
             else:
                 v2 = self._verticies[0]
             self._edges[i] = segment_from_end_points(v1, v2)
+        self._p1 = np.array(self._verticies, dtype=float)
+        self._p2 = np.roll(self._p1, -1, axis=0)
 
     def verticies(self):
         return self._verticies
 
+    def bounding_circle(self):
+        center = np.mean(self._p1, axis=0)
+        return center, np.max(np.linalg.norm(self._p1 - center, axis=1))
+
+    def _closest_edges(self, x):
+        """
+        Returns for the points x (2, p) the index of the closest edge,
+        the position of the closest point along that edge in [0, 1], the
+        closest point (2, p) and the distance to the border
+        """
+        a = self._p1[:, :, None]
+        u = self._p2[:, :, None] - a
+        uu = np.maximum(np.sum(u * u, axis=1), np.finfo(float).tiny)
+        t = np.clip(np.sum(u * (x[None] - a), axis=1) / uu, 0., 1.)
+        d = np.linalg.norm(x[None] - (a + t[:, None] * u), axis=1)
+        i = np.argmin(d, axis=0)
+        points = np.arange(x.shape[1])
+        t = t[i, points]
+        p = self._p1[i].T + t * (self._p2[i] - self._p1[i]).T
+        return i, t, p, d[i, points]
+
+    def _sign(self, x):
+        return np.where(winding_number(x, self._p1, self._p2) != 0, -1., 1.)
+
     def is_inside(self, x):
         """
         Returns false if x is outside of the polygon
 
         Parameters
         ----------
-        x : numpy array with
-            arbitrary dimensions, 2d and 3d
-            or meshgrid data shape = (2 or 3, n, n)
+        x : numpy array 2d
+            or points shape = (2, N)
+            or meshgrid data shape = (2, n, n)
 
-        Computes inside by checking that the point is on the
-        "right side" of all edges of the polygon
+        Computes inside with the winding number of the polygon
+        around x, which also holds for non convex polygons
         """
-        single = x.shape == (2,) or x.shape == (3,)
-        shape = 1 if single else (x.shape[1], x.shape[2])
-        inside = np.full(shape, True)
-        for e in self._edges:
-            inside = np.where(line_side(e.p1(), e.p2(), x), inside, False)
-        return inside
+        inside = winding_number(_flat_points(x), self._p1, self._p2) != 0
+        return inside.reshape(x.shape[1:])
 
     def closest_edge(self, x):
-        min_dist = np.inf
-        closest_point = np.zeros(x.shape)
-        closest_edge = None
-        for edge in self._edges:
-            p = edge.closest_point(x)
-            d = np.linalg.norm(x - p)
-            if min_dist > d:
-                min_dist = d
-                closest_point = p.copy()
-                closest_edge = edge
-        return closest_edge, closest_point, min_dist
+        i, _, p, d = self._closest_edges(_flat_points(x))
+        return self._edges[i[0]], p[:, 0], d[0]
 
     def closest_point(self, x):
-        return self.closest_edge(x)[1]
+        return self._closest_edges(_flat_points(x))[2].reshape(x.shape)
+
+    def dist_gradient(self, x):
+        points = _flat_points(x)
+        _, _, p, d = self._closest_edges(points)
+        g = self._sign(points) * (points - p) / d
+        return g.reshape(x.shape)
 
     def dist_hessian(self, x):
-        return self.closest_edge(x)[0].dist_hessian(x)
+        """
+        The hessian is zero when the closest point is inside an edge,
+        and is the hessian of the distance to the vertex otherwise
+        (see point_distance_hessian). The batch dimensions are last
+        (2, 2, ...).
+        """
+        points = _flat_points(x)
+        _, t, p, d = self._closest_edges(points)
+        vertex = ((t == 0.) | (t == 1.)) & (d > 0.)
+        d_inv = np.where(vertex, 1. / np.where(vertex, d, 1.), 0.)
+        n = (points - p) * d_inv
+        H = np.eye(2)[:, :, None] - n[:, None] * n[None, :]
+        H *= self._sign(points) * d_inv
+        return H.reshape((2, 2) + x.shape[1:])
 
     def dist_from_border(self, x):
-        d = [None] * len(self._edges)
-        for i, edge in enumerate(self._edges):
-            d[i] = edge.dist_from_border(x)
-        sign = np.where(self.is_inside(x), -1., 1.)
-        minimum = np.min(np.array(d), axis=0)
-        d = sign * minimum
-        return np.asscalar(d) if d.size == 1 else d
+        points = _flat_points(x)
+        d = self._sign(points) * self._closest_edges(points)[3]
+        return d.item() if x.ndim == 1 else d.reshape(x.shape[1:])
 
     def sampled_points(self):
         nb_points_per_edge = max(2, int(self.nb_points / len(self._edges)))
@@ -837,6 +997,15 @@ class SignedDistanceWorkspaceMap(DifferentiableMap):
         [mindist, minid] = self._workspace.min_dist(x)
         return np.matrix(self._workspace.obstacles[minid].dist_hessian(x))
 
+    def jacobian_into(self, x, out):
+        out[0, :] = self._workspace.min_dist_gradient(x)
+        return out
+
+    def hessian_into(self, x, out):
+        [mindist, minid] = self._workspace.min_dist(x)
+        out[...] = self._workspace.obstacles[minid].dist_hessian(x)
+        return out
+
     def evaluate(self, x):
         """ Warning: this gradient is ill defined
             it has a kink when two objects are at the same distance """
@@ -845,13 +1014,318 @@ class SignedDistanceWorkspaceMap(DifferentiableMap):
         J_mindist = np.matrix(g_mindist).reshape((1, 2))
         return [mindist, J_mindist]
 
+    def evaluate_all(self, x, order=2):
+        """ The closest obstacle is only searched once """
+        [mindist, minid] = self._workspace.min_dist(x)
+        values = [mindist]
+        obstacle = self._workspace.obstacles[minid]
+        if order > 0:
+            values.append(
+                np.matrix(obstacle.dist_gradient(x)).reshape((1, 2)))
+        if order > 1:
+            values.append(np.matrix(obstacle.dist_hessian(x)))
+        return values
+
 
-def occupancy_map(nb_points, workspace):
+class SmoothSignedDistanceWorkspaceMap(DifferentiableMap):
+    """
+        Smooth min of the signed distances to the obstacles
+
+            f(x) = - t log[ sum_i exp(-d_i(x) / t) ]
+
+        which is the LogSumExp of the distances with gamma = -1 / t. The
+        temperature t sets the smoothness, f is below the min distance
+        by at most t log(nb_obstacles) and converges to it as t goes to
+        zero. Unlike the min distance, f has no kink where two obstacles
+        are at the same distance, its gradient is the softmin weighted
+        sum of the gradients of the distances and its hessian is
+
+            H = sum_i s_i H_i + J^T H_lse J
+
+        where J stacks the gradients of the distances. The distances,
+        gradients and hessians of all obstacles are computed in a single
+        vectorized pass over the packed obstacles (see PackedObstacles).
+        forward takes single points (2), points (2, N) or meshgrids
+        (2, n, m) and the *_batch functions take N x 2 arrays.
+    """
+
+    def __init__(self, workspace, temperature=.01):
+        self._workspace = workspace
+        self.temperature = temperature
+
+    def output_dimension(self):
+        return 1
+
+    def input_dimension(self):
+        return 2
+
+    def _log_sum_exp(self, n):
+        return LogSumExp(n, -1. / self.temperature)
+
+    def _evaluate(self, x, order):
+        """ Returns the values (p), the gradients (2, p) and the hessians
+            (2, 2, p) at the points x (2, p) up to order """
+        packed = self._workspace.packed_obstacles()
+        n, p = packed.nb_obstacles, x.shape[1]
+        f = self._log_sum_exp(n)
+        d = packed.distances(x).T
+        values = [f.forward_batch(d)[:, 0]]
+        if order > 0:
+            # one pair per obstacle and point (2, n, p)
+            x_pairs = np.tile(x, n)
+            ids = np.repeat(np.arange(n), p)
+            s = f.jacobian_batch(d)[:, 0, :].T
+            J = packed.gradients(x_pairs, ids).reshape(2, n, p)
+            g = np.sum(s * J, axis=1)
+            values.append(g)
+        if order > 1:
+            H = np.sum(s * packed.hessians(x_pairs, ids).reshape(
+                2, 2, n, p), axis=2)
+            # J^T H_lse J with H_lse = gamma (diag(s) - s s^T)
+            J_J = np.sum(s * J[:, None] * J[None, :], axis=2)
+            H -= (J_J - g[:, None] * g[None, :]) / self.temperature
+            values.append(H)
+        return values
+
+    def forward(self, x):
+        if not self._workspace.obstacles:
+            return np.full(x.shape[1:], np.inf)
+        d = self._evaluate(_flat_points(x), 0)[0]
+        return d.reshape(x.shape[1:])
+
+    def gradient(self, x):
+        """ Returns the gradients of dimension (2, ...) """
+        return self._evaluate(_flat_points(x), 1)[1].reshape(x.shape)
+
+    def jacobian(self, x):
+        return np.matrix(self.gradient(x)).reshape((1, 2))
+
+    def hessian(self, x):
+        return np.matrix(self._evaluate(_flat_points(x), 2)[2][:, :, 0])
+
+    def evaluate_all(self, x, order=2):
+        """ The obstacles are swept once """
+        values = self._evaluate(_flat_points(x), order)
+        values[0] = values[0].reshape(x.shape[1:])
+        if order > 0:
+            values[1] = np.matrix(values[1]).reshape((1, 2))
+        if order > 1:
+            values[2] = np.matrix(values[2][:, :, 0])
+        return values
+
+    def forward_batch(self, Q):
+        return self._evaluate(np.asarray(Q, dtype=float).T, 0)[0][:, None]
+
+    def jacobian_batch(self, Q):
+        g = self._evaluate(np.asarray(Q, dtype=float).T, 1)[1]
+        return g.T[:, None, :]
+
+    def hessian_batch(self, Q):
+        H = self._evaluate(np.asarray(Q, dtype=float).T, 2)[2]
+        return np.moveaxis(H, -1, 0)
+
+
+class GridSignedDistanceMap(DifferentiableMap):
+    """
+        Signed distance field of a workspace rasterized once on the cells
+        of a PixelMap and interpolated by a bicubic spline, the queries
+        cost the same whatever the number of obstacles. It can replace the
+        SignedDistanceWorkspaceMap of a static workspace, the spline is
+        twice differentiable so the hessian is continuous.
+
+        The spline is stored as one bicubic polynomial per square of
+        grid points, whose coefficients are computed from the values
+        and derivatives of the spline at the corners (bicubic Hermite
+        interpolation), so that the value, gradient and hessian at a
+        point are given by one small product.
+
+        The map is only valid inside the workspace box, forward takes
+        single points (2), points (2, N) or meshgrids (2, n, m) and the
+        *_batch functions take N x 2 arrays. The grid needs at least 4
+        cells along each side of the box.
+    """
+
+    # maps the values and derivatives at the corners of a unit square
+    # to the coefficients of the bicubic polynomial
+    _hermite = np.array([
+        [1., 0., 0., 0.],
+        [0., 0., 1., 0.],
+        [-3., 3., -2., -1.],
+        [2., -2., 1., 1.]])
+
+    def __init__(self, workspace, nb_points=100):
+        self._workspace = workspace
+        self.pixel_map = workspace.pixel_map(nb_points)
+        grid = workspace.box.stacked_meshgrid(nb_points)
+        self.x = grid[0, 0, :]
+        self.y = grid[1, :, 0]
+        if min(self.x.size, self.y.size) < 4:
+            raise ValueError(
+                "GridSignedDistanceMap needs at least 4 x 4 cells, "
+                "got {} x {}".format(self.x.size, self.y.size))
+        self.values = SignedDistanceWorkspaceMap(workspace)(grid).T
+        self._coefficients = self._bicubic_coefficients(
+            RectBivariateSpline(self.x, self.y, self.values))
+        h = self.pixel_map.resolution
+        self._grid_origin = np.array([[self.x[0]], [self.y[0]]])
+        self._last_cells = np.array([[self.x.size - 2], [self.y.size - 2]])
+        self._powers = np.array([[0, 1, 2, 3], [0, 0, 1, 2], [0, 0, 0, 1]])
+        self._monomials = np.array([
+            [1., 1., 1., 1.],
+            [0., 1. / h, 2. / h, 3. / h],
+            [0., 0., 2. / h**2, 6. / h**2]])
+
+    def _bicubic_coefficients(self, spline):
+        """ Returns the coefficients (n - 1, n - 1, 4, 4) of the
+            polynomials in the coordinates of the squares scaled to
+            [0, 1], the spline is a polynomial on each square """
+        h = self.pixel_map.resolution
+        f = spline(self.x, self.y)
+        f_x = h * spline(self.x, self.y, dx=1)
+        f_y = h * spline(self.x, self.y, dy=1)
+        f_xy = h**2 * spline(self.x, self.y, dx=1, dy=1)
+
+        def corners(v):
+            return np.moveaxis(np.array([[v[:-1, :-1], v[:-1, 1:]],
+                                         [v[1:, :-1], v[1:, 1:]]]),
+                               [0, 1], [2, 3])
+        F = np.concatenate([
+            np.concatenate([corners(f), corners(f_y)], axis=3),
+            np.concatenate([corners(f_x), corners(f_xy)], axis=3)], axis=2)
+        return np.matmul(np.matmul(self._hermite, F), self._hermite.T)
+
+    def output_dimension(self):
+        return 1
+
+    def input_dimension(self):
+        return 2
+
+    def _derivatives(self, x):
+        """ Returns the derivatives D (3, 3, ...) at the points x, where
+            D[a, b] is the derivative of order a in x and b in y """
+        points = np.asarray(x, dtype=float).reshape(2, -1)
+        s = (points - self._grid_origin) / self.pixel_map.resolution
+        cells = np.minimum(np.maximum(
+            np.floor(s).astype(int), 0), self._last_cells)
+        # monomials of the coordinates in the squares and their first
+        # and second derivatives (2, p, 3, 4)
+        U, V = self._monomials * (s - cells)[:, :, None, None]**self._powers
+        A = self._coefficients[cells[0], cells[1]]
+        D = np.matmul(U, np.matmul(A, np.swapaxes(V, 1, 2)))
+        return D.transpose(1, 2, 0).reshape((3, 3) + np.shape(x)[1:])
+
+    def _hessians(self, D):
+        return np.array([[D[2, 0], D[1, 1]], [D[1, 1], D[0, 2]]])
+
+    def forward(self, x):
+        return self._derivatives(x)[0, 0]
+
+    def gradient(self, x):
+        """ Returns the gradients of dimension (2, ...) """
+        D = self._derivatives(x)
+        return np.array([D[1, 0], D[0, 1]])
+
+    def jacobian(self, x):
+        return np.matrix(self.gradient(x)).reshape((1, 2))
+
+    def hessian(self, x):
+        return np.matrix(self._hessians(self._derivatives(x)))
+
+    def jacobian_into(self, x, out):
+        out[0, :] = self.gradient(x)
+        return out
+
+    def hessian_into(self, x, out):
+        out[...] = self._hessians(self._derivatives(x))
+        return out
+
+    def evaluate_all(self, x, order=2):
+        """ The value and derivatives are interpolated at once """
+        D = self._derivatives(x)
+        values = [D[0, 0]]
+        if order > 0:
+            values.append(np.matrix([[D[1, 0], D[0, 1]]]))
+        if order > 1:
+            values.append(np.matrix(self._hessians(D)))
+        return values
+
+    def forward_batch(self, Q):
+        return self.forward(np.asarray(Q).T)[:, None]
+
+    def jacobian_batch(self, Q):
+        return self.gradient(np.asarray(Q).T).T[:, None, :]
+
+    def hessian_batch(self, Q):
+        D = self._derivatives(np.asarray(Q).T)
+        return np.moveaxis(self._hessians(D), -1, 0)
+
+    def interpolation_error(self):
+        """
+        Compares the interpolated and the analytical signed distances at
+        the centers of the squares formed by the grid points, which are
+        the furthest from the data, returns the max and the root mean
+        square of the absolute errors.
+        """
+        X, Y = np.meshgrid(.5 * (self.x[1:] + self.x[:-1]),
+                           .5 * (self.y[1:] + self.y[:-1]))
+        points = np.array([X, Y])
+        errors = np.abs(self.forward(points) -
+                        self._workspace.min_dist(points)[0])
+        return [np.max(errors), np.sqrt(np.mean(errors**2))]
+
+
+def rasterize(f, box, nb_points=100, out=None, dtype=float,
+              tile_size=256, nb_threads=1):
+    """
+    Evaluates f at the cell centers of the grid over the box (see
+    EnvBox.cell_centers) and returns the values in an array indexed by
+    the cells along x and y, i.e., the transpose of the meshgrid layout.
+
+    f takes points (2, p) and returns values (p). The grid is processed
+    by tiles of tile_size x tile_size cells, which bounds the size of the
+    temporaries of f, and the tiles are evaluated by a pool of nb_threads
+    threads when nb_threads > 1. The output array can be preallocated,
+    e.g., as a np.memmap to rasterize maps larger than memory.
+    """
+    x, y = box.cell_centers(nb_points)
+    if out is None:
+        out = np.zeros((x.size, y.size), dtype=dtype)
+    assert out.shape == (x.size, y.size)
+
+    def evaluate(tile):
+        i, j = tile
+        X, Y = np.meshgrid(x[i:i + tile_size], y[j:j + tile_size],
+                           indexing="ij")
+        values = f(np.vstack([X.ravel(), Y.ravel()]))
+        out[i:i + tile_size, j:j + tile_size] = np.reshape(values, X.shape)
+
+    tiles = [(i, j) for i in range(0, x.size, tile_size)
+             for j in range(0, y.size, tile_size)]
+    if nb_threads > 1:
+        with ThreadPoolExecutor(nb_threads) as pool:
+            list(pool.map(evaluate, tiles))
+    else:
+        for tile in tiles:
+            evaluate(tile)
+    return out
+
+
+def signed_distance_map(nb_points, workspace, **kwargs):
+    """ Returns the signed distance field of the workspace on the grid
+        over its box, takes the options of rasterize """
+    def sdf(x):
+        if not workspace.obstacles:
+            return np.full(x.shape[1], np.inf)
+        return workspace.min_dist(x)[0]
+    return rasterize(sdf, workspace.box, nb_points, **kwargs)
+
+
+def occupancy_map(nb_points, workspace, **kwargs):
     """ Returns an occupancy map in the form of a square matrix
         using the signed distance field associated to a workspace object """
-    meshgrid = workspace.box.stacked_meshgrid(nb_points)
-    sdf = SignedDistanceWorkspaceMap(workspace)(meshgrid).T
-    return (sdf < 0).astype(float)
+    def occupancy(x):
+        return workspace.in_collision(x)
+    return rasterize(occupancy, workspace.box, nb_points, **kwargs)
 
 
 class EnvBox(Box):
@@ -885,23 +1359,31 @@ class EnvBox(Box):
         extent.y_max = box_extent[3]
         return extent
 
-    def meshgrid(self, nb_points=100):
+    def cell_centers(self, nb_points=100):
         """
-        Mesh grid definition matches the one in the PixelMap class
-            Note that it is only defined for squared boxes.
-            simply takes as input the number of points which corresponds
-            to the number of cells for the PixelMap
+        Coordinates of the cell centers along x and y, the cells are
+        squares of side dim[0] / nb_points, hence there are nb_points
+        cells along x and the number of cells along y follows the aspect
+        ratio of the box.
         """
-        assert self.dim[0] == self.dim[1]
         resolution = self.dim[0] / nb_points
+        nb_points_y = nb_cells(self.dim[1], resolution)
         extent = self.extent()
         x_min = extent.x_min + 0.5 * resolution
         x_max = extent.x_max - 0.5 * resolution
         y_min = extent.y_min + 0.5 * resolution
-        y_max = extent.y_max - 0.5 * resolution
+        y_max = y_min + (nb_points_y - 1) * resolution
         x = np.linspace(x_min, x_max, nb_points)
-        y = np.linspace(y_min, y_max, nb_points)
-        return np.meshgrid(x, y)
+        y = np.linspace(y_min, y_max, nb_points_y)
+        return x, y
+
+    def meshgrid(self, nb_points=100):
+        """
+        Mesh grid definition matches the one in the PixelMap class
+            simply takes as input the number of points which corresponds
+            to the number of cells for the PixelMap along x
+        """
+        return np.meshgrid(*self.cell_centers(nb_points))
 
     def stacked_meshgrid(self, nb_points=100):
         X, Y = self.meshgrid(nb_points)
@@ -931,49 +1413,379 @@ def box_from_limits(x_min, x_max, y_min, y_max):
 
 def pixelmap_from_box(nb_points, box):
     extent = box.extent()
-    assert extent.x() == extent.y()  # Test is square
     resolution = extent.x() / nb_points
     return PixelMap(resolution, extent)
 
 
+class ObstacleList(list):
+    """
+    List of obstacles that counts its modifications (version), so that
+    the packed obstacles of the workspace are kept in sync with it.
+
+    Note that the shapes are assumed not to be modified in place once
+    they are in the list, replace them instead (e.g., obstacles[i] = s).
+    """
+
+    def __init__(self, obstacles=()):
+        list.__init__(self, obstacles)
+        self.version = 0
+
+
+def _versioned(method):
+    @functools.wraps(method)
+    def modify(self, *args, **kwargs):
+        self.version += 1
+        return method(self, *args, **kwargs)
+    return modify
+
+
+for _name in ["__setitem__", "__delitem__", "__iadd__", "__imul__",
+              "append", "extend", "insert", "pop", "remove", "clear",
+              "sort", "reverse"]:
+    setattr(ObstacleList, _name, _versioned(getattr(list, _name)))
+
+
+def _flat_points(x):
+    """ Returns the points of a single point (d) or a meshgrid (d, n, m)
+        as an array of dimension d x nb_points """
+    return np.asarray(x, dtype=float).reshape(x.shape[0], -1)
+
+
+def circles_distance(x, centers, radii):
+    """ Signed distances to circles, x (d x p), centers (k x d)
+        radii (k), returns an array of dimension k x p """
+    return np.linalg.norm(
+        x[None] - centers[:, :, None], axis=1) - radii[:, None]
+
+
+def boxes_distance(x, centers, half_extents):
+    """ Signed distances to axis aligned boxes, x (d x p), centers and
+        half extents (k x d), returns an array of dimension k x p """
+    return box_distance(
+        x[:, None] - centers.T[:, :, None], half_extents.T[:, :, None])
+
+
+def segments_closest_point(x, p1, p2):
+    """ Closest points from x on the segments [p1, p2], the arrays are
+        broadcast and the coordinates are on the axis -2 (d x p) """
+    u = p2 - p1
+    uu = np.maximum(np.sum(u * u, axis=-2), np.finfo(float).tiny)
+    t = np.clip(np.sum(u * (x - p1), axis=-2) / uu, 0., 1.)
+    return p1 + t[..., None, :] * u
+
+
+def segments_distance(x, p1, p2):
+    """ Distances to segments, x (d x p), end points (k x d)
+        returns an array of dimension k x p """
+    p = segments_closest_point(x[None], p1[:, :, None], p2[:, :, None])
+    return np.linalg.norm(x[None] - p, axis=1)
+
+
+class PackedObstacles:
+    """
+    Struct of arrays representation of a list of obstacles.
+
+    The circles, the axis aligned boxes and the segments are stored in
+    contiguous arrays, so that the distances to all the obstacles of a
+    type are computed in a single broadcast. Other shapes are evaluated
+    one by one. The ids are the indices in the obstacle list.
+    """
+
+    def __init__(self, obstacles):
+        self.nb_obstacles = len(obstacles)
+        circles = [i for i, o in enumerate(obstacles) if type(o) is Circle]
+        boxes = [i for i, o in enumerate(obstacles)
+                 if type(o) in (Box, AxisAlignedBox)]
+        segments = [i for i, o in enumerate(obstacles) if type(o) is Segment]
+        packed = set(circles + boxes + segments)
+        self.others = [(i, o) for i, o in enumerate(obstacles)
+                       if i not in packed]
+
+        def stack(ids, f):
+            return np.array([f(obstacles[i]) for i in ids], dtype=float)
+        self.circle_ids = np.array(circles, dtype=int)
+        self.circle_centers = stack(circles, lambda o: o.origin)
+        self.circle_radii = stack(circles, lambda o: o.radius)
+        self.box_ids = np.array(boxes, dtype=int)
+        self.box_centers = stack(boxes, lambda o: o.origin)
+        self.box_half_extents = stack(boxes, lambda o: .5 * o.dim)
+        self.segment_ids = np.array(segments, dtype=int)
+        self.segment_p1 = stack(segments, lambda o: o.p1())
+        self.segment_p2 = stack(segments, lambda o: o.p2())
+
+    def distances(self, x):
+        """ Signed distances to all obstacles at a point (d) or a
+            meshgrid (d, n, m), the array is of dimension
+            nb_obstacles x n x m (or nb_obstacles for a single point) """
+        points = _flat_points(x)
+        d = np.empty((self.nb_obstacles, points.shape[1]))
+        if self.circle_ids.size:
+            d[self.circle_ids] = circles_distance(
+                points, self.circle_centers, self.circle_radii)
+        if self.box_ids.size:
+            d[self.box_ids] = boxes_distance(
+                points, self.box_centers, self.box_half_extents)
+        if self.segment_ids.size:
+            d[self.segment_ids] = segments_distance(
+                points, self.segment_p1, self.segment_p2)
+        for i, o in self.others:
+            d[i] = np.reshape(o.dist_from_border(x), points.shape[1])
+        return d.reshape((self.nb_obstacles,) + x.shape[1:])
+
+    def _lookup(self, type_ids, ids):
+        """ Returns the indices in the arrays of a type of the obstacles
+            ids and the mask of the ids that are of that type """
+        lookup = np.full(self.nb_obstacles, -1)
+        lookup[type_ids] = np.arange(type_ids.size)
+        k = lookup[ids]
+        return k, k >= 0
+
+    def pair_distances(self, x, ids):
+        """ Signed distances of the obstacles ids (p) at the points
+            x (d x p), returns an array of dimension p """
+        d = np.zeros(x.shape[1])
+        if self.circle_ids.size:
+            k, p = self._lookup(self.circle_ids, ids)
+            d[p] = vector_norm(x[:, p] - self.circle_centers[k[p]].T) - \
+                self.circle_radii[k[p]]
+        if self.box_ids.size:
+            k, p = self._lookup(self.box_ids, ids)
+            d[p] = box_distance(x[:, p] - self.box_centers[k[p]].T,
+                                self.box_half_extents[k[p]].T)
+        if self.segment_ids.size:
+            k, p = self._lookup(self.segment_ids, ids)
+            d[p] = vector_norm(x[:, p] - segments_closest_point(
+                x[:, p], self.segment_p1[k[p]].T, self.segment_p2[k[p]].T))
+        for i, o in self.others:
+            p = ids == i
+            if np.any(p):
+                d[p] = np.reshape(o.dist_from_border(x[:, p]), -1)
+        return d
+
+    def gradients(self, x, ids):
+        """ Gradients of the distance of the obstacles ids (p) at the
+            points x (d x p), returns an array of dimension d x p """
+        g = np.zeros(x.shape)
+        if self.circle_ids.size:
+            k, p = self._lookup(self.circle_ids, ids)
+            delta = x[:, p] - self.circle_centers[k[p]].T
+            g[:, p] = delta / vector_norm(delta)
+        if self.box_ids.size:
+            k, p = self._lookup(self.box_ids, ids)
+            g[:, p] = box_distance_gradient(
+                x[:, p] - self.box_centers[k[p]].T,
+                self.box_half_extents[k[p]].T)
+        if self.segment_ids.size:
+            k, p = self._lookup(self.segment_ids, ids)
+            delta = x[:, p] - segments_closest_point(
+                x[:, p], self.segment_p1[k[p]].T, self.segment_p2[k[p]].T)
+            g[:, p] = delta / vector_norm(delta)
+        for i, o in self.others:
+            for j in np.flatnonzero(ids == i):
+                g[:, j] = o.dist_gradient(x[:, j])
+        return g
+
+    def hessians(self, x, ids):
+        """ Hessians of the distance of the obstacles ids (p) at the
+            points x (d x p), returns an array of dimension d x d x p """
+        H = np.zeros((x.shape[0],) + x.shape)
+        if self.circle_ids.size:
+            k, p = self._lookup(self.circle_ids, ids)
+            H[:, :, p] = points_distance_hessian(
+                x[:, p] - self.circle_centers[k[p]].T)
+        if self.box_ids.size:
+            k, p = self._lookup(self.box_ids, ids)
+            H[:, :, p] = box_distance_hessian(
+                x[:, p] - self.box_centers[k[p]].T,
+                self.box_half_extents[k[p]].T)
+        if self.segment_ids.size:
+            # the hessian is zero when the closest point is inside
+            k, p = self._lookup(self.segment_ids, ids)
+            p1, p2 = self.segment_p1[k[p]].T, self.segment_p2[k[p]].T
+            delta = x[:, p] - segments_closest_point(x[:, p], p1, p2)
+            u = p2 - p1
+            t = np.sum(u * (x[:, p] - p1), axis=0) / np.sum(u * u, axis=0)
+            H[:, :, p] = points_distance_hessian(delta) * (
+                (t <= 0.) | (t >= 1.))
+        for i, o in self.others:
+            for j in np.flatnonzero(ids == i):
+                H[:, :, j] = o.dist_hessian(x[:, j])
+        return H
+
+
+class ObstacleIndex:
+    """
+    Spatial index of a list of obstacles for the queries of points far
+    from most obstacles, e.g., in large generated workspaces.
+
+    The obstacles are bounded by circles (see Shape.bounding_circle)
+    whose centers are stored in a KD-tree. The distance to an obstacle is
+    at least the distance to the center of its circle minus its radius,
+    so that the obstacles that can not be closer than a bound are pruned
+    before their distances are computed (see PackedObstacles). The
+    obstacles without bounding circle are never pruned. The queries take
+    points (d x p), they pay off for batches of points (e.g., meshgrids)
+    in workspaces with many obstacles.
+    """
+
+    def __init__(self, obstacles, packed=None, nb_neighbors=4):
+        self.packed = PackedObstacles(obstacles) if packed is None else packed
+        self.nb_obstacles = len(obstacles)
+        self.nb_neighbors = nb_neighbors
+        circles = [o.bounding_circle() for o in obstacles]
+        self.bounded_ids = np.array(
+            [i for i, c in enumerate(circles) if c is not None], dtype=int)
+        self.unbounded_ids = np.array(
+            [i for i, c in enumerate(circles) if c is None], dtype=int)
+        self.centers = np.array(
+            [circles[i][0] for i in self.bounded_ids], dtype=float)
+        self.radii = np.array(
+            [circles[i][1] for i in self.bounded_ids], dtype=float)
+        self.max_radius = np.max(self.radii) if self.radii.size else 0.
+        self.tree = cKDTree(self.centers) if self.radii.size else None
+
+    def _unbounded_pairs(self, nb_points):
+        points = np.repeat(np.arange(nb_points), self.unbounded_ids.size)
+        ids = np.tile(self.unbounded_ids, nb_points)
+        return points, ids
+
+    def _candidates(self, x, bound):
+        """ Returns the pairs of point indices and obstacle ids whose
+            distances are possibly lower or equal to the bounds (p) """
+        points, ids = self._unbounded_pairs(x.shape[1])
+        if self.tree is None:
+            return points, ids
+        balls = self.tree.query_ball_point(
+            x.T, np.maximum(bound + self.max_radius, 0.))
+        k = np.array([j for ball in balls for j in ball], dtype=int)
+        p = np.repeat(np.arange(x.shape[1]), [len(b) for b in balls])
+        lower = vector_norm(x[:, p] - self.centers[k].T) - self.radii[k]
+        keep = lower <= bound[p]
+        return (np.concatenate([points, p[keep]]),
+                np.concatenate([ids, self.bounded_ids[k[keep]]]))
+
+    def min_dist(self, x):
+        """ Smallest signed distance and index of the closest obstacle,
+            the first one in case of ties, returns two arrays (p) """
+        nb_points = x.shape[1]
+        points, ids = self._unbounded_pairs(nb_points)
+        if self.tree is not None:
+            # the closest centers give an upper bound on the distance
+            k = min(self.nb_neighbors, self.radii.size)
+            neighbors = self.tree.query(x.T, k)[1].reshape(nb_points, k)
+            points = np.concatenate(
+                [points, np.repeat(np.arange(nb_points), k)])
+            ids = np.concatenate(
+                [ids, self.bounded_ids[neighbors.flatten()]])
+        d = self.packed.pair_distances(x[:, points], ids)
+        bound = np.full(nb_points, np.inf)
+        np.minimum.at(bound, points, d)
+        candidates = self._candidates(x, bound)
+        d = np.concatenate([d, self.packed.pair_distances(
+            x[:, candidates[0]], candidates[1])])
+        points = np.concatenate([points, candidates[0]])
+        ids = np.concatenate([ids, candidates[1]])
+        order = np.lexsort((ids, d, points))
+        first = order[np.unique(points[order], return_index=True)[1]]
+        return d[first], ids[first]
+
+    def close_obstacles(self, x, threshold):
+        """ Returns the pairs of point indices and obstacle ids whose
+            signed distances are below the threshold and the distances """
+        points, ids = self._candidates(x, np.full(x.shape[1], threshold))
+        d = self.packed.pair_distances(x[:, points], ids)
+        below = d < threshold
+        return points[below], ids[below], d[below]
+
+    def in_collision(self, x):
+        """ Returns an array of booleans (p) """
+        in_collision = np.full(x.shape[1], False)
+        in_collision[self.close_obstacles(x, 0.)[0]] = True
+        return in_collision
+
+
 class Workspace:
     """
        Contains obstacles.
+
+       The obstacles are also packed in arrays (see PackedObstacles),
+       which are rebuilt when the obstacle list is modified. When
+       spatial_index is set, the distance and collision queries prune
+       the obstacles far from the points (see ObstacleIndex), which is
+       also rebuilt lazily.
     """
 
-    def __init__(self, box=EnvBox()):
+    def __init__(self, box=EnvBox(), spatial_index=False):
         self.box = box
+        self.spatial_index = spatial_index
         self.obstacles = []
 
-    def in_collision(self, pt):
-        for obst in self.obstacles:
-            if obst.dist_from_border(pt) < 0.:
-                return True
-        return False
+    @property
+    def obstacles(self):
+        return self._obstacles
+
+    @obstacles.setter
+    def obstacles(self, obstacles):
+        self._obstacles = ObstacleList(obstacles)
+        self._packed = None
+        self._index = None
+
+    def packed_obstacles(self):
+        """ Returns the packed obstacles in sync with the obstacle list """
+        if (self._packed is None or
+                self._packed_version != self._obstacles.version):
+            self._packed = PackedObstacles(self._obstacles)
+            self._packed_version = self._obstacles.version
+        return self._packed
+
+    def obstacle_index(self):
+        """ Returns the spatial index in sync with the obstacle list """
+        if (self._index is None or
+                self._index_version != self._obstacles.version):
+            self._index = ObstacleIndex(
+                self._obstacles, self.packed_obstacles())
+            self._index_version = self._obstacles.version
+        return self._index
 
-    def min_dist(self, pt):
-        if pt.shape == (2,):
-            d_m = float("inf")
-            i_m = -1
+    def in_collision(self, pt):
+        """ Works for single points and meshgrids (d, n, m) """
+        if not self.obstacles:
+            return False if pt.ndim == 1 else np.full(pt.shape[1:], False)
+        if self.spatial_index:
+            in_collision = self.obstacle_index().in_collision(
+                _flat_points(pt)).reshape(pt.shape[1:])
         else:
-            """ Here we declare special variable for element wise querry """
-            shape = (pt.shape[1], pt.shape[2])
-            d_m = np.full(shape, np.inf)
-            i_m = np.full(shape, -1)
-
-        for i, obst in enumerate(self.obstacles):
-            d = obst.dist_from_border(pt)
-            closer_to_i = d < d_m
-            d_m = np.where(closer_to_i, d, d_m)
-            i_m = np.where(closer_to_i, i, i_m)
+            in_collision = np.any(
+                self.packed_obstacles().distances(pt) < 0., axis=0)
+        return bool(in_collision) if pt.ndim == 1 else in_collision
 
+    def min_dist(self, pt):
+        """ Returns the smallest signed distance to the obstacles and the
+            index of the closest obstacle, the first one in case of ties.
+            Works for single points and meshgrids (d, n, m) """
+        if not self.obstacles:
+            if pt.ndim == 1:
+                return [float("inf"), -1]
+            return [np.full(pt.shape[1:], np.inf), np.full(pt.shape[1:], -1)]
+        if self.spatial_index:
+            d_m, i_m = self.obstacle_index().min_dist(_flat_points(pt))
+            d_m = d_m.reshape(pt.shape[1:])
+            i_m = i_m[0] if pt.ndim == 1 else i_m.reshape(pt.shape[1:])
+            return [d_m, i_m]
+        d = self.packed_obstacles().distances(pt)
+        i_m = np.argmin(d, axis=0)
+        d_m = np.take_along_axis(d, np.expand_dims(i_m, 0), axis=0)[0]
         return [d_m, i_m]
 
     def min_dist_gradient(self, pt):
         """ Warning: this gradient is ill defined
             it has a kink when two objects are at the same distance """
         [d_m, i_m] = self.min_dist(pt)
-        return self.obstacles[i_m].dist_gradient(pt)
+        if pt.ndim == 1:
+            return self.obstacles[i_m].dist_gradient(pt)
+        g = self.packed_obstacles().gradients(
+            _flat_points(pt), np.asarray(i_m).flatten())
+        return g.reshape(pt.shape)
 
     def add_circle(self, origin=None, radius=None):
         if origin is None and radius is None:
@@ -985,7 +1797,7 @@ class Workspace:
         if origin is None and length is None:
             self.obstacles.append(Segment())
         else:
-            self.obstacles.append(Segment(origin, length))
+            self.obstacles.append(Segment(origin=origin, length=length))
 
     def all_points(self):
         points = []
@@ -995,7 +1807,6 @@ class Workspace:
 
     def pixel_map(self, nb_points=100):
         extent = self.box.extent()
-        assert extent.x() == extent.y()
         resolution = extent.x() / nb_points
         return PixelMap(resolution, extent)
 
@@ -1051,3 +1862,57 @@ def sample_collision_free(workspace, margin=0.):
         p = workspace.box.sample_uniform()
         if margin < workspace.min_dist(p)[0]:
             return p
+
+
+def halton_sequence(nb_points, dim=2, start=0):
+    """ Points start + 1, ..., start + nb_points of the Halton sequence
+        in [0, 1]^dim (bases 2, 3, 5, ...) as an array (nb_points, dim) """
+    bases = [2, 3, 5, 7, 11, 13][:dim]
+    indices = np.arange(start + 1, start + nb_points + 1)
+    points = np.zeros((nb_points, len(bases)))
+    for k, base in enumerate(bases):
+        i = indices.copy()
+        f = 1.
+        while np.any(i > 0):
+            f /= base
+            points[:, k] += f * (i % base)
+            i //= base
+    return points
+
+
+def sample_collision_free_points(
+        workspace, nb_samples, margin=0.,
+        low_discrepancy=False, max_blocks=100):
+    """
+    Samples nb_samples points with a distance to the obstacles larger
+    than the margin, returns an array (k, 2).
+
+    The candidates are drawn in blocks, whose size follows the observed
+    acceptance rate, and the distances of a block are evaluated at once.
+    At most max_blocks blocks are drawn, hence fewer points (k <
+    nb_samples) are returned when the free space is too small. When
+    low_discrepancy is set the candidates follow a Halton sequence with a
+    random shift (modulo 1) instead of independent uniform draws.
+    """
+    box = workspace.box
+    shift = np.random.random(2)
+    samples = []
+    nb_found = 0
+    nb_drawn = 0
+    for _ in range(max_blocks):
+        remaining = nb_samples - nb_found
+        if remaining <= 0:
+            break
+        rate = (nb_found + 1.) / (nb_drawn + 1.)
+        nb_candidates = min(int(np.ceil(1.5 * remaining / rate)),
+                            100 * remaining)
+        if low_discrepancy:
+            u = np.mod(halton_sequence(nb_candidates, 2, nb_drawn) + shift, 1)
+        else:
+            u = np.random.random((nb_candidates, 2))
+        candidates = box.dim * u + box.lower_corner()
+        free = workspace.min_dist(candidates.T)[0] > margin
+        samples.append(candidates[free][:remaining])
+        nb_found += samples[-1].shape[0]
+        nb_drawn += nb_candidates
+    return np.vstack(samples) if samples else np.zeros((0, 2))
@@ -56,8 +56,7 @@ def obsatcle_potential(workspace):
 def optimize(path, workspace, costmap, verbose=False):
     T = len(path) - 1
     trajectory = Trajectory(T, 2)
-    for i, p in enumerate(path):
-        trajectory.configuration(i)[:] = path[i]
+    trajectory.configurations[:len(path)] = path
 
     optimizer = MotionOptimization2DCostMap(
         T=T,
@@ -101,15 +100,12 @@ def compute_demonstration(
     path = sample_path(workspace, graph, nb_points, no_linear_interpolation)
     if path is None:
         return None
-    traj = [None] * len(path)
     trajectory = ContinuousTrajectory(len(path) - 1, 2)
-    for i, p in enumerate(path):
-        traj[i] = pixel_map.grid_to_world(np.array(p))
-        trajectory.configuration(i)[:] = traj[i]
+    trajectory.configurations[:len(path)] = pixel_map.grid_to_world(
+        np.array(path))
 
-    interpolated_traj = [None] * TRAJ_LENGTH
-    for i, s in enumerate(np.linspace(0, 1, TRAJ_LENGTH)):
-        interpolated_traj[i] = trajectory.configuration_at_parameter(s)
+    interpolated_traj = trajectory.configurations_at_parameters(
+        np.linspace(0, 1, TRAJ_LENGTH))
 
     optimized_trajectory = optimize(
         interpolated_traj, workspace, None, verbose)
@@ -121,10 +117,6 @@ def compute_demonstration(
         print("Warning: has collision !!!")
         return None
 
-    result = [None] * TRAJ_LENGTH
-    for i in range(len(result)):
-        result[i] = optimized_trajectory.configuration(i)
-
     return optimized_trajectory
 
 
@@ -52,13 +52,14 @@ def chomp_obstacle_cost(min_dist, epsilon):
         If min_dist < 0, cost = -min_dist + epsilon/2
         If min_dist >= 0 && min_dist < epsilon, have a different cost
         If min_dist >= epsilon, cost = 0
+        min_dist can be a single distance or an array of distances
     """
-    cost = 0.
-    if min_dist < 0:
-        cost = - min_dist + 0.5 * epsilon
-    elif min_dist <= epsilon:
-        cost = (1. / (2 * epsilon)) * ((min_dist - epsilon) ** 2)
-    return cost
+    min_dist = np.asarray(min_dist, dtype=float)
+    cost = np.where(
+        min_dist < 0., - min_dist + 0.5 * epsilon,
+        np.where(min_dist <= epsilon,
+                 (1. / (2 * epsilon)) * ((min_dist - epsilon) ** 2), 0.))
+    return cost if cost.ndim else float(cost)
 
 
 def grids(workspace, grid_to_world, epsilon):
@@ -72,26 +73,24 @@ def grids(workspace, grid_to_world, epsilon):
     m = grid_to_world.shape[0]
     assert grid_to_world.shape[1] == m
 
-    costs = np.zeros((m, m))
-    meshgrid = workspace.box.stacked_meshgrid(m)
-    sdf = SignedDistanceWorkspaceMap(workspace)(meshgrid).T
+    sdf = signed_distance_map(m, workspace)
     occupancy = sdf <= 0.
+    costs = chomp_obstacle_cost(sdf, epsilon)
     test_grids = False
     if test_grids:
         # return [None, None, None]
         occupancy_tmp = np.zeros((m, m))
         sdf_tmp = np.zeros((m, m))
+        costs_tmp = np.zeros((m, m))
         for i, j in itertools.product(range(m), range(m)):
             [min_dist, obstacle_id] = workspace.min_dist(grid_to_world[i, j])
             sdf_tmp[i, j] = min_dist
             occupancy_tmp[i, j] = min_dist <= 0.
-            costs[i, j] = chomp_obstacle_cost(min_dist, epsilon)
+            costs_tmp[i, j] = chomp_obstacle_cost(min_dist, epsilon)
 
         assert_allclose(sdf_tmp, sdf)
         assert_allclose(occupancy_tmp, occupancy)
-    else:
-        for i, j in itertools.product(range(m), range(m)):
-            costs[i, j] = chomp_obstacle_cost(sdf[i, j], epsilon)
+        assert_allclose(costs_tmp, costs)
 
     return [occupancy, sdf, costs]
 
@@ -79,14 +79,12 @@ def sample_path(
     half_diag = workspace.box.diag() / 2.
     path = None
     resample = False
-    for _ in range(100):
-        s_w = sample_collision_free(workspace, MARGIN / 2)
-        t_w = sample_collision_free(workspace, MARGIN / 2)
-        if no_linear_interpolation:
-            if np.linalg.norm(s_w - t_w) < half_diag:
-                continue
-            if not collision_check_linear_interpolation(workspace, s_w, t_w):
-                continue
+    if no_linear_interpolation:
+        starts, goals = sample_start_goal_pairs(
+            workspace, 100, MARGIN / 2, half_diag, line_of_sight=False)
+    else:
+        starts, goals = sample_start_goal_pairs(workspace, 100, MARGIN / 2)
+    for s_w, t_w in zip(starts, goals):
         s = pixel_map.world_to_grid(s_w)
         t = pixel_map.world_to_grid(t_w)
         try:
@@ -153,11 +153,14 @@ class KinematicTrajectoryFollowingLQR:
         i = int(t / self._dt)  # index on trajectory
         assert i <= self._trajectory.T()
 
-        x_d = self._trajectory.state(i, self._dt).reshape(self._n * 2, 1)
-        a_t = self._trajectory.acceleration(i, self._dt)
-        e_t = x_t - x_d
-        u_t = -self._K_matrix * e_t + a_t.reshape(self._n, 1)
-        return u_t
+        return self._feedback(
+            self._trajectory.state(i, self._dt),
+            self._trajectory.acceleration(i, self._dt), x_t)
+
+    def _feedback(self, x_d, a_d, x_t):
+        """ u = -K (x_t - x_d) + a_d """
+        e_t = x_t - x_d.reshape(self._n * 2, 1)
+        return -self._K_matrix * e_t + a_d.reshape(self._n, 1)
 
     def integrate(self, q_init, start_time_step=0):
         """
@@ -171,14 +174,19 @@ class KinematicTrajectoryFollowingLQR:
         T = self._trajectory.T()
         trajectory = Trajectory(T=T, n=q_init.size)
         x_t = np.hstack([q_init, np.zeros(q_init.size)])
+
+        # states and accelerations along the reference trajectory
+        x_d = self._trajectory.states(dt)
+        a_d = self._trajectory.accelerations(dt)
         for i in range(start_time_step, T + 1):
 
             # 1) compute acceleration
-            u_t = self.policy(i * dt, x_t.reshape(q_init.size * 2, 1))
+            u_t = self._feedback(
+                x_d[i], a_d[i], x_t.reshape(q_init.size * 2, 1))
             a_t = np.array(u_t).reshape((q_init.size, ))
             v_t = x_t[q_init.size:]
             q_t = x_t[:q_init.size]
-            trajectory.configuration(i)[:] = q_t
+            trajectory.configurations[i] = q_t
 
             # 2) integrate forward and update state
             q_t1 = q_t + v_t * dt + a_t * (dt ** 2)
@@ -80,6 +80,44 @@ class SquaredNormDerivative(DifferentiableMap):
     def hessian(self, clique):
         return self._derivative.a().T * self._derivative.a()
 
+    def jacobian_into(self, clique, out):
+        d = self._derivative.forward_into(
+            clique, self._buffer("d", (self._derivative.output_dimension(),)))
+        np.matmul(d.reshape(1, d.size), np.asarray(self._derivative.a()),
+                  out=out)
+        return out
+
+    def hessian_into(self, clique, out):
+        a = np.asarray(self._derivative.a())
+        np.matmul(a.T, a, out=out)
+        return out
+
+    def expression(self):
+        """ Equivalent tree of elementary maps (see compile_map) """
+        return Pullback(self._sq_norm, self._derivative)
+
+    def evaluate_all(self, clique, order=2):
+        d = self._derivative(clique)
+        a = self._derivative.a()
+        values = [self._sq_norm(d), d * a]
+        if order > 1:
+            values.append(a.T * a)
+        return values[:order + 1]
+
+    def forward_batch(self, Q):
+        return self.expression().forward_batch(Q)
+
+    def jacobian_batch(self, Q):
+        return self.expression().jacobian_batch(Q)
+
+    def hessian_batch(self, Q):
+        return self.expression().hessian_batch(Q)
+
+    def forward_record(self, clique):
+        d, backward = self._derivative.forward_record(clique)
+        return (self._sq_norm(d),
+                lambda w: backward(np.asarray(w).reshape(1)[0] * d))
+
 
 class SquaredNormVelocity(SquaredNormDerivative):
 
@@ -219,7 +257,7 @@ class BoundBarrier(DifferentiableMap):
             u_dist = self._v_upper[i] - x_i
             if l_dist < self._margin or u_dist < self._margin:
                 return np.matrix(np.zeros((
-                    self.output_dimension(), self.output_dimension())))
+                    self.input_dimension(), self.input_dimension())))
             H[i, i] += self._alpha / (l_dist ** 2)
             H[i, i] += self._alpha / (u_dist ** 2)
         return H
@@ -262,6 +300,22 @@ class SimplePotential2D(DifferentiableMap):
         J_sdf_sq = J_sdf.T * J_sdf
         return rho * (self._alpha**2 * J_sdf_sq - self._alpha * H_sdf)
 
+    def evaluate_all(self, x, order=2):
+        """ The signed distance field is queried once """
+        values_sdf = self._sdf.evaluate_all(x, order)
+        d_obs = values_sdf[0] - self._margin
+        rho = self._rho_scaling * np.exp(-self._alpha * d_obs)
+        values = [rho]
+        if order > 0:
+            J_sdf = np.matrix(values_sdf[1])
+            values.append(-self._alpha * rho * J_sdf)
+        if order > 1:
+            J_sdf_sq = J_sdf.T * J_sdf
+            H_sdf = values_sdf[2]
+            values.append(
+                rho * (self._alpha**2 * J_sdf_sq - self._alpha * H_sdf))
+        return values
+
 
 class CostGridPotential2D(SimplePotential2D):
 
@@ -277,6 +331,11 @@ class CostGridPotential2D(SimplePotential2D):
         d_obs = self._sdf.forward(x) - self._margin
         return self._rho_scaling * np.exp(-self._alpha * d_obs) + self._offset
 
+    def evaluate_all(self, x, order=2):
+        values = SimplePotential2D.evaluate_all(self, x, order)
+        values[0] += self._offset
+        return values
+
 
 class ObstaclePotential2D(DifferentiableMap):
 
@@ -314,3 +373,21 @@ class ObstaclePotential2D(DifferentiableMap):
     def hessian(self, x):
         J_phi = self.jacobian(x)
         return J_phi.T * J_phi
+
+    def evaluate_all(self, x, order=2):
+        """ The signed distance field is queried once """
+        values_sdf = self._sdf.evaluate_all(x, min(order, 1))
+        rho = np.exp(-self._alpha * values_sdf[0])
+        y = np.zeros(3)
+        y[0] = self._rho_scaling * rho
+        y[1] = x[0]
+        y[2] = x[1]
+        values = [y]
+        if order > 0:
+            J = np.matrix(np.zeros((3, 2)))
+            J[0, :] = -self._alpha * self._rho_scaling * rho * values_sdf[1]
+            J[1:3, :] = np.matrix(np.eye(2, 2))
+            values.append(J)
+        if order > 1:
+            values.append(J.T * J)
+        return values
@@ -21,6 +21,7 @@ from .__init__ import *
 from motion.trajectory import *
 from motion.cost_terms import *
 from optimization.optimization import *
+from optimization.algorithms import banded_newton
 from geometry.differentiable_geometry import *
 from geometry.workspace import *
 from scipy import optimize
@@ -338,8 +339,12 @@ class MotionOptimization2DCostMap:
 
         xi = trajectory.active_segment()
 
+        # the value and gradient are evaluated in one traversal and the
+        # repeated calls at the same iterate are served by the cache
+        objective = CachedMap(self.objective)
+
         if optimizer is "natural_gradient":
-            optimizer = NaturalGradientDescent(self.objective, self.metric)
+            optimizer = NaturalGradientDescent(objective, self.metric)
             optimizer.set_eta(self._eta)
 
             dist = float("inf")
@@ -360,9 +365,9 @@ class MotionOptimization2DCostMap:
             res = optimize.minimize(
                 x0=np.array(xi),
                 method='Newton-CG',
-                fun=self.objective.forward,
-                jac=self.objective.gradient,
-                hess=self.objective.hessian,
+                fun=objective.forward,
+                jac=objective.gradient,
+                hessp=objective.hessian_vector_product,
                 options={'maxiter': nb_steps, 'disp': self.verbose}
             )
             trajectory.active_segment()[:] = res.x
@@ -372,6 +377,14 @@ class MotionOptimization2DCostMap:
                 trajectory.final_configuration() - self.q_goal)
             if self.verbose:
                 print(("gradient norm : ", np.linalg.norm(res.jac)))
+        elif optimizer == "banded_newton":
+            res = banded_newton(
+                self.objective, xi, maxiter=nb_steps, verbose=self.verbose)
+            trajectory.active_segment()[:] = res.x
+            gradient = res.jac
+            delta = res.jac
+            dist = np.linalg.norm(
+                trajectory.final_configuration() - self.q_goal)
         else:
             raise ValueError
 
@@ -19,8 +19,10 @@
 
 from .__init__ import *
 from geometry.differentiable_geometry import *
+from geometry.map_compiler import *
 from geometry.utils import *
 from scipy.interpolate import interp1d
+from scipy import sparse
 
 
 class FunctionNetwork(DifferentiableMap):
@@ -54,6 +56,13 @@ class CliquesFunctionNetwork(FunctionNetwork):
         Base class to implement a function network
         It allows to register functions and evaluates
         f(x_{i-1}, x_i, x_{i+1}) = \sum_i f_i(x_{i-1}, x_i, x_{i+1})
+
+        The functions registered for all cliques are evaluated once on
+        the batch of all cliques (see forward_batch), which are the rows
+        of a strided view of the input (see all_cliques). Their clique
+        gradients and hessians are then added to the full ones with
+        numpy. Only the clique specific functions are evaluated in a
+        loop over the cliques.
     """
 
     def __init__(self, input_dimension, clique_element_dim):
@@ -63,6 +72,7 @@ class CliquesFunctionNetwork(FunctionNetwork):
         self._clique_element_dim = clique_element_dim
         self._clique_dim = self._nb_clique_elements * clique_element_dim
         self._nb_cliques = int(self._input_size / clique_element_dim - 2)
+        self._shared_functions = []
         self._functions = self._nb_cliques * [None]
         for i in range(self._nb_cliques):
             self._functions[i] = []
@@ -78,11 +88,12 @@ class CliquesFunctionNetwork(FunctionNetwork):
 
     def forward(self, x):
         """ We call over all subfunctions in each clique"""
+        X = self.all_cliques(x)
         value = 0.
-        for t, x_t in enumerate(self.all_cliques(x)):
-            # print("x_c[{}] : {}".format(t, x_t))
-            for f in self._functions[t]:
-                value += f.forward(x_t)
+        for f in self._shared_functions:
+            value += np.sum(f.forward_batch(X))
+        for t, x_t, f in self._clique_functions(X):
+            value += f.forward(x_t)
         return value
 
     def jacobian(self, x):
@@ -99,12 +110,7 @@ class CliquesFunctionNetwork(FunctionNetwork):
         J = np.matrix(np.zeros((
             self.output_dimension(),
             self.input_dimension())))
-        for t, x_t in enumerate(self.all_cliques(x)):
-            for f in self._functions[t]:
-                assert f.output_dimension() == self.output_dimension()
-                c_id = t * self._clique_element_dim
-                J[0, c_id:c_id + self._clique_dim] += f.jacobian(x_t)
-        return J
+        return self.jacobian_into(x, J)
 
     def hessian(self, x):
         """
@@ -115,12 +121,190 @@ class CliquesFunctionNetwork(FunctionNetwork):
         H = np.matrix(np.zeros((
             self.input_dimension(),
             self.input_dimension())))
+        return self.hessian_into(x, H)
+
+    def jacobian_into(self, x, out):
+        """ The clique jacobians are written in a buffer of the network
+            workspace, which is reused across calls (and iterations) """
+        out[...] = 0.
+        X = self.all_cliques(x)
+        if self._shared_functions:
+            self._add_clique_gradients(
+                sum(f.jacobian_batch(X)[:, 0, :]
+                    for f in self._shared_functions),
+                np.asarray(out)[0])
+        dim = self._clique_dim
+        J_t = self._buffer("clique_jacobian", (1, dim))
+        for t, x_t, f in self._clique_functions(X):
+            assert f.output_dimension() == self.output_dimension()
+            c_id = t * self._clique_element_dim
+            out[:, c_id:c_id + dim] += f.jacobian_into(x_t, J_t)
+        return out
+
+    def hessian_into(self, x, out):
+        """ Same as jacobian_into for the clique hessians """
+        out[...] = 0.
+        X = self.all_cliques(x)
+        if self._shared_functions:
+            self._add_clique_hessians(
+                sum(f.hessian_batch(X) for f in self._shared_functions),
+                out)
+        dim = self._clique_dim
+        H_t = self._buffer("clique_hessian", (dim, dim))
+        for t, x_t, f in self._clique_functions(X):
+            c_id = t * self._clique_element_dim
+            out[c_id:c_id + dim, c_id:c_id + dim] += f.hessian_into(x_t, H_t)
+        return out
+
+    def clique_hessians(self, x):
+        """ Hessians of the cliques (T x dim x dim), each is the sum of
+            the hessians of the functions of the clique """
+        X = self.all_cliques(x)
+        dim = self._clique_dim
+        H_c = np.zeros((self._nb_cliques, dim, dim))
+        for f in self._shared_functions:
+            H_c += f.hessian_batch(X)
+        for t, x_t, f in self._clique_functions(X):
+            H_c[t] += np.asarray(f.hessian(x_t))
+        return H_c
+
+    def _hessian_indices(self):
+        """ Rows and columns in the full hessian of the entries of the
+            clique hessians (T x dim x dim), computed once """
+        if getattr(self, "_hessian_ids", None) is None:
+            dim = self._clique_dim
+            shape = (self._nb_cliques, dim, dim)
+            c_ids = self._clique_element_dim * np.arange(self._nb_cliques)
+            ids = c_ids[:, None] + np.arange(dim)
+            self._hessian_ids = (
+                np.broadcast_to(ids[:, :, None], shape).flatten(),
+                np.broadcast_to(ids[:, None, :], shape).flatten())
+        return self._hessian_ids
+
+    def hessian_sparse(self, x):
+        """ The hessian as a scipy.sparse (CSR) matrix, assembled from
+            the clique hessians without forming the dense matrix. It is
+            block banded, consecutive cliques share 2 elements. """
+        rows, cols = self._hessian_indices()
+        n = self.input_dimension()
+        return sparse.csr_matrix(
+            (self.clique_hessians(x).flatten(), (rows, cols)), shape=(n, n))
+
+    def hessian_banded(self, x):
+        """
+        The hessian in the lower banded storage of LAPACK, which is the
+        input of scipy.linalg.solveh_banded (lower=True):
+
+            ab[i - j, j] = H[i, j]      for 0 <= i - j < dim
+
+        the array is of dimension dim x n, where dim is the clique size.
+        """
+        rows, cols = self._hessian_indices()
+        lower = rows >= cols
+        n = self.input_dimension()
+        dim = self._clique_dim
+        ab = np.bincount(
+            ((rows - cols) * n + cols)[lower],
+            weights=self.clique_hessians(x).flatten()[lower],
+            minlength=dim * n)
+        return ab.reshape(dim, n)
+
+    def evaluate_all(self, x, order=2):
+        """ Evaluates each clique function once with its derivatives
+            and accumulates them in the full jacobian and hessian """
+        n = self.input_dimension()
+        dim = self._clique_dim
+        X = self.all_cliques(x)
+        values = [0.]
+        if order > 0:
+            values.append(np.matrix(np.zeros((1, n))))
+        if order > 1:
+            values.append(np.matrix(np.zeros((n, n))))
+        for f in self._shared_functions:
+            values[0] += np.sum(f.forward_batch(X))
+            if order > 0:
+                self._add_clique_gradients(
+                    f.jacobian_batch(X)[:, 0, :], np.asarray(values[1])[0])
+            if order > 1:
+                self._add_clique_hessians(f.hessian_batch(X), values[2])
+        for t, x_t, f in self._clique_functions(X):
+            c_id = t * self._clique_element_dim
+            values_f = f.evaluate_all(x_t, order)
+            values[0] += values_f[0]
+            if order > 0:
+                values[1][0, c_id:c_id + dim] += values_f[1]
+            if order > 1:
+                values[2][c_id:c_id + dim, c_id:c_id + dim] += values_f[2]
+        return values
+
+    def forward_record(self, x):
+        """ Records all clique functions, the backward pass accumulates
+            the clique gradients in the full input cotangent. The shared
+            functions are differentiated on a copy of the cliques. """
+        X = self.all_cliques(x)
+        X_shared = X.copy()
+        value = 0.
+        for f in self._shared_functions:
+            value += np.sum(f.forward_batch(X_shared))
+        records = []
+        for t, x_t, f in self._clique_functions(X):
+            y, backward = f.forward_record(x_t)
+            value += y
+            records.append((t * self._clique_element_dim, backward))
+
+        def backward(w):
+            g = np.zeros(self.input_dimension())
+            if self._shared_functions:
+                self._add_clique_gradients(
+                    np.asarray(w).reshape(1)[0] * sum(
+                        f.jacobian_batch(X_shared)[:, 0, :]
+                        for f in self._shared_functions), g)
+            for c_id, backward_f in records:
+                g[c_id:c_id + self._clique_dim] += backward_f(w)
+            return g
+        return value, backward
+
+    def hessian_vector_product(self, x, v):
+        """ Accumulates the products of the clique hessians with the
+            clique elements of v, the full hessian is never formed so
+            the cost is linear in the number of cliques """
+        Hv = np.zeros(self.input_dimension())
+        v = np.asarray(v, dtype=float).flatten()
         dim = self._clique_dim
-        for t, x_t in enumerate(self.all_cliques(x)):
+        X = self.all_cliques(x)
+        if self._shared_functions:
+            H = sum(f.hessian_batch(X) for f in self._shared_functions)
+            self._add_clique_gradients(
+                np.einsum("tij,tj->ti", H, self.all_cliques(v)), Hv)
+        for t, x_t, f in self._clique_functions(X):
             c_id = t * self._clique_element_dim
-            for f in self._functions[t]:
-                H[c_id:c_id + dim, c_id:c_id + dim] += f.hessian(x_t)
-        return H
+            v_t = v[c_id:c_id + dim]
+            Hv[c_id:c_id + dim] += f.hessian_vector_product(x_t, v_t)
+        return Hv
+
+    def compile(self):
+        """ Replaces the functions of each clique by their compiled
+            version (see compile_map), e.g., all quadratic terms of a
+            clique are merged into a single QuadricFunction.
+            Cliques that have the same functions share the compiled ones. """
+        memo = {}
+        compiled = {}
+
+        def compile_functions(functions):
+            if not functions:
+                return []
+            f = compile_map(SumOfTerms(functions), memo)
+            return list(f._functions) if type(f) is SumOfTerms else [f]
+        self._shared_functions = compile_functions(self._shared_functions)
+        for t in range(self._nb_cliques):
+            key = tuple(id(f) for f in self._functions[t])
+            if key not in compiled:
+                compiled[key] = compile_functions(self._functions[t])
+            self._functions[t] = list(compiled[key])
+
+    def clique_functions(self, t):
+        """ Functions of clique t, the shared ones come first """
+        return self._shared_functions + self._functions[t]
 
     def clique_value(self, t, x_t):
         """
@@ -128,7 +312,7 @@ class CliquesFunctionNetwork(FunctionNetwork):
         TODO create a test using this function.
         """
         value = 0.
-        for f in self._functions[t]:
+        for f in self.clique_functions(t):
             value += f.forward(x_t)
         return value
 
@@ -150,13 +334,41 @@ class CliquesFunctionNetwork(FunctionNetwork):
         return H[c_id:c_id + dim, c_id:c_id + dim]
 
     def all_cliques(self, x):
-        """ returns a list of all cliques """
+        """ returns all cliques as the rows of an array (T x dim), which
+            is a strided view of x : the cliques are not copied """
+        x = np.asarray(x).reshape(self._input_size)
+        stride = x.strides[0]
+        return np.lib.stride_tricks.as_strided(
+            x, shape=(self._nb_cliques, self._clique_dim),
+            strides=(self._clique_element_dim * stride, stride))
+
+    def _clique_functions(self, X):
+        """ Iterates over (t, x_t, f) for the clique specific functions """
+        for t, functions in enumerate(self._functions):
+            for f in functions:
+                yield t, X[t], f
+
+    def _add_clique_gradients(self, G, g):
+        """ Adds the clique gradients G (T x dim) to the full gradient g,
+            one slice per clique element as consecutive cliques overlap """
         n = self._clique_element_dim
-        dim = self._clique_dim
-        clique_begin_ids = list(range(0, n * self._nb_cliques, n))
-        cliques = [x[c_id:c_id + dim] for c_id in clique_begin_ids]
-        assert len(cliques) == self._nb_cliques
-        return cliques
+        end = n * self._nb_cliques
+        for k in range(self._nb_clique_elements):
+            g[k * n:k * n + end] += G[:, k * n:(k + 1) * n].reshape(end)
+
+    def _add_clique_hessians(self, H_c, H):
+        """ Adds the clique hessians H_c (T x dim x dim) to the full
+            hessian H. The n x n blocks (k, l) of all cliques do not
+            overlap, they are added through a strided view of H. """
+        H = np.asarray(H)
+        n = self._clique_element_dim
+        s_0, s_1 = H.strides
+        for k in range(self._nb_clique_elements):
+            for l in range(self._nb_clique_elements):
+                blocks = np.lib.stride_tricks.as_strided(
+                    H[k * n:, l * n:], shape=(self._nb_cliques, n, n),
+                    strides=(n * (s_0 + s_1), s_0, s_1))
+                blocks += H_c[:, k * n:(k + 1) * n, l * n:(l + 1) * n]
 
     def register_function_for_clique(self, t, f):
         """ Register function f for clique i """
@@ -164,10 +376,10 @@ class CliquesFunctionNetwork(FunctionNetwork):
         self._functions[t].append(f)
 
     def register_function_for_all_cliques(self, f):
-        """ Register function f """
+        """ Register function f, which is evaluated on the batch of
+            all cliques """
         assert f.input_dimension() == self._clique_dim
-        for t in range(self._nb_cliques):
-            self._functions[t].append(f)
+        self._shared_functions.append(f)
 
     def register_function_last_clique(self, f):
         """ Register function f """
@@ -256,6 +468,63 @@ class TrajectoryObjectiveFunction(DifferentiableMap):
         H = self._function_network.hessian(x_full)[self._n:, self._n:]
         return np.array(H)
 
+    def hessian_sparse(self, x):
+        """ Sparse (CSR) hessian of the active segment, see
+            CliquesFunctionNetwork.hessian_sparse """
+        x_full = self.full_vector(x)
+        H = self._function_network.hessian_sparse(x_full)
+        return H[self._n:, self._n:]
+
+    def hessian_banded(self, x):
+        """ Banded hessian of the active segment, see
+            CliquesFunctionNetwork.hessian_banded """
+        x_full = self.full_vector(x)
+        return self._function_network.hessian_banded(x_full)[:, self._n:]
+
+    def evaluate_all(self, x, order=2):
+        x_full = self.full_vector(x)
+        values = self._function_network.evaluate_all(x_full, order)
+        values[0] = min(1e100, values[0])
+        if order > 0:
+            values[1] = values[1][0, self._n:]
+        if order > 1:
+            values[2] = np.array(values[2][self._n:, self._n:])
+        return values
+
+    def _full_vector_buffer(self, x_active):
+        """ Same as full_vector in a buffer of the workspace """
+        x_full = self._buffer(
+            "x_full", (self._function_network.input_dimension(),))
+        x_full[:self._n] = self._q_init
+        x_full[self._n:] = x_active
+        return x_full
+
+    def jacobian_into(self, x, out):
+        x_full = self._full_vector_buffer(x)
+        J = self._function_network.jacobian_into(
+            x_full, self._buffer("jacobian", (1, x_full.size)))
+        out[...] = J[:, self._n:]
+        return out
+
+    def hessian_into(self, x, out):
+        x_full = self._full_vector_buffer(x)
+        H = self._function_network.hessian_into(
+            x_full, self._buffer("hessian", (x_full.size, x_full.size)))
+        out[...] = H[self._n:, self._n:]
+        return out
+
+    def forward_record(self, x):
+        x_full = self.full_vector(x)
+        y, backward = self._function_network.forward_record(x_full)
+        return min(1e100, y), lambda w: backward(w)[self._n:]
+
+    def hessian_vector_product(self, x, v):
+        x_full = self.full_vector(x)
+        v_full = np.zeros(x_full.size)
+        v_full[self._n:] = np.asarray(v).flatten()
+        Hv = self._function_network.hessian_vector_product(x_full, v_full)
+        return Hv[self._n:]
+
 
 class Trajectory:
     """
@@ -325,6 +594,31 @@ class Trajectory:
         end_idx = self._n * (i + 1)
         return self._x[beg_idx:end_idx]
 
+    @property
+    def configurations(self):
+        """ The (T + 2) x n array of all configurations, which is a view
+            of x (no copy) : traj.configurations[3] = np.ones(2) """
+        return self._x.reshape(self._T + 2, self._n)
+
+    def velocities(self, dt):
+        """ The (T + 2) x n velocities, row i is velocity(i, dt) """
+        q = self.configurations
+        v = np.zeros(q.shape)
+        np.subtract(q[1:], q[:-1], out=v[1:])
+        v[1:] /= dt
+        return v
+
+    def accelerations(self, dt):
+        """ The (T + 1) x n accelerations, row i is acceleration(i, dt) """
+        q = self.configurations
+        a = q[2:] - 2 * q[1:-1] + q[:-2]
+        a = np.vstack([q[1] - q[0], a])
+        return a / (dt ** 2)
+
+    def states(self, dt):
+        """ The (T + 2) x 2n states, row i is state(i, dt) """
+        return np.hstack([self.configurations, self.velocities(dt)])
+
     def velocity(self, i, dt):
         """
         returns velocity at index i
@@ -372,11 +666,7 @@ class Trajectory:
 
     def list_configurations(self):
         """ returns a list of configurations """
-        nb_config = self.T() + 1
-        line = [None] * nb_config
-        for t in range(nb_config):
-            line[t] = self.configuration(t)
-        return line
+        return list(self.configurations[:self._T + 1])
 
     def continuous_trajectory(self):
         """ returns an object of contunious type """
@@ -388,6 +678,21 @@ class Trajectory:
 class ContinuousTrajectory(Trajectory):
     """ Implements a trajectory that can be continously interpolated """
 
+    def _arc_lengths(self):
+        """ Cumulative lengths at configurations 0, ..., T """
+        q = self.configurations[:self._T + 1]
+        d = np.linalg.norm(q[1:] - q[:-1], axis=1)
+        return np.concatenate([[0.], np.cumsum(d)])
+
+    def configurations_at_parameters(self, s):
+        """ Vectorized version of configuration_at_parameter for an
+            array of parameters (k), returns an array (k x n) """
+        lengths = self._arc_lengths()
+        d_param = np.asarray(s, dtype=float) * lengths[-1]
+        q = self.configurations[:self._T + 1]
+        return np.vstack([np.interp(d_param, lengths, q[:, k])
+                          for k in range(self._n)]).T
+
     def configuration_at_parameter(self, s):
         """ The trajectory is indexed by s \in [0, 1] """
         d_param = s * self.length()
@@ -404,13 +709,7 @@ class ContinuousTrajectory(Trajectory):
 
     def length(self):
         """ length in configuration space """
-        length = 0.
-        q_prev = self.configuration(0)
-        for i in range(1, self._T + 1):
-            q_curr = self.configuration(i)
-            length += np.linalg.norm(q_curr - q_prev)
-            q_prev = q_curr
-        return length
+        return self._arc_lengths()[-1]
 
 
 class ConstantAccelerationTrajectory(ContinuousTrajectory):
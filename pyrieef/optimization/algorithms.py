@@ -17,7 +17,10 @@
 #
 #                                        Jim Mainprice on Sunday June 13 2018
 
+from . import common_imports
+from geometry.differentiable_geometry import CachedMap
 from scipy import optimize
+from scipy import linalg
 import numpy as np
 import time
 
@@ -27,13 +30,16 @@ def newton_optimize_trajectory(
         trajectory,
         verbose=False,
         maxiter=15):
+    """ Newton-CG (scipy), the value and gradient of the objective are
+        evaluated in one traversal (see CachedMap) """
     t_start = time.time()
+    objective = CachedMap(objective)
     res = optimize.minimize(
         x0=trajectory.active_segment(),
         method='Newton-CG',
         fun=objective.forward,
         jac=objective.gradient,
-        hess=objective.hessian,
+        hessp=objective.hessian_vector_product,
         tol=1e-9,
         options={'maxiter': maxiter, 'disp': verbose}
     )
@@ -42,3 +48,97 @@ def newton_optimize_trajectory(
         print(("gradient norm : ", np.linalg.norm(res.jac)))
     trajectory.active_segment()[:] = res.x
     return res
+
+
+def damped_banded_solve(ab, b, damping=0., min_damping=1e-8,
+                        max_increases=60):
+    """
+    Solves (H + damping I) p = b where H is symmetric and given in the
+    lower banded storage (see scipy.linalg.solveh_banded). The damping
+    is increased (Levenberg) until the Cholesky factorization succeeds,
+    i.e., the damped matrix is positive definite. Returns p and the
+    damping that was used.
+    """
+    if not np.all(np.isfinite(ab)):
+        raise linalg.LinAlgError("the hessian is not finite")
+    scale = max(np.max(np.abs(ab[0])), 1.)
+    a = np.array(ab, dtype=float)
+    for _ in range(max_increases):
+        a[0] = ab[0] + damping
+        try:
+            return linalg.solveh_banded(a, b, lower=True), damping
+        except linalg.LinAlgError:
+            damping = max(10. * damping, min_damping * scale)
+    raise linalg.LinAlgError("the damped hessian is not positive definite")
+
+
+def banded_newton(
+        objective,
+        x0,
+        maxiter=100,
+        gtol=1e-6,
+        armijo=1e-4,
+        max_backtracks=30,
+        verbose=False):
+    """
+    Newton's method for objectives with a banded hessian, which provide
+    hessian_banded (e.g., TrajectoryObjectiveFunction).
+
+    The steps are solved by banded Cholesky factorization, which costs
+    O(N b^2) for a bandwidth b instead of O(N^3), and are damped when
+    the hessian is not positive definite (see damped_banded_solve). The
+    damping decreases after each iteration. The step length follows a
+    backtracking line search from 1 until the Armijo condition holds,
+    infinite values (e.g., of barriers) are rejected by the search.
+    Returns a scipy OptimizeResult.
+    """
+    x = np.array(x0, dtype=float).flatten()
+    f = float(objective.forward(x))
+    g = objective.gradient(x)
+    damping = 0.
+    success = False
+    message = "Maximum number of iterations has been exceeded."
+    nit = 0
+    for nit in range(1, maxiter + 1):
+        if np.linalg.norm(g) < gtol:
+            nit -= 1
+            success = True
+            message = "Optimization terminated successfully."
+            break
+        p, damping = damped_banded_solve(
+            objective.hessian_banded(x), -g, damping)
+        slope = np.dot(g, p)
+        alpha = 1.
+        for _ in range(max_backtracks):
+            f_new = float(objective.forward(x + alpha * p))
+            if f_new <= f + armijo * alpha * slope:
+                break
+            alpha *= .5
+        else:
+            message = "Line search failed."
+            break
+        x += alpha * p
+        f = f_new
+        g = objective.gradient(x)
+        damping *= .1
+        if verbose:
+            print("iteration {} : f = {}, |g| = {}, step = {}".format(
+                nit, f, np.linalg.norm(g), alpha))
+    return optimize.OptimizeResult(
+        x=x, fun=f, jac=g, nit=nit, success=success, message=message)
+
+
+def banded_newton_optimize_trajectory(
+        objective,
+        trajectory,
+        verbose=False,
+        maxiter=15):
+    """ Same as newton_optimize_trajectory with banded_newton """
+    t_start = time.time()
+    res = banded_newton(
+        objective, trajectory.active_segment(), maxiter, verbose=verbose)
+    if verbose:
+        print(("optimization done in {} sec.".format(time.time() - t_start)))
+        print(("gradient norm : ", np.linalg.norm(res.jac)))
+    trajectory.active_segment()[:] = res.x
+    return res
@@ -22,24 +22,99 @@ from motion.trajectory import *
 import numpy as np
 
 
-def collision_check_trajectory(workspace, trajectory):
+def sphere_tracing(workspace, p_init, p_goal, tolerance=1e-3):
+    """
+    Conservative advancement along the segments [p_init, p_goal], given
+    as arrays (m, 2).
+
+    The ball centered at a point of radius the signed distance to the
+    obstacles is free, hence each segment is walked by steps of the
+    current distance, which are long in free space. All segments are
+    advanced at once, until they either reach their end or come closer
+    than the tolerance to an obstacle. Returns an array of booleans (m),
+    True for the segments in collision (up to the tolerance).
+    """
+    p_init = np.atleast_2d(np.asarray(p_init, dtype=float))
+    p_goal = np.atleast_2d(np.asarray(p_goal, dtype=float))
+    length = np.linalg.norm(p_goal - p_init, axis=1)
+    direction = (p_goal - p_init) / np.maximum(length, 1e-12)[:, None]
+    s = np.zeros(length.size)
+    collision = np.full(length.size, False)
+    active = np.arange(length.size)
+    while active.size:
+        p = p_init[active] + s[active, None] * direction[active]
+        d = workspace.min_dist(p.T)[0]
+        hit = d < tolerance
+        collision[active[hit]] = True
+        s[active] += d
+        active = active[~hit & (s[active] < length[active])]
+    return collision
+
+
+def collision_check_trajectories(workspace, trajectories, tolerance=1e-3):
+    """ Checks the segments of all trajectories at once (sphere_tracing),
+        returns an array of booleans, one per trajectory """
+    configurations = [t.configurations[:t.T() + 1] for t in trajectories]
+    collision = sphere_tracing(
+        workspace,
+        np.vstack([q[:-1] for q in configurations]),
+        np.vstack([q[1:] for q in configurations]),
+        tolerance)
+    offsets = np.cumsum([0] + [q.shape[0] - 1 for q in configurations])
+    return np.logical_or.reduceat(collision, offsets[:-1])
+
+
+def collision_check_trajectory(workspace, trajectory, tolerance=1e-3):
     """ Check trajectory for collision """
-    delta = workspace.box.diag() / 100.
-    interpolated_traj = trajectory.continuous_trajectory()
-    length = interpolated_traj.length()
-    for s in np.linspace(0, 1, num=int(length / delta) + 1):
-        if workspace.in_collision(
-                interpolated_traj.configuration_at_parameter(s)):
-            return True
-    return False
+    return bool(collision_check_trajectories(
+        workspace, [trajectory], tolerance)[0])
 
 
-def collision_check_linear_interpolation(workspace, p_init, p_goal):
+def collision_check_linear_interpolation(
+        workspace, p_init, p_goal, tolerance=1e-3):
     """ Check interior interpolation for collision """
-    delta = workspace.box.diag() / 100.
-    length = np.linalg.norm(p_init - p_goal)
-    for s in np.linspace(0, 1, num=int(length / delta) + 1):
-        p_interp = (1. - s) * p_init + s * p_goal
-        if workspace.in_collision(p_interp):
-            return True
-    return False
+    return bool(sphere_tracing(workspace, p_init, p_goal, tolerance)[0])
+
+
+def sample_start_goal_pairs(
+        workspace, nb_pairs, margin=0., min_distance=0., line_of_sight=None,
+        low_discrepancy=False, max_blocks=100):
+    """
+    Samples collision free start and goal points (see
+    sample_collision_free_points) that are at least min_distance apart.
+    When line_of_sight is True (resp. False) the straight segment between
+    them is required to be collision free (resp. in collision).
+
+    The pairs are drawn in at most max_blocks blocks in total, whose size
+    follows the observed acceptance rate of the pairs (at most 100 times
+    the number of pairs left). Returns two arrays (k, 2), with k <
+    nb_pairs when the budget is exhausted, e.g., when the constraints
+    reject almost all pairs.
+    """
+    starts = []
+    goals = []
+    nb_found = 0
+    nb_drawn = 0
+    for _ in range(max_blocks):
+        remaining = nb_pairs - nb_found
+        if remaining <= 0:
+            break
+        rate = (nb_found + 1.) / (nb_drawn + 1.)
+        nb_candidates = min(int(np.ceil(1.5 * remaining / rate)),
+                            100 * remaining)
+        nb_drawn += nb_candidates
+        s = sample_collision_free_points(
+            workspace, 2 * nb_candidates, margin, low_discrepancy, 1)
+        n = s.shape[0] // 2
+        p_init, p_goal = s[:n], s[n:2 * n]
+        valid = np.linalg.norm(p_goal - p_init, axis=1) >= min_distance
+        if line_of_sight is not None:
+            visible = ~sphere_tracing(
+                workspace, p_init[valid], p_goal[valid])
+            valid[valid] = visible == line_of_sight
+        starts.append(p_init[valid][:remaining])
+        goals.append(p_goal[valid][:remaining])
+        nb_found += starts[-1].shape[0]
+    if not starts:
+        return np.zeros((0, 2)), np.zeros((0, 2))
+    return np.vstack(starts), np.vstack(goals)
@@ -101,12 +101,10 @@ def test_inverse_functions():
     # assert check_jacobian_against_finite_difference(obstacle)
     # assert check_inverse(obstacle)
 
-    # obstacle = AnalyticEllipse()
-    # obstacle.set_alpha(alpha_f, beta_inv_f)
-    # if check_inverse(obstacle):
-    #     print "Analytic Ellipse OK !!!"
-    # else:
-    #     print "Analytic Ellipse Error !!!"
+    print("Test AnalyticEllipse")
+    obstacle = AnalyticEllipse(orientation=.3)
+    assert check_jacobian_against_finite_difference(obstacle)
+    assert check_obstacle_inverse(obstacle)
 
     print("Test AnalyticCircle")
     obstacle = AnalyticCircle()
@@ -145,5 +143,33 @@ def test_inverse_functions():
     print("Done.")
 
 
+def test_convex_polygon():
+    np.random.seed(0)
+    polygon = ellipse_polygon(.2, .1, [.0, .0], [.1, .0], .3)
+    x = np.random.uniform(-.5, .5, (2, 200))
+    inside = polygon.is_inside(x)
+    assert np.array_equal(inside, Polygon.is_inside(polygon, x))
+    assert np.array_equal(inside, polygon.dist_from_border(x) < 0.)
+    p = polygon.intersection_point(x)
+    assert p.shape == (2, 200)
+    assert np.allclose(p, np.array(
+        [polygon.intersection_point(y) for y in x.T]).T)
+    assert np.allclose(polygon.dist_from_border(p), 0.)
+
+
+def test_multi_diffeo_jacobian():
+    """ The activations are assigned into a preallocated array, which jets
+        do not support, the jacobian falls back to finite differences """
+    diffeo = AnalyticMultiDiffeo([
+        AnalyticCircle(origin=[.1, .0], radius=0.1),
+        AnalyticCircle(origin=[.1, .25], radius=0.05)])
+    q = np.array([.3, .2])
+    J = diffeo.jacobian(q)
+    assert J.shape == (2, 2)
+    assert check_is_close(J, finite_difference_jacobian(diffeo, q), 1e-6)
+    assert not diffeo._jet_compatible
+
+
 if __name__ == "__main__":
     test_inverse_functions()
+    # test_multi_diffeo_jacobian()
@@ -19,7 +19,10 @@
 
 import __init__
 from geometry.differentiable_geometry import *
+from geometry.map_compiler import *
+from geometry.profiling import *
 from numpy.testing import assert_allclose
+import time
 
 
 def test_finite_difference():
@@ -348,6 +351,14 @@ def test_softmax():
     print("Check LogSumExp (H implementation) : ")
     assert check_hessian_against_finite_difference(f)
 
+    # large exponents do not overflow
+    f = LogSumExp(3, -1000.)
+    x = np.array([10., 11., 12.])
+    assert np.isclose(f(x), 10. - np.log(1. + np.exp(-1000.)) / 1000.)
+    assert np.allclose(f.jacobian(x), [1., 0., 0.])
+    assert np.allclose(f.forward_batch([x, x + 1.]), [[10.], [11.]])
+    assert np.allclose(SoftMax(3, 1000.).forward(x), [0., 0., 1.])
+
 
 def test_activations():
 
@@ -398,6 +409,516 @@ def test_radial_basis_function():
     assert abs(f(x) - np.exp(-.5 * phi)) < 1e-5
 
 
+def check_batch_against_loop(f, nb_points=10, hessian=True):
+    """ Makes sure the batch evaluation matches the pointwise one """
+    Q = np.random.rand(nb_points, f.input_dimension())
+    m = f.output_dimension()
+    n = f.input_dimension()
+    Y = f.forward_batch(Q)
+    J = f.jacobian_batch(Q)
+    assert Y.shape == (nb_points, m)
+    assert J.shape == (nb_points, m, n)
+    for i, q in enumerate(Q):
+        assert_allclose(Y[i], np.asarray(f(q)).reshape(m), atol=1e-10)
+        assert_allclose(
+            J[i], np.asarray(f.jacobian(q)).reshape(m, n), atol=1e-10)
+    if hessian:
+        H = f.hessian_batch(Q)
+        assert H.shape == (nb_points, n, n)
+        for i, q in enumerate(Q):
+            assert_allclose(
+                H[i], np.asarray(f.hessian(q)).reshape(n, n), atol=1e-10)
+    return True
+
+
+def test_batch_evaluation():
+    np.random.seed(0)
+    dim = 3
+    k = np.matrix(np.random.rand(dim, dim))
+    quadric = QuadricFunction(k.T * k, np.random.rand(dim), 1.)
+    affine = AffineMap(np.random.rand(dim, dim), np.random.rand(dim))
+    affine_1d = AffineMap(np.random.rand(1, dim), np.random.rand(1))
+    squared_norm = SquaredNorm(np.random.rand(dim))
+
+    assert check_batch_against_loop(IdentityMap(dim), hessian=False)
+    assert check_batch_against_loop(ZeroMap(dim + 2, dim), hessian=False)
+    assert check_batch_against_loop(affine, hessian=False)
+    assert check_batch_against_loop(affine_1d)
+    assert check_batch_against_loop(quadric)
+    assert check_batch_against_loop(squared_norm)
+    assert check_batch_against_loop(Norm(np.random.rand(dim)))
+    assert check_batch_against_loop(Normalize(dim), hessian=False)
+    assert check_batch_against_loop(SoftMax(dim, 3.), hessian=False)
+    assert check_batch_against_loop(LogSumExp(dim, 3.))
+    assert check_batch_against_loop(Sigmoid(1))
+    assert check_batch_against_loop(Tanh(dim), hessian=False)
+    assert check_batch_against_loop(Arccos())
+    assert check_batch_against_loop(ExpTestFunction(), hessian=False)
+    assert check_batch_against_loop(RadialBasisFunction(
+        np.random.rand(2), np.eye(2)), hessian=False)
+    assert check_batch_against_loop(Scale(quadric, .3))
+    assert check_batch_against_loop(SumOfTerms([quadric, squared_norm]))
+    assert check_batch_against_loop(
+        Compose(squared_norm, affine), hessian=False)
+    assert check_batch_against_loop(
+        Compose(SquaredNorm(np.random.rand(1)), affine_1d))
+    assert check_batch_against_loop(Pullback(squared_norm, affine))
+    assert check_batch_against_loop(Compose(Arccos(), Scale(
+        RadialBasisFunction(np.random.rand(2), np.eye(2)), .5)),
+        hessian=False)
+    assert check_batch_against_loop(ProductFunction(quadric, squared_norm))
+    assert check_batch_against_loop(CombinedOutputMap(
+        [affine, squared_norm]), hessian=False)
+    assert check_batch_against_loop(
+        Compose(RangeSubspaceMap(dim, [0, 2]), affine), hessian=False)
+
+
+def calculate_finite_difference_speedup(f, nb_points=10):
+    """ Benchmarks the vectorized finite differences against
+        the pointwise implementation """
+    samples = np.random.rand(nb_points, f.input_dimension())
+    time1 = time.time()
+    [finite_difference_jacobian(f, x) for x in samples]
+    time2 = time.time()
+    t_loop = (time2 - time1) * 1000.0
+    print(('%s function took %0.3f ms' % ("finite diff", t_loop)))
+    time1 = time.time()
+    [vectorized_finite_difference_jacobian(f, x) for x in samples]
+    time2 = time.time()
+    t_vectorized = (time2 - time1) * 1000.0
+    print(('%s function took %0.3f ms' % ("vectorized", t_vectorized)))
+    print((" -- speedup : {:.1f} x".format(t_loop / t_vectorized)))
+
+
+def test_vectorized_finite_differences():
+    np.random.seed(0)
+    dim = 20
+    k = np.matrix(np.random.rand(dim, dim))
+    quadric = QuadricFunction(k.T * k, np.random.rand(dim), 1.)
+    affine = AffineMap(np.random.rand(dim, dim), np.random.rand(dim))
+    maps = [quadric, affine, SoftMax(dim, 2.), LogSumExp(dim, 2.),
+            Pullback(SquaredNorm(np.zeros(dim)), affine)]
+    for f in maps:
+        q = np.random.rand(f.input_dimension())
+        J = np.asarray(f.jacobian(q))
+
+        # Accuracy against the pointwise implementation
+        J_loop = finite_difference_jacobian(f, q)
+        J_central = vectorized_finite_difference_jacobian(f, q)
+        assert check_is_close(J_central, J_loop, 1e-9)
+        assert check_is_close(J_central, J, 1e-4)
+
+        # One sided schemes are first order accurate
+        J_forward = vectorized_finite_difference_jacobian(
+            f, q, dt=1e-7, scheme="forward")
+        J_backward = vectorized_finite_difference_jacobian(
+            f, q, dt=1e-7, scheme="backward")
+        assert check_is_close(J_forward, J, 1e-4)
+        assert check_is_close(J_backward, J, 1e-4)
+
+        if f.output_dimension() == 1:
+            H_loop = finite_difference_hessian(f, q)
+            H_central = vectorized_finite_difference_hessian(f, q)
+            assert check_is_close(H_central, H_loop, 1e-9)
+
+        calculate_finite_difference_speedup(f)
+
+    # Complex step differentiation is exact to machine precision
+    for f in [quadric, affine, SoftMax(dim, 2.), ExpTestFunction()]:
+        q = np.random.rand(f.input_dimension())
+        J_complex = complex_step_jacobian(f, q)
+        if isinstance(f, ExpTestFunction):
+            v = f(q)
+            J = np.array([[-8. * q[0] * v, -.5 * q[1] * v]])
+        else:
+            J = np.asarray(f.jacobian(q))
+        assert check_is_close(J_complex, J, 1e-12)
+
+
+class ArrayConstructionMap(DifferentiableMap):
+    """ The forward builds a new array, which does not support jets """
+
+    def output_dimension(self):
+        return 1
+
+    def input_dimension(self):
+        return 2
+
+    def forward(self, x):
+        return np.array([np.sin(x[0]) * x[1]])
+
+
+class MatrixProductMap(DifferentiableMap):
+    """ The forward multiplies by a numpy matrix """
+
+    def __init__(self, A):
+        self.A = np.matrix(A)
+
+    def output_dimension(self):
+        return self.A.shape[0]
+
+    def input_dimension(self):
+        return self.A.shape[1]
+
+    def forward(self, x):
+        assert x.shape[0] == self.input_dimension()
+        return np.dot(self.A, x)
+
+
+def test_forward_mode_differentiation():
+    np.random.seed(0)
+    maps = [ExpTestFunction(),
+            RadialBasisFunction(np.random.rand(2), np.eye(2) + .1),
+            Norm(np.random.rand(3)),
+            Tanh(3), Tanh(1),
+            LogSumExp(3, 2.),
+            Scale(Norm(np.random.rand(2)), 3.)]
+    for f in maps:
+        q = np.random.rand(f.input_dimension())
+        J = forward_mode_jacobian(f, q)
+        assert check_is_close(J, finite_difference_jacobian(f, q), 1e-6)
+        if f.output_dimension() == 1:
+            H = forward_mode_hessian(f, q)
+            assert check_is_close(H, finite_difference_hessian(f, q), 1e-6)
+
+    # The default derivatives use jets when possible
+    f = ExpTestFunction()
+    q = np.random.rand(2)
+    v = f(q)
+    assert check_is_close(f.jacobian(q), [[-8. * q[0] * v, -.5 * q[1] * v]])
+    assert f._jet_compatible
+
+    # Tanh second derivative used to be missing
+    tanh = Tanh(1)
+    x = np.random.rand(1)
+    t = np.tanh(x[0])
+    assert check_is_close(tanh.hessian(x), [[-2. * t * (1. - t ** 2)]])
+
+    # Otherwise they fall back to finite differences
+    f = ArrayConstructionMap()
+    q = np.random.rand(2)
+    J = f.jacobian(q)
+    assert not f._jet_compatible
+    assert check_is_close(J, [[np.cos(q[0]) * q[1], np.sin(q[0])]], 1e-6)
+    assert check_is_close(f.hessian(q), finite_difference_hessian(f, q), 1e-6)
+
+    # numpy matrix operands are multiplied elementwise in the jet products
+    f = MatrixProductMap(np.random.rand(2, 3))
+    q = np.random.rand(3)
+    assert check_is_close(f.jacobian(q), f.A)
+    assert f._jet_compatible
+    x = Jet.variable(q)
+    assert check_is_close(np.asarray(f.A).dot(q), (f.A * x).value)
+    assert check_is_close((q * x).value, q * q)
+    try:
+        np.dot(np.random.rand(2, 2), x)
+        assert False
+    except TypeError:
+        pass
+
+    # errors of the forward function are not hidden by finite differences
+    f = MatrixProductMap(np.random.rand(2, 3))
+    raised = False
+    try:
+        f.jacobian(np.random.rand(4))
+    except AssertionError:
+        raised = True
+    assert raised
+    assert f._jet_compatible
+
+
+def test_reverse_mode_gradient():
+    np.random.seed(0)
+    dim = 4
+    affine = AffineMap(np.random.rand(dim, dim), np.random.rand(dim))
+    subspace = RangeSubspaceMap(dim, [0, 2])
+    tree = SumOfTerms([
+        Scale(Pullback(SquaredNorm(np.random.rand(dim)), affine), 2.),
+        Compose(LogSumExp(2, 3.), Compose(subspace, affine)),
+        ProductFunction(
+            Pullback(SquaredNorm(np.zeros(2)), subspace),
+            Compose(RadialBasisFunction(np.zeros(2), np.eye(2)),
+                    Compose(subspace, IdentityMap(dim)))),
+        Compose(SquaredNorm(np.zeros(3)), CombinedOutputMap([
+            Compose(RangeSubspaceMap(dim, [1]), affine),
+            Compose(subspace, affine)]))])
+    for _ in range(5):
+        q = np.random.rand(dim)
+        [v, g] = tree.value_and_gradient(q)
+        assert check_is_close(v, tree(q))
+        assert g.shape == q.shape
+        assert check_is_close(g, tree.gradient(q), 1e-8)
+        assert check_is_close(
+            g, np.asarray(finite_difference_jacobian(tree, q)).ravel(), 1e-6)
+
+
+def test_evaluate_all():
+    np.random.seed(0)
+    dim = 3
+    k = np.matrix(np.random.rand(dim, dim))
+    quadric = QuadricFunction(k.T * k, np.random.rand(dim), 1.)
+    affine = AffineMap(np.random.rand(dim, dim), np.random.rand(dim))
+    maps = [quadric,
+            SquaredNorm(np.random.rand(dim)),
+            Norm(np.random.rand(dim)),
+            LogSumExp(dim, 2.),
+            Tanh(1), Sigmoid(1),
+            ExpTestFunction(),
+            Scale(quadric, 3.),
+            SumOfTerms([quadric, Norm(np.zeros(dim))]),
+            Compose(Tanh(1), AffineMap(np.random.rand(1, dim), np.ones(1))),
+            Pullback(LogSumExp(dim, 2.), affine),
+            ProductFunction(quadric, Norm(np.zeros(dim)))]
+    for f in maps:
+        q = np.random.rand(f.input_dimension())
+        [y, J, H] = f.evaluate_all(q)
+        assert check_is_close(y, f.forward(q))
+        assert check_is_close(J, f.jacobian(q), 1e-8)
+        assert check_is_close(H, f.hessian(q), 1e-8)
+        [y, J] = f.evaluate_all(q, order=1)
+        assert check_is_close(J, f.jacobian(q), 1e-8)
+        assert len(f.evaluate_all(q, order=0)) == 1
+
+    for f in [affine, SoftMax(dim, 2.), Tanh(dim)]:
+        q = np.random.rand(f.input_dimension())
+        [y, J] = f.evaluate_all(q, order=1)
+        assert check_is_close(y, f.forward(q))
+        assert check_is_close(J, f.jacobian(q), 1e-8)
+
+
+def test_compile_map():
+    np.random.seed(0)
+    dim = 4
+    affine_1 = AffineMap(np.random.rand(dim, dim), np.random.rand(dim))
+    affine_2 = AffineMap(np.random.rand(3, dim), np.random.rand(3))
+    subspace = RangeSubspaceMap(dim, [1, 3])
+    tree = SumOfTerms([
+        Scale(Scale(Pullback(SquaredNorm(np.random.rand(3)),
+                             Compose(affine_2, affine_1)), 2.), .5),
+        Scale(Pullback(SquaredNorm(np.random.rand(2)), subspace), 3.),
+        SumOfTerms([
+            Pullback(LogSumExp(2, 2.), subspace),
+            Pullback(Scale(Norm(np.zeros(2)), 2.), subspace)])])
+    compiled = compile_map(tree)
+    assert isinstance(compiled, SumOfTerms)
+    types = [type(f) for f in compiled._functions]
+    assert types.count(QuadricFunction) == 1
+    assert types.count(SubspacePullback) == 1
+    assert types.count(Scale) == 1
+    for _ in range(5):
+        q = np.random.rand(dim)
+        assert check_is_close(compiled(q), tree(q))
+        assert check_is_close(compiled.jacobian(q), tree.jacobian(q))
+        assert check_is_close(compiled.hessian(q), tree.hessian(q), 1e-8)
+
+    # Affine chains are folded in a single matrix
+    compiled = compile_map(Compose(Compose(subspace, affine_1), affine_1))
+    assert isinstance(compiled, AffineMap)
+    q = np.random.rand(dim)
+    assert check_is_close(compiled(q), subspace(affine_1(affine_1(q))))
+
+    # Subspace pullbacks slice the input
+    f = SubspacePullback(RadialBasisFunction(np.zeros(2), np.eye(2)),
+                         dim, [2, 0])
+    assert check_jacobian_against_finite_difference(f, False)
+    assert check_hessian_against_finite_difference(f, False)
+
+
+def test_structured_jacobians():
+    np.random.seed(0)
+    dim = 5
+    indices = [4, 1, 2]
+    subspace = RangeSubspaceMap(dim, indices)
+    q = np.random.rand(dim)
+    J = subspace.jacobian(q)
+    J_dense = np.eye(dim)[indices, :]
+    assert isinstance(J, SelectionJacobian)
+    assert J.shape == (3, dim)
+    assert check_is_close(J, J_dense)
+    assert check_is_close(J.T, J_dense.T)
+    assert check_is_close(J.tosparse().toarray(), J_dense)
+
+    # products with dense matrices give the same numpy matrices
+    a = np.random.rand(2, 3)
+    b = np.random.rand(dim, 2)
+    assert isinstance(np.matrix(a) * J, np.matrix)
+    assert check_is_close(np.matrix(a) * J, a.dot(J_dense))
+    assert check_is_close(J * b, J_dense.dot(b))
+    assert check_is_close(J.T * a.T, J_dense.T.dot(a.T))
+    h = np.random.rand(3, 3)
+
+    # numpy arrays on the left are multiplied as with numpy matrices
+    v = np.array([1., 2.])
+    for product in [v * IdentityMap(2).jacobian(q),
+                    v @ IdentityMap(2).jacobian(q)]:
+        assert isinstance(product, np.matrix)
+        assert product.shape == (1, 2)
+        assert check_is_close(product, v * np.matrix(np.eye(2)))
+    assert check_is_close(a * J, a.dot(J_dense))
+    assert check_is_close(a @ J, a.dot(J_dense))
+    assert check_is_close(a * ZeroMap(3, 2).jacobian(q), np.zeros((2, 2)))
+    assert check_is_close(
+        pullback_hessian(h, J), J_dense.T.dot(h).dot(J_dense))
+
+    # structured products stay structured
+    J_2 = RangeSubspaceMap(3, [2, 0]).jacobian(None) * J
+    assert isinstance(J_2, SelectionJacobian)
+    assert check_is_close(J_2, np.eye(dim)[[2, 4], :])
+    assert isinstance(IdentityMap(3).jacobian(q) * J, SelectionJacobian)
+    assert check_is_close(ZeroMap(2, 3).jacobian(q) * J, np.zeros((2, dim)))
+    blocks = [np.random.rand(2, 2), np.random.rand(1, 3)]
+    J_b = BlockDiagonalJacobian(blocks)
+    assert check_is_close(np.matrix(a) * J_b, a.dot(np.asarray(J_b)))
+    assert check_is_close(J_b * b, np.asarray(J_b).dot(b))
+    assert check_is_close(J_b.T * a.T, np.asarray(J_b).T.dot(a.T))
+
+    # combined outputs of structured maps are sparse
+    combined = CombinedOutputMap([subspace, IdentityMap(dim)])
+    J_c = combined.jacobian(q)
+    assert isinstance(J_c, SparseJacobian)
+    assert check_is_close(J_c, np.vstack([J_dense, np.eye(dim)]))
+    assert check_jacobian_against_finite_difference(combined, False)
+
+    # the chain rule in compositions exploits the structure
+    f = Pullback(SquaredNorm(np.random.rand(3)), subspace)
+    assert isinstance(f.jacobian(q), np.matrix)
+    assert check_jacobian_against_finite_difference(f, False)
+    assert check_hessian_against_finite_difference(f, False)
+    f = Pullback(LogSumExp(3, 2.), subspace)
+    assert check_jacobian_against_finite_difference(f, False)
+    assert check_hessian_against_finite_difference(f, False)
+
+
+def test_hessian_vector_product():
+    np.random.seed(0)
+    dim = 4
+    subspace = RangeSubspaceMap(dim, [3, 1])
+    affine = AffineMap(np.random.rand(3, dim), np.random.rand(3))
+    functions = [
+        Scale(Pullback(SquaredNorm(np.random.rand(3)), affine), 2.),
+        SumOfTerms([
+            Pullback(LogSumExp(2, 2.), subspace),
+            QuadricFunction(np.random.rand(dim, dim), np.random.rand(dim),
+                            .3)]),
+        Compose(Tanh(1), AffineMap(np.random.rand(1, dim), np.ones(1))),
+        SubspacePullback(RadialBasisFunction(np.zeros(2), np.eye(2)),
+                         dim, [2, 0])]
+    for f in functions:
+        q = np.random.rand(dim)
+        v = np.random.rand(dim)
+        Hv = f.hessian_vector_product(q, v)
+        assert Hv.shape == q.shape
+        assert check_is_close(Hv, np.asarray(f.hessian(q)).dot(v))
+
+
+def test_profiling():
+    dim = 3
+    f = Pullback(SquaredNorm(np.zeros(dim)), IdentityMap(dim))
+    assert f._profile is None
+    with profiling():
+        squared_norm = SquaredNorm(np.zeros(2))
+        g = SumOfTerms([
+            Pullback(squared_norm, RangeSubspaceMap(dim, [0, 1])),
+            Pullback(squared_norm, RangeSubspaceMap(dim, [1, 2])),
+            Scale(SquaredNorm(np.ones(dim)), 2.)])
+    assert not is_profiling_enabled()
+    q = np.random.rand(dim)
+    value = g(q)
+    g.jacobian(q)
+    g.hessian(q)
+    assert g._profile.calls["forward"] == 1
+    assert g._profile.calls["jacobian"] == 1
+    assert squared_norm._profile.calls["forward"] == 2
+    assert squared_norm._profile.calls["evaluate_all"] == 4
+    assert check_is_close(value, squared_norm(q[:2]) + squared_norm(q[1:]) +
+                          np.sum((q - 1) ** 2))
+    report = profile_report(g)
+    print(report)
+    lines = report.split("\n")
+    assert lines[0].startswith("SumOfTerms : forward 1")
+    assert lines[1].startswith("  Pullback : forward 1 ")
+    assert "    SquaredNorm (shared)" in lines
+    reset_profiles(g)
+    assert squared_norm._profile.calls["forward"] == 0
+
+
+def test_evaluation_into_buffers():
+    np.random.seed(0)
+    dim = 4
+    affine = AffineMap(np.random.rand(3, dim), np.random.rand(3))
+    maps = [
+        affine,
+        RangeSubspaceMap(dim, [3, 1]),
+        IdentityMap(dim),
+        ZeroMap(2, dim),
+        Compose(affine, Compose(
+            AffineMap(np.random.rand(dim, dim), np.random.rand(dim)),
+            IdentityMap(dim))),
+        SumOfTerms([
+            Scale(Pullback(SquaredNorm(np.random.rand(3)), affine), 2.),
+            Pullback(SquaredNorm(np.zeros(2)), RangeSubspaceMap(dim, [0, 2])),
+            QuadricFunction(np.random.rand(dim, dim), np.random.rand(dim),
+                            .3),
+            Pullback(ExpTestFunction(), RangeSubspaceMap(dim, [1, 0]))])]
+    for f in maps:
+        m = f.output_dimension()
+        y = np.zeros(m)
+        J = np.zeros((m, dim))
+        H = np.zeros((dim, dim))
+        for _ in range(2):
+            q = np.random.rand(dim)
+            assert f.forward_into(q, y) is y
+            assert f.jacobian_into(q, J) is J
+            assert check_is_close(y, f(q))
+            assert check_is_close(J, f.jacobian(q))
+            if m == 1:
+                assert f.hessian_into(q, H) is H
+                assert check_is_close(H, f.hessian(q))
+
+
+def test_cached_map():
+    np.random.seed(0)
+    dim = 3
+    a = np.random.rand(dim, dim)
+    with profiling():
+        f = QuadricFunction(a.T.dot(a), np.random.rand(dim), 1.)
+    cached = CachedMap(f, order=1, max_size=2)
+    assert cached.input_dimension() == dim
+    assert cached.output_dimension() == 1
+    f.name = "quadric"
+    assert cached.name == "quadric"
+    q = np.random.rand(dim)
+    assert_allclose(cached(q), f(q))
+    assert_allclose(cached.jacobian(q), f.jacobian(q))
+    assert_allclose(cached.gradient(q), f.gradient(q))
+    assert f._profile.calls["evaluate_all"] == 1
+
+    # the hessian is computed once at the same input
+    assert_allclose(cached.hessian(q), f.hessian(q))
+    assert_allclose(cached.hessian(q.copy()), f.hessian(q))
+    assert f._profile.calls["evaluate_all"] == 2
+    v = np.random.rand(dim)
+    assert_allclose(cached.hessian_vector_product(q, v),
+                    f.hessian_vector_product(q, v))
+    assert f._profile.calls["hessian_vector_product"] == 1
+    [value, J] = cached.evaluate_all(q, 1)
+    assert_allclose(J, f.jacobian(q))
+
+    # least recently used inputs are evicted
+    p_1, p_2 = np.random.rand(dim), np.random.rand(dim)
+    cached(p_1)
+    cached(q)
+    cached(p_2)
+    assert f._profile.calls["evaluate_all"] == 4
+    cached(q)
+    assert f._profile.calls["evaluate_all"] == 4
+    cached(p_1)
+    assert f._profile.calls["evaluate_all"] == 5
+    cached.clear()
+    cached(q)
+    assert f._profile.calls["evaluate_all"] == 6
+
+
 if __name__ == "__main__":
     # test_finite_difference()
     # test_zero()
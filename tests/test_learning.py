@@ -68,7 +68,19 @@ def test_demonstrations():
     print("time : {} sec.".format(time.time() - t_start))
 
 
+def test_chomp_obstacle_cost():
+    epsilon = .1
+    distances = np.array([[-.1, 0., .05], [.1, .2, -1.]])
+    costs = chomp_obstacle_cost(distances, epsilon)
+    assert costs.shape == distances.shape
+    for d, c in zip(distances.flatten(), costs.flatten()):
+        assert isinstance(chomp_obstacle_cost(d, epsilon), float)
+        assert_allclose(chomp_obstacle_cost(d, epsilon), c)
+    assert_allclose(costs, [[.15, .05, .0125], [0., 0., 1.05]])
+
+
 if __name__ == "__main__":
     test_random_enviroments()
     test_standard_dataset()
     test_demonstrations()
+    # test_chomp_obstacle_cost()
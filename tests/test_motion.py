@@ -22,6 +22,7 @@ from motion.trajectory import *
 from motion.cost_terms import *
 from motion.objective import *
 from motion.control import *
+from utils.collision_checking import *
 import time
 from numpy.linalg import norm
 from numpy.testing import assert_allclose
@@ -563,6 +564,120 @@ def test_trajectory_objective():
     assert check_hessian_against_finite_difference(objective, False, 1e-3)
 
 
+def calculate_value_and_gradient_speedup(objective, xi, nb_evals=10):
+    """ Benchmarks value_and_gradient against separate calls to the
+        objective and its gradient """
+    time1 = time.time()
+    for _ in range(nb_evals):
+        objective(xi)
+        objective.gradient(xi)
+    time2 = time.time()
+    t_separate = (time2 - time1) * 1000.0
+    print(('%s took %0.3f ms' % ("value + gradient", t_separate)))
+    time1 = time.time()
+    for _ in range(nb_evals):
+        objective.value_and_gradient(xi)
+    time2 = time.time()
+    t_reverse = (time2 - time1) * 1000.0
+    print(('%s took %0.3f ms' % ("value_and_gradient", t_reverse)))
+    print((" -- speedup : {:.1f} x".format(t_separate / t_reverse)))
+    return t_separate / t_reverse
+
+
+def test_value_and_gradient():
+    np.random.seed(0)
+    problem = MotionOptimization2DCostMap(T=10)
+    trajectory = linear_interpolation_trajectory(
+        problem.q_init, problem.q_goal, problem.T)
+    for _ in range(3):
+        xi = trajectory.active_segment().copy()
+        xi += .01 * np.random.rand(xi.size)
+        [v, g] = problem.objective.value_and_gradient(xi)
+        assert_allclose(v, problem.objective(xi))
+        assert_allclose(g, problem.objective.gradient(xi), rtol=1e-6,
+                        atol=1e-8)
+
+    problem = MotionOptimization2DCostMap(T=30)
+    trajectory = linear_interpolation_trajectory(
+        problem.q_init, problem.q_goal, problem.T)
+    calculate_value_and_gradient_speedup(
+        problem.objective, trajectory.active_segment())
+
+
+def test_evaluate_all():
+    np.random.seed(0)
+    problem = MotionOptimization2DCostMap(T=10)
+    trajectory = linear_interpolation_trajectory(
+        problem.q_init, problem.q_goal, problem.T)
+    xi = trajectory.active_segment().copy()
+    xi += .01 * np.random.rand(xi.size)
+    [v, J, H] = problem.objective.evaluate_all(xi)
+    assert_allclose(v, problem.objective(xi))
+    assert_allclose(J, problem.objective.jacobian(xi), rtol=1e-8)
+    assert_allclose(H, problem.objective.hessian(xi), rtol=1e-8)
+
+
+def test_hessian_vector_product():
+    np.random.seed(0)
+    problem = MotionOptimization2DCostMap(T=10)
+    trajectory = linear_interpolation_trajectory(
+        problem.q_init, problem.q_goal, problem.T)
+    xi = trajectory.active_segment().copy()
+    xi += .01 * np.random.rand(xi.size)
+    H = problem.objective.hessian(xi)
+    for _ in range(3):
+        v = np.random.rand(xi.size)
+        Hv = problem.objective.hessian_vector_product(xi, v)
+        assert Hv.shape == xi.shape
+        assert_allclose(Hv, np.dot(H, v), rtol=1e-8, atol=1e-10)
+
+
+def test_evaluation_into_buffers():
+    np.random.seed(0)
+    for T in [10, 200]:
+        problem = MotionOptimization2DCostMap(T=T)
+        trajectory = linear_interpolation_trajectory(
+            problem.q_init, problem.q_goal, problem.T)
+        xi = trajectory.active_segment().copy()
+        xi += .01 * np.random.rand(xi.size)
+        n = xi.size
+        J = np.zeros((1, n))
+        H = np.zeros((n, n))
+        t_0 = time.time()
+        for _ in range(3):
+            problem.objective.jacobian(xi)
+            problem.objective.hessian(xi)
+        t_1 = time.time()
+        for _ in range(3):
+            problem.objective.jacobian_into(xi, J)
+            problem.objective.hessian_into(xi, H)
+        t_2 = time.time()
+        print("T = {} : allocating {:.4f} sec., buffers {:.4f} sec.".format(
+            T, t_1 - t_0, t_2 - t_1))
+        assert_allclose(J, problem.objective.jacobian(xi), rtol=1e-8)
+        assert_allclose(H, problem.objective.hessian(xi), rtol=1e-8)
+
+
+def test_compile_network():
+    np.random.seed(0)
+    problem = MotionOptimization2DCostMap(T=10)
+    trajectory = linear_interpolation_trajectory(
+        problem.q_init, problem.q_goal, problem.T)
+    xi = trajectory.active_segment().copy()
+    xi += .01 * np.random.rand(xi.size)
+    [v, J, H] = problem.objective.evaluate_all(xi)
+    problem.function_network.compile()
+    network = problem.function_network
+    functions = [network.clique_functions(t)
+                 for t in range(network.nb_cliques())]
+    assert len(functions[1]) < 5
+    assert functions[1][0] is functions[2][0]
+    [v_c, J_c, H_c] = problem.objective.evaluate_all(xi)
+    assert_allclose(v_c, v)
+    assert_allclose(J_c, J, atol=1e-8)
+    assert_allclose(H_c, H, atol=1e-8)
+
+
 def test_optimize():
     print("Check Motion Optimization (optimize)")
     q_init = np.zeros(2)
@@ -586,6 +701,178 @@ def test_trajectory_following():
         assert u_t.size == q_t.size
 
 
+def test_sphere_tracing():
+    workspace = Workspace()
+    workspace.obstacles.append(Circle(np.array([.1, .1]), .2))
+    workspace.obstacles.append(
+        AxisAlignedBox(np.array([-.2, -.3]), np.array([.2, .1])))
+
+    def sampled_min_dist(p_init, p_goal):
+        s = np.linspace(0., 1., 2000)
+        points = np.outer(p_init, 1. - s) + np.outer(p_goal, s)
+        return workspace.min_dist(points)[0].min()
+
+    p_init = np.random.uniform(-.5, .5, (200, 2))
+    p_goal = np.random.uniform(-.5, .5, (200, 2))
+    collision = sphere_tracing(workspace, p_init, p_goal, 1e-3)
+    d = np.array([sampled_min_dist(*p) for p in zip(p_init, p_goal)])
+    assert collision.any() and not collision.all()
+    assert np.all(collision[d < 0.])
+    assert not np.any(collision[d > 2e-3])
+
+    # segment tangent to the circle
+    assert collision_check_linear_interpolation(
+        workspace, np.array([-.3, .3]), np.array([.3, .3]))
+    assert not collision_check_linear_interpolation(
+        workspace, np.array([-.3, .31]), np.array([.3, .31]))
+    assert not sphere_tracing(Workspace(), p_init, p_goal).any()
+
+    trajectories = [None] * 20
+    for k in range(len(trajectories)):
+        trajectories[k] = ContinuousTrajectory(5, 2)
+        trajectories[k].x()[:] = np.random.uniform(
+            -.5, .5, trajectories[k].x().size)
+    collision = collision_check_trajectories(workspace, trajectories)
+    for k, trajectory in enumerate(trajectories):
+        assert collision_check_trajectory(
+            workspace, trajectory) == collision[k]
+        configurations = trajectory.list_configurations()
+        assert collision[k] == sphere_tracing(
+            workspace, configurations[:-1], configurations[1:]).any()
+
+
+def test_sample_start_goal_pairs():
+    workspace = Workspace(EnvBox(np.array([0., 0.]), np.array([1., 1.])))
+    workspace.obstacles.append(Circle(np.array([0., 0.]), .2))
+    for line_of_sight in [True, False]:
+        starts, goals = sample_start_goal_pairs(
+            workspace, 50, .05, .5, line_of_sight)
+        assert starts.shape == goals.shape == (50, 2)
+        assert np.all(workspace.min_dist(starts.T)[0] > .05)
+        assert np.all(workspace.min_dist(goals.T)[0] > .05)
+        assert np.all(norm(goals - starts, axis=1) >= .5)
+        for s, g in zip(starts, goals):
+            assert collision_check_linear_interpolation(
+                workspace, s, g) != line_of_sight
+    starts, goals = sample_start_goal_pairs(workspace, 10, .05, 10.)
+    assert starts.shape == goals.shape == (0, 2)
+
+    # the blocks of candidates are shared by all the constraints
+    min_dist = workspace.min_dist
+    nb_candidates = []
+
+    def counting_min_dist(x):
+        nb_candidates.append(np.asarray(x).reshape(2, -1).shape[1])
+        return min_dist(x)
+    workspace.min_dist = counting_min_dist
+    starts, goals = sample_start_goal_pairs(
+        workspace, 10, .05, 10., max_blocks=3)
+    assert starts.shape == goals.shape == (0, 2)
+    assert len(nb_candidates) == 3
+    assert sum(nb_candidates) <= 3 * 1.5 * 2 * 100 * 10
+    np.random.seed(0)
+    starts, goals = sample_start_goal_pairs(
+        workspace, 50, .05, 1.3, max_blocks=2)
+    assert 0 < starts.shape[0] < 50
+    assert np.all(norm(goals - starts, axis=1) >= 1.3)
+
+
+def test_vectorized_cliques():
+    np.random.seed(0)
+    T, n = 12, 2
+    trajectory = Trajectory(T, n)
+    trajectory.x()[:] = np.random.random(trajectory.x().size)
+    x = trajectory.x()
+    network = CliquesFunctionNetwork(x.size, n)
+    cliques = network.all_cliques(x)
+    assert cliques.shape == (network.nb_cliques(), 3 * n)
+    assert np.shares_memory(cliques, x)
+    network.register_function_for_all_cliques(
+        SquaredNormAcceleration(n, .1))
+    network.register_function_for_all_cliques(Pullback(
+        ExpTestFunction(), network.center_of_clique_map()))
+    network.register_function_for_clique(3, Scale(Pullback(
+        SquaredNormVelocity(n, .1), network.right_of_clique_map()), 2.))
+    network.register_function_last_clique(Pullback(
+        SquaredNorm(np.ones(n)), network.right_most_of_clique_map()))
+
+    # reference: loop over all functions of each clique
+    value = 0.
+    g = np.zeros(x.size)
+    H = np.zeros((x.size, x.size))
+    for t in range(network.nb_cliques()):
+        x_t = trajectory.clique(t + 1)
+        idx = slice(t * n, t * n + 3 * n)
+        for f in network.clique_functions(t):
+            value += f.forward(x_t)
+            g[idx] += np.asarray(f.jacobian(x_t)).flatten()
+            H[idx, idx] += f.hessian(x_t)
+    assert_allclose(network.forward(x), value)
+    assert_allclose(network.jacobian(x), g.reshape(1, -1))
+    assert_allclose(network.hessian(x), H)
+    [v, J, H_all] = network.evaluate_all(x)
+    assert_allclose(v, value)
+    assert_allclose(J, g.reshape(1, -1))
+    assert_allclose(H_all, H)
+    v = np.random.random(x.size)
+    assert_allclose(network.hessian_vector_product(x, v), H.dot(v))
+    y, backward = network.forward_record(x)
+    assert_allclose(y, value)
+    assert_allclose(backward(np.ones(1)), g)
+    assert check_jacobian_against_finite_difference(network)
+
+
+def test_sparse_hessian():
+    np.random.seed(0)
+    problem = MotionOptimization2DCostMap(T=10)
+    trajectory = linear_interpolation_trajectory(
+        problem.q_init, problem.q_goal, problem.T)
+    xi = trajectory.active_segment().copy()
+    xi += .01 * np.random.rand(xi.size)
+    network = problem.function_network
+    x_full = problem.objective.full_vector(xi)
+    for f, x in [(network, x_full), (problem.objective, xi)]:
+        H = np.asarray(f.hessian(x))
+        H_sparse = f.hessian_sparse(x)
+        assert sparse.issparse(H_sparse)
+        assert_allclose(H_sparse.toarray(), H, atol=1e-12)
+        ab = f.hessian_banded(x)
+        assert ab.shape == (3 * problem.config_space_dim, x.size)
+        H_banded = np.zeros(H.shape)
+        for d in range(ab.shape[0]):
+            H_banded += np.diag(ab[d, :x.size - d], -d)
+        assert_allclose(np.tril(H), H_banded, atol=1e-12)
+
+
+def test_trajectory_views():
+    np.random.seed(0)
+    T, n, dt = 10, 3, .1
+    trajectory = Trajectory(T, n)
+    trajectory.x()[:] = np.random.random(trajectory.x().size)
+    q = trajectory.configurations
+    assert q.shape == (T + 2, n)
+    assert np.shares_memory(q, trajectory.x())
+    q[3] = np.ones(n)
+    assert_allclose(trajectory.configuration(3), np.ones(n))
+    v = trajectory.velocities(dt)
+    a = trajectory.accelerations(dt)
+    x = trajectory.states(dt)
+    assert a.shape == (T + 1, n)
+    assert x.shape == (T + 2, 2 * n)
+    for i in range(T + 2):
+        assert_allclose(q[i], trajectory.configuration(i))
+        assert_allclose(v[i], trajectory.velocity(i, dt))
+        assert_allclose(x[i], trajectory.state(i, dt))
+    for i in range(T + 1):
+        assert_allclose(a[i], trajectory.acceleration(i, dt))
+    trajectory = trajectory.continuous_trajectory()
+    s = np.linspace(0, 1, 7)
+    q_s = trajectory.configurations_at_parameters(s)
+    for i in range(s.size):
+        assert_allclose(
+            q_s[i], trajectory.configuration_at_parameter(s[i]), atol=1e-12)
+
+
 if __name__ == "__main__":
     # test_finite_differences()
     # test_integration()
@@ -608,3 +895,8 @@ if __name__ == "__main__":
     # test_trajectory_objective()
     # test_optimize()
     # test_trajectory_following()
+    # test_sphere_tracing()
+    # test_sample_start_goal_pairs()
+    # test_vectorized_cliques()
+    # test_sparse_hessian()
+    # test_trajectory_views()
@@ -24,6 +24,7 @@ print((scipy.__version__))
 import numpy as np
 from geometry.differentiable_geometry import *
 from motion.objective import *
+from optimization.algorithms import *
 from numpy.testing import assert_allclose
 
 
@@ -113,8 +114,51 @@ def test_motion_optimimization_2d():
     assert_allclose(res.jac, np.zeros(res.jac.size), atol=1e-1)
 
 
+def test_banded_newton():
+    np.random.seed(0)
+    trajectory = linear_interpolation_trajectory(
+        q_init=np.zeros(2), q_goal=.5 * np.ones(2), T=20)
+    problem = MotionOptimization2DCostMap(
+        T=trajectory.T(),
+        q_init=trajectory.initial_configuration(),
+        q_goal=trajectory.final_configuration())
+    problem.create_clique_network()
+    problem.add_init_and_terminal_terms()
+    problem.add_smoothness_terms(1)
+    problem.add_smoothness_terms(2)
+    problem.create_objective()
+    f = problem.objective
+
+    # quadratic objective: one newton step
+    x0 = trajectory.active_segment().copy()
+    x0 += .1 * np.random.randn(x0.size)
+    res = banded_newton(f, x0, gtol=1e-5)
+    assert res.success and res.nit <= 2
+    g = f.gradient(np.zeros(f.input_dimension()))
+    x_star = np.linalg.solve(f.hessian(x0), -g)
+    assert_allclose(res.x, x_star, atol=1e-6)
+
+    # indefinite hessian: the steps are damped
+    H = np.array([[1., 2.], [2., 1.]])
+    ab = np.array([np.diag(H), [2., 0.]])
+    p, damping = damped_banded_solve(ab, np.ones(2))
+    assert damping > 0.
+    assert_allclose((H + damping * np.eye(2)).dot(p), np.ones(2))
+
+    # barriers return inf outside of the box, which the search rejects
+    problem.add_box_limits()
+    problem.create_objective()
+    f = problem.objective
+    x0 = trajectory.active_segment().copy()
+    x0 += .01 * np.random.rand(x0.size)
+    res = banded_newton(f, x0, maxiter=20)
+    assert np.isfinite(res.fun) and res.fun < f(x0)
+    assert np.linalg.norm(res.jac) < 1e-3 * np.linalg.norm(f.gradient(x0))
+
+
 if __name__ == "__main__":
     test_optimization_module()
     test_optimization_trust()
     test_quadric()
     test_motion_optimimization_2d()
+    test_banded_newton()
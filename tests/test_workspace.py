@@ -23,6 +23,8 @@ from __init__ import *
 # from .__init__ import *
 from geometry.workspace import *
 from itertools import product
+import tempfile
+import os
 from numpy.testing import assert_allclose
 
 
@@ -153,11 +155,39 @@ def test_axis_aligned_box():
         sdf2 = box2.dist_from_border(p)
         assert np.fabs(sdf1 - sdf2) < 1.e-06
 
-    # TODO make code parallelizable
-    # grid = EnvBox().stacked_meshgrid()
-    # sdf1 = box1.dist_from_border(grid)
-    # sdf2 = box2.dist_from_border(grid)
-    # assert_allclose(sdf1, sdf2)
+    grid = EnvBox().stacked_meshgrid(20)
+    sdf1 = box1.dist_from_border(grid)
+    sdf2 = box2.dist_from_border(grid)
+    assert_allclose(sdf1, sdf2)
+    gradients = box1.dist_gradient(grid)
+    hessians = box1.dist_hessian(grid)
+    assert gradients.shape == (2, 20, 20)
+    assert hessians.shape == (2, 2, 20, 20)
+    for i, j in product(list(range(20)), list(range(20))):
+        p = grid[:, i, j]
+        assert_allclose(gradients[:, i, j], box1.dist_gradient(p))
+        assert_allclose(hessians[:, :, i, j], box2.dist_hessian(p),
+                        atol=1e-12)
+
+
+def test_oriented_box():
+    np.random.seed(0)
+    box = OrientedBox(origin=np.array([.1, .2]),
+                      dim=np.array([.4, .2]),
+                      orientation=.5)
+    for _ in range(100):
+        p = EnvBox().sample_uniform()
+        d = min(segment.dist_from_border(p) for segment in box.segments())
+        assert_allclose(box.dist_from_border(p),
+                        -d if box.is_inside(p) else d)
+    sdf = SignedDistance2DMap(box)
+    assert check_jacobian_against_finite_difference(sdf)
+    assert check_hessian_against_finite_difference(sdf)
+    points = np.random.rand(2, 30) - .5
+    assert_allclose(box.dist_from_border(points),
+                    [box.dist_from_border(p) for p in points.T])
+    assert_allclose(box.dist_gradient(points),
+                    np.array([box.dist_gradient(p) for p in points.T]).T)
 
 
 def test_ellipse():
@@ -172,6 +202,28 @@ def test_ellipse():
     print("dist = ", dist)
     assert np.fabs(dist - 0.2) < 1.e-06
 
+    np.random.seed(0)
+    ellipse = Ellipse(a=0.3, b=0.1, origin=[.1, -.2], orientation=.5)
+    points = np.random.uniform(-.6, .6, (2, 300)) + ellipse.origin[:, None]
+    d = ellipse.dist_from_border(points)
+    p = ellipse.closest_point(points)
+    assert_allclose(np.abs(d), np.linalg.norm(points - p, axis=0))
+    assert_allclose(ellipse.dist_from_border(p), 0., atol=1e-12)
+    assert np.array_equal(d < 0., ellipse.is_inside(points))
+    assert_allclose(d, [ellipse.dist_from_border(x) for x in points.T])
+    samples = np.array(ellipse.sampled_points()).T
+    assert np.all(np.linalg.norm(points[:, :, None] - samples[:, None],
+                                 axis=0).min(axis=1) >= np.abs(d) - 1e-12)
+    f = SignedDistance2DMap(ellipse)
+    for x in points.T[:50]:
+        assert check_is_close(
+            f.jacobian(x), finite_difference_jacobian(f, x), 1e-4)
+        assert check_is_close(
+            f.hessian(x), finite_difference_hessian(f, x), 1e-4)
+    assert ellipse.dist_hessian(points).shape == (2, 2, 300)
+    X, Y = np.meshgrid(np.linspace(-1, 1, 100), np.linspace(-1, 1, 100))
+    assert ellipse.dist_from_border(np.array([X, Y])).shape == (100, 100)
+
 
 def test_line_side():
     assert line_side([1, 0], [0, 0], [-1, -1])
@@ -248,6 +300,40 @@ def test_hexagon_jac():
         assert check_is_close(H, H_diff, 1e-4)
 
 
+def test_polygon_batch():
+    np.random.seed(0)
+    angles = np.linspace(0., 2. * np.pi, 11)[:-1]
+    radii = np.where(np.arange(10) % 2 == 0, .4, .2)
+    star = Polygon(verticies=[
+        r * np.array([np.cos(a), np.sin(a)]) for r, a in zip(radii, angles)])
+    for polygon in [Polygon(), hexagon(scale=.5), star]:
+        x = np.random.uniform(-1., 1., (2, 200))
+        d = polygon.dist_from_border(x)
+        d_edges = [e.dist_from_border(x) for e in polygon._edges]
+        assert_allclose(np.abs(d), np.min(d_edges, axis=0))
+        assert_allclose(d, [polygon.dist_from_border(p) for p in x.T])
+        inside = polygon.is_inside(x)
+        assert np.array_equal(inside, d < 0.)
+        assert_allclose(polygon.closest_point(x),
+                        np.array([polygon.closest_point(p) for p in x.T]).T)
+        assert_allclose(polygon.dist_gradient(x),
+                        np.array([polygon.dist_gradient(p) for p in x.T]).T)
+        H = polygon.dist_hessian(x)
+        assert H.shape == (2, 2, 200)
+        f = SignedDistance2DMap(polygon)
+        for p in x.T[:20]:
+            assert check_is_close(
+                f.hessian(p), finite_difference_hessian(f, p), 1e-4)
+        X, Y = np.meshgrid(np.linspace(-1, 1, 10), np.linspace(-1, 1, 10))
+        grid = np.array([X, Y])
+        assert polygon.dist_from_border(grid).shape == (10, 10)
+        assert polygon.is_inside(grid).shape == (10, 10)
+        assert polygon.dist_hessian(grid).shape == (2, 2, 10, 10)
+    assert star.is_inside(np.array([.0, .0]))
+    notch = .25 * np.array([np.cos(angles[1]), np.sin(angles[1])])
+    assert not star.is_inside(notch)
+
+
 def test_sdf_derivatives():
     verbose = False
     circles = []
@@ -268,6 +354,100 @@ def test_sdf_workspace():
     assert check_hessian_against_finite_difference(signed_distance_field)
 
 
+def test_smooth_sdf():
+    np.random.seed(0)
+    workspace = sample_circle_workspaces(nb_circles=5)
+    workspace.obstacles.append(
+        AxisAlignedBox(np.array([.2, .2]), np.array([.1, .2])))
+    workspace.obstacles.append(segment_from_end_points(
+        np.array([-.3, .1]), np.array([-.1, .3])))
+    workspace.obstacles.append(hexagon(.1))
+    sdf = SignedDistanceWorkspaceMap(workspace)
+    points = np.array([workspace.box.sample_uniform() for _ in range(20)])
+    for temperature in [.1, .01]:
+        smooth_sdf = SmoothSignedDistanceWorkspaceMap(workspace, temperature)
+        for p in points:
+            d = np.array([o.dist_from_border(p) for o in workspace.obstacles])
+            assert_allclose(smooth_sdf(p),
+                            -temperature * np.log(np.sum(
+                                np.exp(-d / temperature))))
+            assert smooth_sdf(p) <= sdf(p)
+            assert smooth_sdf(p) >= sdf(p) - temperature * np.log(d.size)
+            assert check_is_close(
+                smooth_sdf.jacobian(p),
+                finite_difference_jacobian(smooth_sdf, p), 1e-4)
+            assert_allclose(smooth_sdf.hessian(p),
+                            finite_difference_hessian(smooth_sdf, p),
+                            rtol=1e-4, atol=1e-4)
+            [d, J, H] = smooth_sdf.evaluate_all(p)
+            assert_allclose(d, smooth_sdf(p))
+            assert_allclose(J, smooth_sdf.jacobian(p))
+            assert_allclose(H, smooth_sdf.hessian(p))
+        assert_allclose(smooth_sdf.forward_batch(points),
+                        [[smooth_sdf(p)] for p in points])
+        assert_allclose(smooth_sdf.jacobian_batch(points),
+                        [smooth_sdf.jacobian(p) for p in points])
+        assert_allclose(smooth_sdf.hessian_batch(points),
+                        [smooth_sdf.hessian(p) for p in points])
+
+    # the log-sum-exp is stable for small temperatures
+    smooth_sdf = SmoothSignedDistanceWorkspaceMap(workspace, 1e-5)
+    grid = workspace.box.stacked_meshgrid(20)
+    assert_allclose(smooth_sdf(grid), sdf(grid), atol=1e-4)
+
+
+def test_grid_sdf():
+    np.random.seed(0)
+    workspace = sample_circle_workspaces(nb_circles=5)
+    sdf = SignedDistanceWorkspaceMap(workspace)
+    grid_sdf = GridSignedDistanceMap(workspace, nb_points=100)
+    grid = workspace.box.stacked_meshgrid(100)
+    assert_allclose(grid_sdf(grid), sdf(grid), atol=1e-12)
+    max_error, rms_error = grid_sdf.interpolation_error()
+    assert max_error < 1e-2
+    assert rms_error < 1e-3
+    points = np.array([workspace.box.sample_uniform() for _ in range(20)])
+    for p in points:
+        assert check_is_close(grid_sdf.jacobian(p),
+                              finite_difference_jacobian(grid_sdf, p), 1e-4)
+        assert_allclose(grid_sdf.hessian(p),
+                        finite_difference_hessian(grid_sdf, p),
+                        rtol=1e-4, atol=1e-4)
+    [d, J, H] = grid_sdf.evaluate_all(points[0])
+    assert_allclose(d, grid_sdf(points[0]))
+    assert_allclose(grid_sdf.forward_batch(points),
+                    [[grid_sdf(p)] for p in points])
+    assert_allclose(grid_sdf.jacobian_batch(points),
+                    [grid_sdf.jacobian(p) for p in points])
+    assert_allclose(grid_sdf.hessian_batch(points),
+                    [grid_sdf.hessian(p) for p in points])
+    assert grid_sdf.forward(points.T).shape == (20,)
+
+    # non square boxes have more cells along the longest side
+    for dim in [np.array([2., 1.]), np.array([1., 2.])]:
+        workspace = Workspace(EnvBox(np.array([.5, .2]), dim))
+        for _ in range(5):
+            workspace.obstacles.append(
+                Circle(workspace.box.sample_uniform(), .1))
+        grid_sdf = GridSignedDistanceMap(workspace, nb_points=50)
+        grid = workspace.box.stacked_meshgrid(50)
+        assert_allclose(grid_sdf(grid), workspace.min_dist(grid)[0],
+                        atol=1e-12)
+        assert grid_sdf.interpolation_error()[0] < 5e-2
+        points = np.array([workspace.box.sample_uniform() for _ in range(20)])
+        assert_allclose(grid_sdf.forward(points.T),
+                        workspace.min_dist(points.T)[0], atol=5e-2)
+
+    # the bicubic spline needs at least 4 x 4 cells
+    workspace = Workspace(EnvBox(np.array([0., 0.]), np.array([1., .33])))
+    raised = False
+    try:
+        GridSignedDistanceMap(workspace, nb_points=10)
+    except ValueError:
+        raised = True
+    assert raised
+
+
 def test_meshgrid():
     nb_points = 10
     workspace = Workspace()
@@ -324,6 +504,175 @@ def test_workspace_to_occupancy_map():
         assert_allclose(occ[i, j], v)
 
 
+def test_packed_obstacles():
+    np.random.seed(0)
+    workspace = sample_circle_workspaces(nb_circles=10)
+    for _ in range(3):
+        workspace.obstacles.append(AxisAlignedBox(
+            workspace.box.sample_uniform(), .1 + .2 * np.random.rand(2)))
+        workspace.obstacles.append(segment_from_end_points(
+            workspace.box.sample_uniform(), workspace.box.sample_uniform()))
+        workspace.obstacles.append(hexagon(.1, workspace.box.sample_uniform()))
+
+    def min_dist(pt):
+        d = np.array([o.dist_from_border(pt) for o in workspace.obstacles])
+        return np.min(d, axis=0), np.argmin(d, axis=0)
+
+    for _ in range(50):
+        p = workspace.box.sample_uniform()
+        [d, i] = workspace.min_dist(p)
+        assert_allclose(d, min_dist(p)[0])
+        assert i == min_dist(p)[1]
+        assert workspace.in_collision(p) == (d < 0)
+        assert_allclose(workspace.min_dist_gradient(p),
+                        workspace.obstacles[i].dist_gradient(p))
+
+    grid = workspace.box.stacked_meshgrid(20)
+    [d, i] = workspace.min_dist(grid)
+    assert d.shape == (20, 20)
+    assert_allclose(d, min_dist(grid)[0])
+    assert_allclose(workspace.in_collision(grid), d < 0)
+    gradients = workspace.min_dist_gradient(grid)
+    for k, l in product(list(range(0, 20, 3)), list(range(0, 20, 3))):
+        assert_allclose(gradients[:, k, l],
+                        workspace.min_dist_gradient(grid[:, k, l]),
+                        atol=1e-12)
+
+    # The packed obstacles follow the modifications of the list
+    p = workspace.obstacles[0].origin
+    assert workspace.in_collision(p)
+    del workspace.obstacles[0]
+    assert_allclose(workspace.min_dist(p)[0], min_dist(p)[0])
+    workspace.obstacles[0] = Circle(p, .01)
+    assert_allclose(workspace.min_dist(p)[0], -.01)
+    workspace.obstacles.sort(key=lambda o: o.dist_from_border(p))
+    [d, i] = workspace.min_dist(p)
+    assert i == 0 and workspace.obstacles[0].origin is p
+    workspace.obstacles.sort(key=lambda o: o.dist_from_border(p),
+                             reverse=True)
+    assert workspace.min_dist(p)[1] == len(workspace.obstacles) - 1
+    workspace.obstacles = []
+    assert not workspace.in_collision(p)
+
+
+def test_obstacle_index():
+    np.random.seed(0)
+    workspace = Workspace(EnvBox(dim=np.array([10., 10.])),
+                          spatial_index=True)
+    for _ in range(40):
+        workspace.add_circle(workspace.box.sample_uniform(),
+                             .05 + .2 * np.random.rand())
+        workspace.obstacles.append(AxisAlignedBox(
+            workspace.box.sample_uniform(), .1 + .3 * np.random.rand(2)))
+        workspace.add_segment(workspace.box.sample_uniform(), .5)
+    workspace.obstacles.append(Ellipse(.3, .1, [1., 1.], .5))
+    workspace.obstacles.append(Complex(shapes=[Circle([-1., 1.], .2)]))
+    polygon = hexagon(.2)
+    workspace.obstacles.append(polygon)
+
+    def min_dist(pt):
+        d = np.array([o.dist_from_border(pt) for o in workspace.obstacles])
+        return np.min(d, axis=0), np.argmin(d, axis=0)
+
+    grid = workspace.box.stacked_meshgrid(30)
+    [d, i] = workspace.min_dist(grid)
+    d_all, i_all = min_dist(grid)
+    assert_allclose(d, d_all)
+    assert np.array_equal(i, i_all)
+    assert np.array_equal(workspace.in_collision(grid), d_all < 0.)
+    for _ in range(20):
+        p = workspace.box.sample_uniform()
+        [d, i] = workspace.min_dist(p)
+        assert_allclose(d, min_dist(p)[0])
+        assert i == min_dist(p)[1]
+        assert workspace.in_collision(p) == (d < 0)
+
+    index = workspace.obstacle_index()
+    assert index.unbounded_ids.tolist() == [121]
+    points = grid.reshape(2, -1)
+    distances = workspace.packed_obstacles().distances(points)
+    p, ids, d = index.close_obstacles(points, .1)
+    assert_allclose(d, distances[ids, p])
+    assert sorted(zip(p, ids)) == sorted(
+        zip(*np.nonzero(distances.T < .1)))
+
+    # The index is rebuilt when obstacles are added
+    p = np.array([4.8, -4.8])
+    workspace.add_circle(p, .05)
+    assert workspace.obstacle_index() is not index
+    assert workspace.in_collision(p)
+    assert workspace.min_dist(p)[1] == len(workspace.obstacles) - 1
+
+
+def test_sample_collision_free_points():
+    workspace = sample_circle_workspaces(nb_circles=10)
+    for low_discrepancy in [False, True]:
+        points = sample_collision_free_points(
+            workspace, 500, .05, low_discrepancy)
+        assert points.shape == (500, 2)
+        assert np.all(workspace.min_dist(points.T)[0] > .05)
+        assert np.all(points >= workspace.box.lower_corner())
+        assert np.all(points <= workspace.box.upper_corner())
+
+    # the free space is empty, the budget bounds the number of blocks
+    points = sample_collision_free_points(workspace, 10, 10., max_blocks=5)
+    assert points.shape == (0, 2)
+
+    u = halton_sequence(1000)
+    assert u.shape == (1000, 2)
+    assert np.unique(u[:, 0]).size == 1000
+    assert_allclose(u[:3], [[.5, 1. / 3], [.25, 2. / 3], [.75, 1. / 9]])
+    counts = np.histogram2d(u[:, 0], u[:, 1], bins=4)[0]
+    assert np.all(np.abs(counts - 1000 / 16.) <= 2)
+
+
+def test_rasterize():
+    box = EnvBox(np.array([.5, .2]), np.array([2., 1.]))
+    workspace = Workspace(box)
+    for _ in range(10):
+        workspace.obstacles.append(Circle(box.sample_uniform(), .1))
+    x, y = box.cell_centers(40)
+    assert x.size == 40 and y.size == 20
+    assert_allclose(x[1] - x[0], y[1] - y[0])
+    assert_allclose([x[0], y[0]], box.lower_corner() + .025)
+    assert_allclose([x[-1], y[-1]], box.upper_corner() - .025)
+    X, Y = box.meshgrid(40)
+    assert X.shape == (20, 40)
+
+    sdf = workspace.min_dist(np.stack([X, Y]))[0].T
+    assert_allclose(signed_distance_map(40, workspace), sdf)
+    assert_allclose(signed_distance_map(
+        40, workspace, tile_size=7, nb_threads=3), sdf)
+    assert np.array_equal(occupancy_map(40, workspace, tile_size=9), sdf < 0)
+
+    filename = os.path.join(tempfile.mkdtemp(), "sdf.dat")
+    out = np.memmap(filename, dtype=np.float32, mode="w+", shape=(40, 20))
+    assert signed_distance_map(40, workspace, out=out, tile_size=16) is out
+    assert_allclose(np.memmap(filename, dtype=np.float32, shape=(40, 20)),
+                    sdf, rtol=1e-6, atol=1e-6)
+    os.remove(filename)
+
+    # boxes that are taller than wide
+    box = EnvBox(np.array([.5, .2]), np.array([1., 2.]))
+    workspace.box = box
+    x, y = box.cell_centers(20)
+    assert x.size == 20 and y.size == 40
+    pixel_map = pixelmap_from_box(20, box)
+    assert pixel_map.nb_cells_x == 20 and pixel_map.nb_cells_y == 40
+    X, Y = box.meshgrid(20)
+    sdf = workspace.min_dist(np.stack([X, Y]))[0].T
+    assert_allclose(signed_distance_map(20, workspace, tile_size=7), sdf)
+
+    # the rasterized grids and the pixel maps have the same number of cells
+    for dim in [[1., .6], [1., .33], [2., 1.], [1., 2.], [1., .65]]:
+        workspace = Workspace(EnvBox(np.array([0., 0.]), np.array(dim)))
+        pixel_map = workspace.pixel_map(10)
+        x, y = workspace.box.cell_centers(10)
+        assert pixel_map.nb_cells_x == x.size
+        assert pixel_map.nb_cells_y == y.size
+        assert occupancy_map(10, workspace).shape == (x.size, y.size)
+
+
 if __name__ == "__main__":
 
     # test_circle()